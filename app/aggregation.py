@@ -0,0 +1,207 @@
+import time
+from datetime import datetime
+from typing import Dict, Any, Optional, Tuple
+
+from sqlalchemy import text
+
+from .chunking import CHUNK_REF_KEY
+
+# Periods records can be grouped by, as the length of the ISO date prefix
+# naming the group; weeks are merged from days
+GROUP_PERIODS = {'year': 4, 'month': 7, 'week': 10, 'day': 10}
+
+# Most groups returned by a grouped aggregate; results with more are reported as truncated
+MAX_GROUPS = 100
+
+# Chunks holding records: array chunks that are not inside an array element,
+# and array elements stored as chunks of their own ('[3]', 'patients[3]')
+_RECORD_CHUNK = """
+    CASE jsonb_typeof(c.content)
+        WHEN 'array' THEN strpos(c.chunk_type, '[') = 0
+        WHEN 'object' THEN c.chunk_type ~ '^[^[]*\\[\\d+\\]$'
+        ELSE FALSE
+    END
+"""
+
+# ISO text of a record's date; epoch numbers are read like parse_timestamp does
+_DATE_TEXT = """
+    CASE jsonb_typeof(r.date)
+        WHEN 'string' THEN r.date #>> '{}'
+        WHEN 'number' THEN to_char(
+            to_timestamp(CASE WHEN abs(r.date::float8) > 1e11
+                              THEN r.date::float8 / 1000
+                              ELSE r.date::float8 END) AT TIME ZONE 'UTC',
+            'YYYY-MM-DD"T"HH24\\:MI\\:SS')
+    END
+"""
+
+
+def _json_path(field: str, name: str, params: Dict[str, Any]) -> str:
+    """Return the SQL selecting a dotted field of a record, binding its path as name"""
+    if '.' not in field:
+        # -> with a single key is cheaper than #> with a path array
+        params[name] = field
+        return f"(e.item -> :{name})"
+    params[name] = field.split('.')
+    return f"(e.item #> :{name})"
+
+
+def compile_aggregate(field: Optional[str], date_field: Optional[str] = None,
+                      start: Optional[datetime] = None, end: Optional[datetime] = None,
+                      group_field: Optional[str] = None,
+                      group_period: Optional[str] = None) -> Tuple[str, Dict[str, Any]]:
+    """
+    Compile an aggregate question into one SQL statement over the records of all live chunks
+    
+    Records are the elements of array chunks, expanded with
+    jsonb_array_elements, and array elements stored as object chunks of
+    their own; the references left in place of the latter are skipped.
+    Arrays nested inside records are only read for a field their zone
+    maps show they hold, so counting records counts top-level records.
+    Chunks are pruned by their date_span when a period is given and by
+    their zone maps when a field is given.
+    
+    The statement works in stages fenced with OFFSET 0: the fields of each
+    record are extracted once, then converted once, then aggregated;
+    otherwise PostgreSQL inlines the expressions and evaluates them again
+    for every aggregate.
+    
+    Args:
+        field: Dotted path of the numeric field to aggregate; None counts records
+        date_field: Dotted path of the field dating each record
+        start: First day of the period, inclusive
+        end: Day after the period, exclusive
+        group_field: Dotted path of a field to group records by
+        group_period: Period ('day', 'week', 'month', 'year') to group records by
+    
+    Returns:
+        Tuple of (SQL, bind parameters); the statement yields the columns
+        grp, count, sum, min, max and mean, one row per group, for up to
+        MAX_GROUPS + 1 groups so that truncation can be detected
+    """
+    params: Dict[str, Any] = {'max_groups': MAX_GROUPS + 1}
+    chunk_filters = ["c.deleted_at IS NULL"]
+    record_filters = ["TRUE"]
+    
+    if field:
+        params['field'] = field
+        # Zone maps: skip chunks known not to hold the field
+        chunk_filters.append("""(
+            EXISTS (SELECT 1 FROM chunk_field_stats s
+                    WHERE s.chunk_id = c.chunk_id AND s.field = :field
+                      AND s.value_type IN ('number', 'mixed'))
+            OR NOT c.metadata_ ? 'zone_map'
+        )""")
+        # Arrays nested in records count too once their zone map shows they hold the field
+        chunk_filters.append(f"({_RECORD_CHUNK} OR (jsonb_typeof(c.content) = 'array' AND c.metadata_ ? 'zone_map'))")
+        metric = _json_path(field, 'path', params)
+        value = "CASE WHEN jsonb_typeof(r.metric) = 'number' THEN r.metric::numeric END"
+        count = "count(v.value)"
+    else:
+        chunk_filters.append(_RECORD_CHUNK)
+        metric = value = "NULL::numeric"
+        count = "count(*)"
+    
+    date, day = "NULL::jsonb", "NULL::text"
+    if date_field:
+        date, day = _json_path(date_field, 'date_path', params), _DATE_TEXT
+    if start and end and date_field:
+        params.update({'start': start, 'end': end,
+                       'start_text': start.strftime('%Y-%m-%d'), 'end_text': end.strftime('%Y-%m-%d')})
+        chunk_filters.append("c.date_span && tsrange(:start, :end, '[)')")
+        # ISO text compares in date order
+        record_filters.append("v.day >= :start_text AND v.day < :end_text")
+    
+    label = "NULL::text"
+    group = "NULL::text"
+    if group_field:
+        label = f"{_json_path(group_field, 'group_path', params)} #>> '{{}}'"
+        group = "v.label"
+    elif group_period and date_field:
+        group = f"left(v.day, {GROUP_PERIODS[group_period]})"
+    
+    sql = f"""
+        SELECT {group} AS grp,
+               {count} AS count,
+               sum(v.value) AS sum,
+               min(v.value) AS min,
+               max(v.value) AS max,
+               avg(v.value) AS mean
+        FROM (
+            SELECT {value} AS value, {day} AS day, r.label
+            FROM (
+                SELECT {metric} AS metric, {date} AS date, {label} AS label
+                FROM json_chunks c
+                CROSS JOIN LATERAL jsonb_array_elements(
+                    CASE WHEN jsonb_typeof(c.content) = 'array' THEN c.content
+                         ELSE jsonb_build_array(c.content) END
+                ) AS e(item)
+                WHERE {' AND '.join(chunk_filters)}
+                  AND jsonb_typeof(e.item) = 'object'
+                  AND NOT e.item ? '{CHUNK_REF_KEY}'
+                OFFSET 0
+            ) AS r
+            OFFSET 0
+        ) AS v
+        WHERE {' AND '.join(record_filters)}
+        GROUP BY 1
+    """
+    if group_period == 'week' and date_field:
+        # Days are far fewer than records: group by day, then merge the days of each ISO week
+        sql = f"""
+            SELECT CASE WHEN d.grp ~ '^\\d{{4}}-\\d{{2}}-\\d{{2}}$'
+                        THEN to_char(d.grp::date, 'IYYY-"W"IW') END AS grp,
+                   sum(d.count) AS count,
+                   sum(d.sum) AS sum,
+                   min(d.min) AS min,
+                   max(d.max) AS max,
+                   sum(d.sum) / nullif(sum(d.count), 0) AS mean
+            FROM ({sql}) AS d
+            GROUP BY 1
+        """
+    sql += """
+        ORDER BY 1 NULLS LAST
+        LIMIT :max_groups
+    """
+    return sql, params
+
+
+def run_aggregate(db, field: Optional[str], **options) -> Dict[str, Any]:
+    """
+    Run an aggregate inside the database
+    
+    Args:
+        db: Database session
+        field: Dotted path of the numeric field to aggregate; None counts records
+        **options: date_field, start, end, group_field and group_period as
+            accepted by compile_aggregate
+    
+    Returns:
+        Dictionary with 'groups' (list of {'group', 'count', 'sum', 'min',
+        'max', 'mean'}, at most MAX_GROUPS), 'truncated' (whether there
+        were more groups) and 'elapsed_ms'
+    """
+    sql, params = compile_aggregate(field, **options)
+    started = time.perf_counter()
+    rows = db.execute(text(sql), params).mappings().all()
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    
+    groups = []
+    for row in rows[:MAX_GROUPS]:
+        groups.append({
+            'group': row['grp'],
+            'count': _to_number(row['count']),
+            'sum': _to_number(row['sum']),
+            'min': _to_number(row['min']),
+            'max': _to_number(row['max']),
+            'mean': _to_number(row['mean'])
+        })
+    return {'groups': groups, 'truncated': len(rows) > MAX_GROUPS, 'elapsed_ms': round(elapsed_ms, 2)}
+
+
+def _to_number(value: Any) -> Optional[float]:
+    """Convert a numeric column to an int when integral, else a float"""
+    if value is None:
+        return None
+    number = float(value)
+    return int(number) if number.is_integer() and abs(number) < 2 ** 53 else number
@@ -0,0 +1,462 @@
+import fcntl
+import logging
+import math
+import os
+import re
+import threading
+import uuid
+from collections import Counter
+from typing import Dict, Any, Iterable, List, Optional, Tuple
+
+import numpy as np
+import orjson
+
+from .embeddings import chunk_text
+
+logger = logging.getLogger(__name__)
+
+# Directory of the index; BM25 retrieval is enabled when set
+BM25_INDEX_DIR = os.getenv("BM25_INDEX_DIR")
+# Segments kept before the smallest are merged in the background
+BM25_MAX_SEGMENTS = int(os.getenv("BM25_MAX_SEGMENTS", "8"))
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+MANIFEST = 'manifest.json'
+_TOKEN_RE = re.compile(r'[^\W_]+')
+
+# Postings of one term: (local document numbers, term frequencies)
+Postings = Tuple[np.ndarray, np.ndarray]
+
+
+def tokenize(text: str) -> List[str]:
+    """Split text into lowercase word tokens"""
+    return _TOKEN_RE.findall(text.lower())
+
+
+def varint_widths(values: np.ndarray) -> np.ndarray:
+    """Return the number of bytes of each value encoded as a varint"""
+    values = np.asarray(values, dtype=np.uint64)
+    widths = np.ones(len(values), dtype=np.int64)
+    for bits in range(7, 64, 7):
+        widths += values >= np.uint64(1 << bits)
+    return widths
+
+
+def encode_varints(values: np.ndarray) -> bytes:
+    """Encode non-negative integers as LEB128 varints, 7 bits per byte"""
+    values = np.asarray(values, dtype=np.uint64)
+    if not len(values):
+        return b''
+    groups = np.stack([(values >> np.uint64(7 * i)) & np.uint64(0x7f) for i in range(10)], axis=1).astype(np.uint8)
+    widths = varint_widths(values)
+    used = np.arange(10) < widths[:, None]
+    more = np.arange(10) < (widths - 1)[:, None]
+    return (groups | (more * 0x80).astype(np.uint8))[used].tobytes()
+
+
+def decode_varints(data: np.ndarray) -> np.ndarray:
+    """Decode a run of LEB128 varints into an int64 array"""
+    if not len(data):
+        return np.zeros(0, dtype=np.int64)
+    ends = np.flatnonzero((data & 0x80) == 0)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    positions = np.arange(len(data)) - np.repeat(starts, ends - starts + 1)
+    parts = (data & 0x7f).astype(np.int64) << (7 * positions)
+    return np.add.reduceat(parts, starts)
+
+
+class _Segment:
+    """
+    An immutable part of the index, memory-mapped read-only
+    
+    Files:
+        <name>.docs.npy: (chunk id, token count) per local document number
+        <name>.post: postings as varints, the delta-coded document numbers
+            of every term followed by the term frequencies of every term
+        <name>.terms: term -> [document offset, document bytes,
+            frequency offset, frequency bytes, df]
+    """
+    
+    def __init__(self, directory: str, name: str):
+        self.name = name
+        path = os.path.join(directory, name)
+        docs = np.load(path + '.docs.npy', mmap_mode='r')
+        self.ids = docs[:, 0]
+        self.lengths = docs[:, 1]
+        size = os.path.getsize(path + '.post')
+        self.postings = np.memmap(path + '.post', dtype=np.uint8, mode='r') if size else np.zeros(0, np.uint8)
+        with open(path + '.terms', 'rb') as f:
+            self.terms: Dict[str, List[int]] = orjson.loads(f.read())
+    
+    def __len__(self) -> int:
+        return len(self.ids)
+    
+    def df(self, term: str) -> int:
+        entry = self.terms.get(term)
+        return entry[4] if entry else 0
+    
+    def get(self, term: str) -> Optional[Postings]:
+        entry = self.terms.get(term)
+        if entry is None:
+            return None
+        doc_offset, doc_bytes, tf_offset, tf_bytes, _ = entry
+        docs = np.cumsum(decode_varints(self.postings[doc_offset:doc_offset + doc_bytes]))
+        tfs = decode_varints(self.postings[tf_offset:tf_offset + tf_bytes])
+        return docs, tfs
+
+
+def _write_segment(directory: str, ids: np.ndarray, lengths: np.ndarray,
+                   postings: Dict[str, Postings]) -> str:
+    """
+    Write a new segment and return its name
+    
+    The postings of all terms are delta-coded and varint-encoded in one
+    vectorized pass: first the document numbers of every term, then the
+    term frequencies of every term.
+    """
+    name = f'seg_{uuid.uuid4().hex[:12]}'
+    path = os.path.join(directory, name)
+    terms = sorted(postings)
+    terms_index = {}
+    data = b''
+    if terms:
+        dfs = np.array([len(postings[term][0]) for term in terms], dtype=np.int64)
+        starts = np.concatenate(([0], np.cumsum(dfs)[:-1]))
+        docs = np.concatenate([postings[term][0] for term in terms]).astype(np.int64)
+        tfs = np.concatenate([postings[term][1] for term in terms]).astype(np.int64)
+        # Gaps between document numbers, restarting at each term
+        gaps = np.diff(docs, prepend=0)
+        gaps[starts] = docs[starts]
+        
+        doc_sizes = np.add.reduceat(varint_widths(gaps), starts)
+        tf_sizes = np.add.reduceat(varint_widths(tfs), starts)
+        doc_offsets = np.cumsum(doc_sizes) - doc_sizes
+        tf_offsets = np.cumsum(tf_sizes) - tf_sizes + doc_sizes.sum()
+        data = encode_varints(gaps) + encode_varints(tfs)
+        for i, term in enumerate(terms):
+            terms_index[term] = [int(doc_offsets[i]), int(doc_sizes[i]), int(tf_offsets[i]), int(tf_sizes[i]), int(dfs[i])]
+    
+    with open(path + '.post', 'wb') as f:
+        f.write(data)
+    np.save(path + '.docs.npy', np.column_stack([ids, lengths]).astype(np.int64).reshape(-1, 2))
+    with open(path + '.terms', 'wb') as f:
+        f.write(orjson.dumps(terms_index))
+    return name
+
+
+def _invert(docs: Iterable[Tuple[int, List[str]]]) -> Tuple[np.ndarray, np.ndarray, Dict[str, Postings]]:
+    """Build the postings of a batch of (chunk id, tokens) documents"""
+    ids, lengths = [], []
+    postings: Dict[str, Tuple[List[int], List[int]]] = {}
+    for local, (doc_id, tokens) in enumerate(docs):
+        ids.append(doc_id)
+        lengths.append(len(tokens))
+        for term, tf in Counter(tokens).items():
+            entry = postings.get(term)
+            if entry is None:
+                postings[term] = entry = ([], [])
+            entry[0].append(local)
+            entry[1].append(tf)
+    return (
+        np.array(ids, dtype=np.int64),
+        np.array(lengths, dtype=np.int64),
+        {term: (np.array(docs), np.array(tfs)) for term, (docs, tfs) in postings.items()}
+    )
+
+
+class BM25Index:
+    """
+    In-process BM25 index over chunk text, stored as memory-mapped segments
+    
+    Every refresh after an upload writes a new immutable segment holding the
+    file's new chunks and records its tombstoned chunks in a deletion list;
+    segments are merged in the background once there are more than
+    BM25_MAX_SEGMENTS. A manifest names the live segments and is replaced
+    atomically, so uvicorn workers sharing the directory reload it when it
+    changes and share the mapped files through the page cache. Writers
+    serialize on a file lock.
+    
+    Documents are JSONChunk ids; searches never touch the database.
+    """
+    
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._merging = False
+        self._loaded_mtime = None
+        # (segments, deleted chunk ids, document count, average length)
+        self._state: Tuple[List[_Segment], np.ndarray, int, float] = ([], np.zeros(0, np.int64), 0, 0.0)
+    
+    def search(self, query: str, limit: int = 20) -> List[int]:
+        """
+        Return the ids of the chunks that score best for the query
+        
+        Returns:
+            JSONChunk ids, best first
+        """
+        self._reload()
+        segments, deleted, total_docs, avg_length = self._state
+        terms = set(tokenize(query))
+        if not terms or not total_docs:
+            return []
+        
+        found_ids, found_scores = [], []
+        for term in terms:
+            df = sum(segment.df(term) for segment in segments)
+            if not df:
+                continue
+            idf = math.log(1 + (total_docs - df + 0.5) / (df + 0.5))
+            for segment in segments:
+                postings = segment.get(term)
+                if postings is None:
+                    continue
+                docs, tfs = postings
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * segment.lengths[docs] / avg_length)
+                found_ids.append(segment.ids[docs])
+                found_scores.append(idf * tfs * (BM25_K1 + 1) / (tfs + norm))
+        if not found_ids:
+            return []
+        
+        ids, inverse = np.unique(np.concatenate(found_ids), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(found_scores))
+        if len(deleted):
+            live = ~np.isin(ids, deleted)
+            ids, scores = ids[live], scores[live]
+        if len(ids) > limit:
+            top = np.argpartition(-scores, limit)[:limit]
+            ids, scores = ids[top], scores[top]
+        return [int(chunk_id) for chunk_id in ids[np.argsort(-scores, kind='stable')]]
+    
+    def version(self) -> int:
+        """Return a number that changes whenever the index changes"""
+        try:
+            return os.stat(os.path.join(self.directory, MANIFEST)).st_mtime_ns
+        except FileNotFoundError:
+            return 0
+    
+    def refresh(self, db, source_file: Optional[str] = None, batch_size: int = 1000) -> Dict[str, int]:
+        """
+        Bring the index up to date with the database
+        
+        Args:
+            db: Database session
+            source_file: Only look at the chunks of this file; None for all
+            batch_size: Chunks fetched per query when indexing new chunks
+        
+        Returns:
+            Dictionary with the number of chunks 'added' and 'deleted'
+        """
+        from .database import JSONChunk
+        
+        with self._write_lock():
+            manifest = self._read_manifest()
+            indexed = self._indexed_ids(manifest)
+            deleted = self._load_deleted(manifest)
+            
+            rows = db.query(JSONChunk.id, JSONChunk.deleted_at.is_(None))
+            if source_file is not None:
+                rows = rows.filter(JSONChunk.source_file == source_file)
+            rows = rows.all()
+            live = np.array([row_id for row_id, alive in rows if alive], dtype=np.int64)
+            dead = np.array([row_id for row_id, alive in rows if not alive], dtype=np.int64)
+            new_ids = live[~np.isin(live, indexed)]
+            newly_deleted = dead[np.isin(dead, indexed) & ~np.isin(dead, deleted)]
+            
+            if len(new_ids):
+                docs = []
+                for i in range(0, len(new_ids), batch_size):
+                    batch = [int(row_id) for row_id in new_ids[i:i + batch_size]]
+                    for row_id, content in db.query(JSONChunk.id, JSONChunk.content).filter(JSONChunk.id.in_(batch)):
+                        docs.append((row_id, tokenize(chunk_text(content))))
+                ids, lengths, postings = _invert(docs)
+                name = _write_segment(self.directory, ids, lengths, postings)
+                manifest['segments'].append({'name': name, 'docs': len(ids), 'tokens': int(lengths.sum())})
+            if len(newly_deleted):
+                manifest['deleted'] = self._write_deleted(np.union1d(deleted, newly_deleted))
+            if len(new_ids) or len(newly_deleted):
+                self._write_manifest(manifest)
+        
+        if len(manifest['segments']) > BM25_MAX_SEGMENTS:
+            self._merge_in_background()
+        return {'added': len(new_ids), 'deleted': len(newly_deleted)}
+    
+    def merge(self) -> int:
+        """
+        Merge the smaller half of the segments into one, dropping deleted chunks
+        
+        Returns:
+            Number of segments merged
+        """
+        with self._write_lock():
+            manifest = self._read_manifest()
+            entries = sorted(manifest['segments'], key=lambda entry: entry['docs'])
+            merged = entries[:max(2, len(entries) // 2)]
+            if len(merged) < 2:
+                return 0
+            segments = [_Segment(self.directory, entry['name']) for entry in merged]
+            deleted = self._load_deleted(manifest)
+            
+            # New document numbers of the live documents of each segment
+            ids, lengths, remaps = [], [], []
+            start = 0
+            for segment in segments:
+                keep = ~np.isin(segment.ids, deleted)
+                remap = np.full(len(segment), -1, dtype=np.int64)
+                remap[keep] = np.arange(start, start + keep.sum())
+                start += int(keep.sum())
+                ids.append(segment.ids[keep])
+                lengths.append(segment.lengths[keep])
+                remaps.append(remap)
+            
+            postings = {}
+            for term in set().union(*(segment.terms for segment in segments)):
+                term_docs, term_tfs = [], []
+                for segment, remap in zip(segments, remaps):
+                    found = segment.get(term)
+                    if found is None:
+                        continue
+                    docs = remap[found[0]]
+                    live = docs >= 0
+                    term_docs.append(docs[live])
+                    term_tfs.append(found[1][live])
+                docs = np.concatenate(term_docs)
+                if len(docs):
+                    postings[term] = (docs, np.concatenate(term_tfs))
+            
+            ids, lengths = np.concatenate(ids), np.concatenate(lengths)
+            name = _write_segment(self.directory, ids, lengths, postings)
+            merged_names = {entry['name'] for entry in merged}
+            manifest['segments'] = [entry for entry in manifest['segments'] if entry['name'] not in merged_names]
+            manifest['segments'].append({'name': name, 'docs': len(ids), 'tokens': int(lengths.sum())})
+            # Deletions only matter for chunks still held by other segments
+            still_held = deleted[np.isin(deleted, self._indexed_ids(manifest))]
+            old_deleted = manifest.get('deleted')
+            manifest['deleted'] = self._write_deleted(still_held) if len(still_held) else None
+            self._write_manifest(manifest)
+            
+            # Workers that still map the old files keep reading them until they reload
+            for old in merged_names:
+                for suffix in ('.docs.npy', '.post', '.terms'):
+                    self._remove(old + suffix)
+            if old_deleted:
+                self._remove(old_deleted)
+        return len(merged)
+    
+    def _merge_in_background(self):
+        with self._lock:
+            if self._merging:
+                return
+            self._merging = True
+        
+        def run():
+            try:
+                while self.merge() and len(self._read_manifest()['segments']) > BM25_MAX_SEGMENTS:
+                    pass
+            except Exception:
+                logger.exception("BM25 segment merge failed")
+            finally:
+                self._merging = False
+        
+        threading.Thread(target=run, name='bm25-merge', daemon=True).start()
+    
+    def _reload(self):
+        """Map the segments named by the manifest when it changed"""
+        path = os.path.join(self.directory, MANIFEST)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self._loaded_mtime:
+            return
+        for _ in range(3):
+            manifest = self._read_manifest()
+            try:
+                segments = [_Segment(self.directory, entry['name']) for entry in manifest['segments']]
+                deleted = self._load_deleted(manifest)
+                break
+            except FileNotFoundError:
+                # A merge replaced the manifest while it was being loaded
+                continue
+        else:
+            return
+        total_docs = sum(len(segment) for segment in segments)
+        total_tokens = sum(entry['tokens'] for entry in manifest['segments'])
+        self._state = (segments, deleted, total_docs, total_tokens / total_docs if total_docs else 0.0)
+        self._loaded_mtime = mtime
+    
+    def _indexed_ids(self, manifest: Dict[str, Any]) -> np.ndarray:
+        """Chunk ids held by the segments of a manifest, deleted or not"""
+        ids = [
+            np.load(os.path.join(self.directory, entry['name'] + '.docs.npy'), mmap_mode='r')[:, 0]
+            for entry in manifest['segments']
+        ]
+        return np.concatenate(ids) if ids else np.zeros(0, dtype=np.int64)
+    
+    def _read_manifest(self) -> Dict[str, Any]:
+        try:
+            with open(os.path.join(self.directory, MANIFEST), 'rb') as f:
+                return orjson.loads(f.read())
+        except FileNotFoundError:
+            return {'segments': [], 'deleted': None}
+    
+    def _write_manifest(self, manifest: Dict[str, Any]):
+        path = os.path.join(self.directory, MANIFEST)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(orjson.dumps(manifest))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+    
+    def _load_deleted(self, manifest: Dict[str, Any]) -> np.ndarray:
+        name = manifest.get('deleted')
+        if not name:
+            return np.zeros(0, dtype=np.int64)
+        return np.load(os.path.join(self.directory, name), mmap_mode='r')
+    
+    def _write_deleted(self, deleted: np.ndarray) -> str:
+        name = f'deleted_{uuid.uuid4().hex[:12]}.npy'
+        np.save(os.path.join(self.directory, name), np.asarray(deleted, dtype=np.int64))
+        return name
+    
+    def _remove(self, name: str):
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except OSError:
+            pass
+    
+    def _write_lock(self):
+        return _DirectoryLock(self.directory, self._lock)
+
+
+class _DirectoryLock:
+    """Serializes index writers across threads and worker processes"""
+    
+    def __init__(self, directory: str, lock: threading.Lock):
+        self.path = os.path.join(directory, 'write.lock')
+        self.lock = lock
+        self.file = None
+    
+    def __enter__(self):
+        self.lock.acquire()
+        self.file = open(self.path, 'w')
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        return self
+    
+    def __exit__(self, *exc):
+        fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.file.close()
+        self.lock.release()
+
+
+_index: Optional[BM25Index] = None
+
+
+def get_bm25_index() -> Optional[BM25Index]:
+    """Return the process-wide index, or None when BM25_INDEX_DIR is not set"""
+    global _index
+    if _index is None and BM25_INDEX_DIR:
+        _index = BM25Index(BM25_INDEX_DIR)
+    return _index
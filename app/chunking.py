@@ -0,0 +1,314 @@
+import json
+import math
+import uuid
+import zlib
+from typing import Dict, Any, List, Optional, Tuple
+
+import orjson
+
+
+def serialize(value: Any) -> bytes:
+    """Serialize a value as compact JSON"""
+    try:
+        return orjson.dumps(value)
+    except TypeError:
+        # orjson rejects integers wider than 64 bits
+        return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+
+def serialized_size(value: Any) -> int:
+    """Return the size in bytes of a value serialized as compact JSON"""
+    return len(serialize(value))
+
+
+# Serialized size of an item and a 32-bit fingerprint of its content
+ItemSignature = Tuple[int, int]
+
+
+def item_signature(value: Any) -> ItemSignature:
+    """Return the serialized size and content fingerprint of an array item"""
+    data = serialize(value)
+    return len(data), zlib.crc32(data)
+
+
+# Share of the chunk limits a chunk must reach before it may end at a
+# content-defined boundary; keeps runs of identical items from being split
+# into one chunk per item
+MIN_BOUNDARY_FILL = 0.25
+
+
+class ChunkingPolicy:
+    """
+    Decides where array chunks end
+    
+    Chunks are closed when they reach max_items, or, when a byte or token
+    budget is set, when the next item would push them over that budget.
+    A chunk always takes at least min_items items (and at least one), so a
+    single oversized item still forms a chunk of its own.
+    
+    With content_defined, chunks of the root array also end after items
+    whose content fingerprint matches, on average about once per chunk
+    limit. Those boundaries do not move when records are inserted or
+    removed elsewhere in the array, so re-uploading an edited file leaves
+    the chunks away from the edit unchanged.
+    """
+    
+    def __init__(self, max_items: int = 1000, min_items: int = 1,
+                 max_bytes: Optional[int] = None, max_tokens: Optional[int] = None,
+                 bytes_per_token: float = 4.0, content_defined: bool = True):
+        """
+        Initialize the chunking policy
+        
+        Args:
+            max_items: Maximum number of items per chunk
+            min_items: Minimum number of items per chunk before a size budget applies
+            max_bytes: Budget for the serialized size of a chunk
+            max_tokens: Budget for the estimated token count of a chunk
+            bytes_per_token: Average serialized bytes per LLM token, used to
+                estimate token counts without a tokenizer
+            content_defined: End chunks at content-defined boundaries as
+                well as at the limits
+        """
+        self.max_items = max_items
+        self.min_items = max(min_items, 1)
+        self.max_bytes = max_bytes
+        self.max_tokens = max_tokens
+        self.bytes_per_token = bytes_per_token
+        self.content_defined = content_defined
+        
+        budgets = []
+        if max_bytes:
+            budgets.append(max_bytes)
+        if max_tokens:
+            budgets.append(int(max_tokens * bytes_per_token))
+        self.byte_budget = min(budgets) if budgets else None
+    
+    @property
+    def is_size_based(self) -> bool:
+        return self.byte_budget is not None
+    
+    def fits(self, items: int, size: int, item_size: int) -> bool:
+        """
+        Check whether another item can be added to a chunk
+        
+        Args:
+            items: Number of items already in the chunk
+            size: Serialized bytes already in the chunk
+            item_size: Serialized bytes of the next item
+        """
+        if items >= self.max_items:
+            return False
+        if self.byte_budget is None or items < self.min_items:
+            return True
+        # Brackets and commas of the serialized chunk count towards the budget
+        return size + item_size + items + 2 <= self.byte_budget
+    
+    def is_boundary(self, items: int, size: int, item_size: int, fingerprint: int) -> bool:
+        """
+        Check whether a chunk ends after its last item because of that item's content
+        
+        Each item is a boundary with a chance equal to its share of the
+        tightest limit, decided by its fingerprint alone, so the same items
+        are boundaries wherever they appear in the array.
+        
+        Args:
+            items: Number of items in the chunk, including the last one
+            size: Serialized bytes in the chunk, including the last item
+            item_size: Serialized bytes of the last item
+            fingerprint: Content fingerprint of the last item
+        """
+        if not self.content_defined or items < self.min_items:
+            return False
+        fill = items / self.max_items
+        chance = 1 / self.max_items
+        if self.byte_budget is not None:
+            fill = max(fill, size / self.byte_budget)
+            chance = max(chance, item_size / self.byte_budget)
+        return fill >= MIN_BOUNDARY_FILL and fingerprint < chance * 2 ** 32
+    
+    def estimate_tokens(self, size: int) -> int:
+        """Estimate the LLM token count of size serialized bytes"""
+        return math.ceil(size / self.bytes_per_token)
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """Describe the policy for chunk metadata"""
+        return {
+            'strategy': 'size' if self.is_size_based else 'items',
+            'max_items': self.max_items,
+            'min_items': self.min_items,
+            'max_bytes': self.max_bytes,
+            'max_tokens': self.max_tokens,
+            'bytes_per_token': self.bytes_per_token,
+            'content_defined': self.content_defined
+        }
+    
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'ChunkingPolicy':
+        data = dict(data)
+        data.pop('strategy', None)
+        return cls(**data)
+
+
+# Key of the placeholder left where a nested value was moved to its own chunk
+CHUNK_REF_KEY = '$ref'
+
+# A chunk ready to be stored: (chunk_type, chunk_data, info), where info holds
+# the chunk's JSON path, its chunk_id and the chunk_id of its parent
+ChunkRecord = Tuple[str, Any, Dict[str, Any]]
+
+
+def child_path(path: str, key: Any) -> str:
+    """Return the JSON path of an object member"""
+    return f'{path}.{key}' if path else str(key)
+
+
+def make_record(chunk_type: str, chunk: Any, path: str, parent: Optional['ChunkAnchor'],
+                chunk_id: Optional[str] = None, **info) -> ChunkRecord:
+    """Build a chunk record, allocating a chunk_id unless one is given"""
+    info.update({
+        'path': path,
+        'chunk_id': chunk_id or str(uuid.uuid4()),
+        'parent_id': parent.chunk_id if parent is not None else None
+    })
+    return chunk_type, chunk, info
+
+
+class ChunkAnchor:
+    """
+    Chunk id of a value that may have to become a chunk of its own
+    
+    The id is only allocated when a nested chunk names the value as its
+    parent; a value whose anchor was used holds references to other chunks
+    and is stored as a chunk itself.
+    """
+    
+    __slots__ = ('_chunk_id',)
+    
+    def __init__(self):
+        self._chunk_id = None
+    
+    @property
+    def used(self) -> bool:
+        return self._chunk_id is not None
+    
+    @property
+    def chunk_id(self) -> str:
+        if self._chunk_id is None:
+            self._chunk_id = str(uuid.uuid4())
+        return self._chunk_id
+
+
+class ArrayChunker:
+    """
+    Groups the items of one array into chunks following a policy
+    
+    The first chunk is held back until the array turns out to need more
+    than one; an array that fits in a single chunk stays inline in its
+    parent value. Arrays given a fixed chunk_type (the root array) are
+    always chunked.
+    """
+    
+    def __init__(self, policy: ChunkingPolicy, path: str, parent: Optional[ChunkAnchor],
+                 chunk_type: Optional[str] = None):
+        """
+        Initialize the chunker
+        
+        Args:
+            policy: Chunking policy deciding where chunks end
+            path: JSON path of the array
+            parent: Anchor of the value holding the array, None at the root
+            chunk_type: Chunk type for every chunk; defaults to '<path>_chunk_N'
+        """
+        self.policy = policy
+        self.path = path
+        self.parent = parent
+        self.chunk_type = chunk_type
+        self.count = 0
+        self.chunks = 0
+        self._items: List[Any] = []
+        self._size = 0
+        self._offset = 0
+        self._held = None
+        self._boundary = False
+        # Chunks of nested arrays are named after their position, and an array
+        # that fits in one chunk stays inline, so content-defined boundaries
+        # are only placed in arrays with a fixed chunk_type
+        self._content_defined = policy.content_defined and chunk_type is not None
+        self._signed = policy.is_size_based or self._content_defined
+    
+    def add(self, item: Any, signature: Optional[ItemSignature] = None) -> List[ChunkRecord]:
+        """Add the next item, with its signature if already known, and return any chunks it closed"""
+        if signature is None and self._signed:
+            signature = item_signature(item)
+        item_size = signature[0] if signature else 0
+        records = []
+        if self._items and (self._boundary or not self.policy.fits(len(self._items), self._size, item_size)):
+            records = self._close()
+        self._items.append(item)
+        self._size += item_size
+        self.count += 1
+        self._boundary = self._content_defined and self.policy.is_boundary(
+            len(self._items), self._size, *signature
+        )
+        return records
+    
+    @property
+    def pending(self) -> int:
+        """Number of items in the chunk still open"""
+        return len(self._items)
+    
+    def skip(self, count: int):
+        """
+        Account for items the caller stored as chunks of its own
+        
+        The skipped items start with those of the open chunk, which is
+        dropped; only used for arrays with a fixed chunk_type.
+        
+        Args:
+            count: Number of items skipped, including those of the open chunk
+        """
+        self.count += count - len(self._items)
+        self._offset += count
+        self._items = []
+        self._size = 0
+        self._boundary = False
+    
+    def finish(self) -> Tuple[List[ChunkRecord], Any]:
+        """
+        Close the array
+        
+        Returns:
+            Tuple of (remaining chunk records, value to keep in the parent):
+            the items themselves when the array fits inline, otherwise a
+            reference to its chunks
+        """
+        if self._inline:
+            return [], self._items
+        records = self._close() if self._items else []
+        return records, {CHUNK_REF_KEY: self.path, 'items': self.count, 'chunks': self.chunks}
+    
+    @property
+    def _inline(self) -> bool:
+        return self.chunk_type is None and self._held is None and not self.chunks
+    
+    def _close(self) -> List[ChunkRecord]:
+        chunk = (self._items, self._offset)
+        self._offset += len(self._items)
+        self._items = []
+        self._size = 0
+        if self._inline:
+            # Not known yet whether the array fits in one chunk
+            self._held = chunk
+            return []
+        
+        records = []
+        if self._held is not None:
+            records.append(self._record(*self._held))
+            self._held = None
+        records.append(self._record(*chunk))
+        return records
+    
+    def _record(self, items: List[Any], offset: int) -> ChunkRecord:
+        chunk_type = self.chunk_type or f'{self.path}_chunk_{self.chunks}'
+        self.chunks += 1
+        return make_record(chunk_type, items, self.path, self.parent, item_offset=offset)
@@ -0,0 +1,200 @@
+import math
+import os
+import re
+from collections import Counter
+from typing import Any, Dict, List, Set, Tuple
+
+import orjson
+
+from .value_index import is_id_field
+
+try:
+    import tiktoken
+    _ENCODING = tiktoken.get_encoding("cl100k_base")
+except Exception:  # Not installed, or its encoding cannot be downloaded
+    _ENCODING = None
+
+# Prompt tokens spent on retrieved chunks
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+# Characters per token when tiktoken is not installed; about right for JSON and English
+CHARS_PER_TOKEN = 4
+# Records shown from a chunk none of whose records match the query
+SAMPLE_RECORDS = 3
+# Fields that identify a record, always kept when fields are projected
+ID_FIELDS = ('id', '_id', 'uuid', 'key')
+
+_TERM_RE = re.compile(r'[^\W_]+')
+# Question words that say nothing about which records or fields are relevant
+STOP_WORDS = frozenset("""
+    a an and any are all as at be by can could did do does for from get give had has have how i in is it list
+    me my of on or please show tell than that the their them there these this those to was we were what when
+    where which who whom why will with would you your about after before between during each every into many
+    much most over some such under
+""".split())
+
+
+def count_tokens(text: str) -> int:
+    """Count the tokens of a text with tiktoken, or estimate them from its length"""
+    if _ENCODING is not None:
+        return len(_ENCODING.encode(text, disallowed_special=()))
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def query_terms(query: str) -> Set[str]:
+    """Lowercased words of a query that can match field names or values"""
+    return {
+        term for term in _TERM_RE.findall(query.lower())
+        if term not in STOP_WORDS and (len(term) > 2 or term.isdigit())
+    }
+
+
+def _flatten(value: Any, prefix: str = '') -> Dict[str, Any]:
+    """Flatten nested objects to dotted paths; lists are kept as values"""
+    if not isinstance(value, dict):
+        return {prefix or 'value': value}
+    flat = {}
+    for key, item in value.items():
+        path = f'{prefix}.{key}' if prefix else str(key)
+        if isinstance(item, dict) and item:
+            flat.update(_flatten(item, path))
+        else:
+            flat[path] = item
+    return flat
+
+
+def _terms_of(value: Any) -> Set[str]:
+    """Lowercased words of a value, including the keys of nested objects"""
+    terms = set()
+    stack = [value]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, dict):
+            for key, item in value.items():
+                terms.update(_TERM_RE.findall(str(key).lower()))
+                stack.append(item)
+        elif isinstance(value, list):
+            stack.extend(value)
+        elif isinstance(value, str):
+            terms.update(_TERM_RE.findall(value.lower()))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            terms.add(str(value).lower())
+    return terms
+
+
+class _ChunkView:
+    """Records of a chunk scored against the query, with the fields worth showing"""
+    
+    def __init__(self, chunk: Dict[str, Any], terms: Set[str]):
+        content = chunk['content']
+        self.is_list = isinstance(content, list)
+        records = content if self.is_list else [content]
+        self.records = [_flatten(record) for record in records]
+        # Retrieval may have fetched only some of the chunk's items
+        self.total = (chunk.get('metadata') or {}).get('items_total') or len(records)
+        
+        # Fields named like a query term, or holding a value that matches one
+        matched_fields = []
+        record_hits = []
+        for record in self.records:
+            hits = set()
+            for path, value in record.items():
+                value_hits = _terms_of(value) & terms
+                if value_hits or set(_TERM_RE.findall(path.lower())) & terms:
+                    if path not in matched_fields:
+                        matched_fields.append(path)
+                hits |= value_hits
+            record_hits.append(hits)
+        
+        # A term held by few records of the chunk, e.g. an id, weighs more than one held by all
+        df = Counter(term for hits in record_hits for term in hits)
+        scores = [sum(1 / df[term] for term in hits) for hits in record_hits]
+        
+        # Records holding query terms, best first; a sample when none do
+        order = sorted(range(len(self.records)), key=lambda i: -scores[i])
+        matching = [i for i in order if scores[i] > 0]
+        self.ranked = matching or list(range(min(SAMPLE_RECORDS, len(self.records))))
+        
+        fields = []
+        for record in self.records:
+            for path in record:
+                if path not in fields:
+                    fields.append(path)
+        if matched_fields and len(matched_fields) < len(fields):
+            keep = set(matched_fields)
+            self.fields = [path for path in fields if path in keep or is_id_field(path, ID_FIELDS)]
+        else:
+            self.fields = fields
+    
+    def render(self, indexes: List[int]) -> str:
+        """Serialize the given records, projected to the chosen fields, in their original order"""
+        indexes = sorted(indexes)
+        if not self.is_list:
+            record = self.records[0]
+            return orjson.dumps({path: record[path] for path in self.fields if path in record}).decode()
+        if self.fields != ['value']:
+            # Columnar: field names once, then one row of values per record
+            rows = [[self.records[i].get(path) for path in self.fields] for i in indexes]
+            return orjson.dumps({'columns': self.fields, 'rows': rows}).decode()
+        return orjson.dumps([self.records[i]['value'] for i in indexes]).decode()
+
+
+def build_context(chunks: List[Dict[str, Any]], query: str,
+                  budget: int = CONTEXT_TOKEN_BUDGET) -> Tuple[str, Dict[str, Any]]:
+    """
+    Build the context of a prompt from retrieved chunks within a token budget
+    
+    Records are ranked by how many query terms they hold and only fields
+    named like a query term, holding a matching value or identifying the
+    record are kept. Records are serialized compactly with orjson, list
+    chunks as a table of columns and rows. Chunks are filled in retrieval
+    order, each with an equal share of what is left of the budget, so a
+    large first chunk does not crowd out the rest.
+    
+    Args:
+        chunks: Retrieved chunks with 'content' and 'metadata', best first
+        query: User's query
+        budget: Most tokens spent on the context
+    
+    Returns:
+        Tuple of (context text, stats with 'tokens', 'budget',
+        'records_shown' and 'records_total')
+    """
+    terms = query_terms(query)
+    parts = ["Context:"]
+    used = count_tokens(parts[0])
+    shown = total = 0
+    
+    for position, chunk in enumerate(chunks):
+        view = _ChunkView(chunk, terms)
+        total += view.total
+        share = (budget - used) // (len(chunks) - position)
+        metadata = chunk.get('metadata') or {}
+        
+        def block(indexes: List[int]) -> str:
+            header = (f"--- Chunk {position + 1} (Source: {metadata.get('source', 'unknown')}, "
+                      f"Type: {metadata.get('type', 'unknown')}, {len(indexes)} of {view.total} records) ---")
+            return f"{header}\n{view.render(indexes)}"
+        
+        # Largest prefix of the ranked records that fits the chunk's share
+        low, high = 0, len(view.ranked)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if count_tokens(block(view.ranked[:middle])) <= share:
+                low = middle
+            else:
+                high = middle - 1
+        if low == 0:
+            continue
+        text = block(view.ranked[:low])
+        parts.append(text)
+        used += count_tokens(text)
+        shown += low
+    
+    context = '\n'.join(parts)
+    return context, {
+        'tokens': count_tokens(context),
+        'budget': budget,
+        'records_shown': shown,
+        'records_total': total,
+        'tokenizer': 'tiktoken' if _ENCODING is not None else 'estimate'
+    }
@@ -1,10 +1,25 @@
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Index
-from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy import (
+    create_engine, insert, update, delete, select, text, case, cast, exists, func, or_, Column, Computed, Integer,
+    Float, String, DateTime, Index, LargeBinary, Text
+)
+from sqlalchemy.dialects.postgresql import JSONB, TSRANGE, TSVECTOR, Range
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-from datetime import datetime
+from sqlalchemy.orm import deferred, sessionmaker
+from sqlalchemy.types import UserDefinedType
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, List, Optional, Set, Tuple
+from functools import lru_cache
+import json
+import logging
 import os
 
+from .embeddings import EMBEDDING_DIM, HashingEmbedder
+from .field_stats import parse_timestamp
+from .rollups import PERIODS, merge_stats, period_bounds, period_key, summarize
+from .value_index import value_postings
+
+
+logger = logging.getLogger(__name__)
 
 # Database URL from environment or default to local PostgreSQL
 DATABASE_URL = os.getenv(
@@ -19,6 +34,13 @@ SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 # Base class for models
 Base = declarative_base()
 
+# Text search configuration of chunk search vectors and queries
+SEARCH_CONFIG = os.getenv("SEARCH_CONFIG", "english")
+# Search vector of a chunk: its string values and object keys, computed by PostgreSQL on write
+SEARCH_VECTOR_SQL = f"""jsonb_to_tsvector('{SEARCH_CONFIG}'::regconfig, content, '["string", "key"]'::jsonb)"""
+# Words kept in the search vocabulary, by length in characters
+SEARCH_TERM_LENGTH = (3, 40)
+
 class JSONChunk(Base):
     """Model for storing JSON chunks with metadata"""
     __tablename__ = "json_chunks"
@@ -30,6 +52,14 @@ class JSONChunk(Base):
     chunk_type = Column(String, index=True)  # e.g., 'day_wise', 'week_wise'
     metadata_ = Column(JSONB)  # Store extracted metadata as JSONB
     content = Column(JSONB)  # The actual JSON chunk data
+    content_hash = Column(String(64), index=True, nullable=True)  # SHA-256 of chunk type and content
+    deleted_at = Column(DateTime, nullable=True)  # Tombstone set when a re-upload no longer contains the chunk
+    date_span = Column(TSRANGE, nullable=True)  # Inclusive range of metadata['date_range'], 'empty' if unparseable
+    # Per-day partial aggregates of the chunk's records, merged into PrecomputedAggregate
+    # rollups; kept out of the GIN-indexed metadata_, which only holds a marker
+    rollups = deferred(Column(JSONB(none_as_null=True), nullable=True))
+    # Full-text search vector; deferred so loading chunks does not fetch it
+    search_vector = deferred(Column(TSVECTOR, Computed(SEARCH_VECTOR_SQL, persisted=True)))
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
@@ -39,6 +69,123 @@ class JSONChunk(Base):
         Index('idx_chunk_type', 'chunk_type'),
         # GIN index for JSONB metadata (using jsonb_path_ops for efficient JSON path queries)
         Index('idx_metadata', 'metadata_', postgresql_using='gin', postgresql_ops={'metadata_': 'jsonb_path_ops'}),
+        # GiST index for date range overlap (&&) queries
+        Index('idx_chunk_date_span', 'date_span', postgresql_using='gist'),
+        # GIN index for full-text search (@@) queries
+        Index('idx_chunk_search', 'search_vector', postgresql_using='gin'),
+    )
+
+class ChunkFieldStats(Base):
+    """Zone map entry: statistics of one field within one chunk"""
+    __tablename__ = "chunk_field_stats"
+    
+    id = Column(Integer, primary_key=True)
+    chunk_id = Column(String, index=True)  # JSONChunk.chunk_id
+    field = Column(String)  # Dotted path of the field within a record
+    value_type = Column(String)  # JSON type of the values, or 'mixed'
+    min_number = Column(Float, nullable=True)
+    max_number = Column(Float, nullable=True)
+    # Byte-wise collation matches the code point order the bounds were computed in
+    min_text = Column(String(collation='C'), nullable=True)
+    max_text = Column(String(collation='C'), nullable=True)
+    value_count = Column(Integer)
+    null_count = Column(Integer)
+    distinct_count = Column(Integer, nullable=True)
+    
+    __table_args__ = (
+        # Range lookups: all chunks whose [min, max] for a field overlaps a filter
+        Index('idx_field_stats_number', 'field', 'min_number', 'max_number'),
+        Index('idx_field_stats_text', 'field', 'min_text', 'max_text'),
+    )
+
+class ChunkFieldValue(Base):
+    """Lookup index entry: a record of a chunk holding a value of an id-like or categorical field"""
+    __tablename__ = "chunk_field_values"
+    
+    id = Column(Integer, primary_key=True)
+    chunk_id = Column(String, index=True)  # JSONChunk.chunk_id
+    field = Column(String)  # Dotted path of the field within a record
+    value = Column(String(collation='C'))  # Value as text, lowercased
+    item_offset = Column(Integer, nullable=True)  # Position of the record in the chunk, None for object chunks
+    
+    __table_args__ = (
+        # Point lookups of a value, optionally narrowed to a field
+        Index('idx_field_values_lookup', 'value', 'field'),
+    )
+
+class Vector(UserDefinedType):
+    """pgvector column type, bound in its text form so no client library is needed"""
+    cache_ok = True
+    
+    def __init__(self, dim: int):
+        self.dim = dim
+    
+    def get_col_spec(self, **kw):
+        return f"vector({self.dim})"
+    
+    def bind_expression(self, bindvalue):
+        return cast(bindvalue, self)
+    
+    def bind_processor(self, dialect):
+        def process(value):
+            if value is None:
+                return None
+            return '[' + ','.join(f'{float(x):.6g}' for x in value) + ']'
+        return process
+    
+    def result_processor(self, dialect, coltype):
+        def process(value):
+            if value is None:
+                return None
+            return [float(x) for x in value.strip('[]').split(',')]
+        return process
+
+class DataGeneration(Base):
+    """Single-row counter bumped in the transaction of every upload that changes the stored chunks"""
+    __tablename__ = "data_generation"
+    
+    id = Column(Integer, primary_key=True)
+    generation = Column(Integer, nullable=False, default=0)
+
+class SearchTerm(Base):
+    """Vocabulary entry: a word of the string values and keys of a file's live chunks"""
+    __tablename__ = "search_terms"
+    
+    term = Column(String, primary_key=True)  # Lowercased, unstemmed word
+    source_file = Column(String, primary_key=True)
+    documents = Column(Integer)  # Live chunks of the file holding the word
+
+class ChunkEmbedding(Base):
+    """Embedding of a chunk for nearest-neighbour search; needs the pgvector extension"""
+    __tablename__ = "chunk_embeddings"
+    
+    id = Column(Integer, primary_key=True)
+    chunk_id = Column(String, index=True)  # JSONChunk.chunk_id
+    embedding = Column(Vector(EMBEDDING_DIM))
+    
+    __table_args__ = (
+        # HNSW graph for approximate cosine-distance (<=>) search, updated on every insert
+        Index('idx_chunk_embedding_hnsw', 'embedding', postgresql_using='hnsw',
+              postgresql_ops={'embedding': 'vector_cosine_ops'}),
+    )
+
+class ResponseCacheEntry(Base):
+    """Cached language model answer to a prompt"""
+    __tablename__ = "llm_response_cache"
+    
+    key = Column(String(64), primary_key=True)  # SHA-256 of the model and the prompt messages
+    model = Column(String)
+    context_hash = Column(String(64))  # SHA-256 of the retrieved chunks the prompt was built from
+    query = Column(Text)
+    query_embedding = Column(LargeBinary, nullable=True)  # float32 HashingEmbedder vector of the normalized query
+    response = Column(Text)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    last_used_at = Column(DateTime, default=datetime.utcnow)
+    hits = Column(Integer, default=0)
+    
+    __table_args__ = (
+        # Semantic lookups compare the questions asked over the same chunks
+        Index('idx_response_cache_context', 'model', 'context_hash'),
     )
 
 class PrecomputedAggregate(Base):
@@ -46,12 +193,19 @@ class PrecomputedAggregate(Base):
     __tablename__ = "precomputed_aggregates"
     
     id = Column(Integer, primary_key=True, index=True)
-    name = Column(String, index=True)  # e.g., 'weekly_glucose_avg'
+    name = Column(String, index=True)  # e.g., 'glucose'
     key = Column(String, index=True)   # e.g., '2025-W18'
     value = Column(JSONB)               # The computed aggregate value
     metadata_ = Column(JSONB)           # Additional context
+    source_file = Column(String, nullable=True)  # File the rollup was computed from
+    period = Column(String, nullable=True)       # 'day', 'week' or 'month'
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    __table_args__ = (
+        # Rollups of one field over a run of periods
+        Index('idx_aggregate_lookup', 'name', 'period', 'key'),
+    )
 
 def get_db():
     """Dependency for getting database session"""
@@ -61,6 +215,738 @@ def get_db():
     finally:
         db.close()
 
+# Schema changes made after the first release; create_all() only creates
+# missing tables, so new columns on existing tables are added here
+SCHEMA_UPGRADES = [
+    "ALTER TABLE json_chunks ADD COLUMN IF NOT EXISTS content_hash VARCHAR(64)",
+    "ALTER TABLE json_chunks ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP",
+    "CREATE INDEX IF NOT EXISTS ix_json_chunks_content_hash ON json_chunks (content_hash)",
+    "ALTER TABLE json_chunks ADD COLUMN IF NOT EXISTS date_span TSRANGE",
+    "CREATE INDEX IF NOT EXISTS idx_chunk_date_span ON json_chunks USING gist (date_span)",
+    "ALTER TABLE precomputed_aggregates ADD COLUMN IF NOT EXISTS source_file VARCHAR",
+    "ALTER TABLE precomputed_aggregates ADD COLUMN IF NOT EXISTS period VARCHAR",
+    "CREATE INDEX IF NOT EXISTS idx_aggregate_lookup ON precomputed_aggregates (name, period, key)",
+    # Adding the generated column computes it for every stored chunk
+    f"ALTER TABLE json_chunks ADD COLUMN IF NOT EXISTS search_vector TSVECTOR "
+    f"GENERATED ALWAYS AS ({SEARCH_VECTOR_SQL}) STORED",
+    "CREATE INDEX IF NOT EXISTS idx_chunk_search ON json_chunks USING gin (search_vector)",
+    # Zone maps live in chunk_field_stats only; metadata_ keeps a marker
+    "UPDATE json_chunks SET metadata_ = (metadata_ - 'field_stats') || '{\"zone_map\": true}' "
+    "WHERE metadata_ ? 'field_stats'",
+    # Per-day partial aggregates live in their own column; metadata_ keeps a marker
+    "ALTER TABLE json_chunks ADD COLUMN IF NOT EXISTS rollups JSONB",
+    "UPDATE json_chunks SET rollups = metadata_ -> 'rollups', metadata_ = metadata_ || '{\"rollups\": true}' "
+    "WHERE jsonb_typeof(metadata_ -> 'rollups') = 'object'",
+]
+
 def create_tables():
-    """Create database tables"""
-    Base.metadata.create_all(bind=engine)
+    """Create database tables and apply schema upgrades"""
+    Base.metadata.create_all(bind=engine, tables=[
+        table for table in Base.metadata.sorted_tables if table is not ChunkEmbedding.__table__
+    ])
+    with engine.begin() as conn:
+        for statement in SCHEMA_UPGRADES:
+            conn.execute(text(statement))
+    try:
+        with engine.begin() as conn:
+            conn.execute(text("CREATE EXTENSION IF NOT EXISTS vector"))
+            ChunkEmbedding.__table__.create(conn, checkfirst=True)
+    except Exception as e:
+        logger.warning(f"pgvector is not available, vector search is disabled: {e}")
+    try:
+        with engine.begin() as conn:
+            conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+            conn.execute(text(
+                "CREATE INDEX IF NOT EXISTS idx_search_terms_trgm ON search_terms USING gin (term gin_trgm_ops)"
+            ))
+    except Exception as e:
+        logger.warning(f"pg_trgm is not available, fuzzy search is disabled: {e}")
+    vector_search_available.cache_clear()
+    fuzzy_search_available.cache_clear()
+    backfill_date_spans()
+    backfill_search_terms()
+    if vector_search_available():
+        backfill_embeddings()
+
+@lru_cache(maxsize=1)
+def vector_search_available() -> bool:
+    """Check once whether the chunk_embeddings table exists"""
+    with engine.connect() as conn:
+        return conn.execute(text("SELECT to_regclass('chunk_embeddings') IS NOT NULL")).scalar()
+
+@lru_cache(maxsize=1)
+def fuzzy_search_available() -> bool:
+    """Check once whether the search vocabulary has its trigram index"""
+    with engine.connect() as conn:
+        return conn.execute(text("SELECT to_regclass('idx_search_terms_trgm') IS NOT NULL")).scalar()
+
+def chunk_date_span(metadata: Dict[str, Any]) -> Optional[Range]:
+    """
+    Build the date_span of a chunk from its metadata
+    
+    Returns:
+        Inclusive range of metadata['date_range'], an empty range when its
+        bounds are not recognisable dates, or None when there is no date range
+    """
+    date_range = (metadata or {}).get('date_range')
+    if not date_range:
+        return None
+    low = parse_timestamp(date_range.get('min'))
+    high = parse_timestamp(date_range.get('max'))
+    if low is None or high is None or low > high:
+        return Range(empty=True)
+    return Range(low, high, bounds='[]')
+
+def backfill_date_spans(batch_size: int = 1000):
+    """Fill date_span for chunks stored before the column existed"""
+    db = SessionLocal()
+    try:
+        while True:
+            rows = db.query(JSONChunk.id, JSONChunk.metadata_).filter(
+                JSONChunk.date_span.is_(None),
+                JSONChunk.metadata_.has_key('date_range')
+            ).limit(batch_size).all()
+            if not rows:
+                break
+            db.execute(update(JSONChunk), [
+                {'id': row_id, 'date_span': chunk_date_span(metadata)} for row_id, metadata in rows
+            ])
+            db.commit()
+    finally:
+        db.close()
+
+def backfill_search_terms():
+    """Build the vocabulary of files stored before the search_terms table existed"""
+    db = SessionLocal()
+    try:
+        files = db.query(JSONChunk.source_file).filter(
+            JSONChunk.deleted_at.is_(None),
+            ~exists().where(SearchTerm.source_file == JSONChunk.source_file)
+        ).distinct().all()
+        for (source_file,) in files:
+            refresh_search_terms(db, source_file)
+            db.commit()
+    finally:
+        db.close()
+
+def backfill_embeddings(batch_size: int = 500):
+    """Embed live chunks stored before vector search was enabled"""
+    embedder = HashingEmbedder()
+    db = SessionLocal()
+    try:
+        while True:
+            rows = db.query(JSONChunk.chunk_id, JSONChunk.content).filter(
+                JSONChunk.deleted_at.is_(None),
+                ~exists().where(ChunkEmbedding.chunk_id == JSONChunk.chunk_id)
+            ).limit(batch_size).all()
+            if not rows:
+                break
+            bulk_insert_embeddings(db, [row.chunk_id for row in rows], embedder.embed_chunks([row.content for row in rows]))
+            db.commit()
+    finally:
+        db.close()
+
+def bulk_insert_chunks(db, rows: List[Dict[str, Any]]) -> int:
+    """
+    Insert a batch of chunk rows with a single multi-row INSERT
+    
+    The caller owns the transaction, so a whole file can be written
+    in one commit and rolled back as a unit.
+    
+    Args:
+        db: Database session
+        rows: Column values for each JSONChunk row
+        
+    Returns:
+        Number of rows written
+    """
+    if not rows:
+        return 0
+    db.execute(insert(JSONChunk), rows)
+    return len(rows)
+
+def field_stats_rows(chunk_id: str, field_stats: Dict[str, Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Turn the field_stats of a chunk's metadata into ChunkFieldStats rows
+    
+    Args:
+        chunk_id: chunk_id of the chunk
+        field_stats: Statistics computed by compute_field_stats
+        
+    Returns:
+        Column values for each ChunkFieldStats row
+    """
+    rows = []
+    for field, stats in field_stats.items():
+        low, high = stats.get('min'), stats.get('max')
+        numeric = isinstance(low, (int, float)) and not isinstance(low, bool)
+        rows.append({
+            'chunk_id': chunk_id,
+            'field': field,
+            'value_type': stats['type'],
+            'min_number': low if numeric else None,
+            'max_number': high if numeric else None,
+            'min_text': stats.get('text_min', low if isinstance(low, str) else None),
+            'max_text': stats.get('text_max', high if isinstance(high, str) else None),
+            'value_count': stats['count'],
+            'null_count': stats['null_count'],
+            'distinct_count': stats.get('distinct')
+        })
+    return rows
+
+def bulk_insert_field_stats(db, rows: List[Dict[str, Any]]) -> int:
+    """Insert a batch of ChunkFieldStats rows with a single multi-row INSERT"""
+    if not rows:
+        return 0
+    db.execute(insert(ChunkFieldStats), rows)
+    return len(rows)
+
+def field_value_rows(chunk_id: str, chunk: Any, fields: List[str]) -> List[Dict[str, Any]]:
+    """
+    Build the ChunkFieldValue rows of a chunk
+    
+    Args:
+        chunk_id: chunk_id of the chunk
+        chunk: Content of the chunk
+        fields: Fields to index, from metadata['lookup_fields']
+        
+    Returns:
+        Column values for each ChunkFieldValue row
+    """
+    return [
+        {'chunk_id': chunk_id, 'field': field, 'value': value, 'item_offset': offset}
+        for field, value, offset in value_postings(chunk, fields)
+    ]
+
+def bulk_insert_field_values(db, rows: List[Dict[str, Any]]) -> int:
+    """Insert a batch of ChunkFieldValue rows with a single multi-row INSERT"""
+    if not rows:
+        return 0
+    db.execute(insert(ChunkFieldValue), rows)
+    return len(rows)
+
+def lookup_field_values(db, values: List[str], limit: int = 20) -> List[Dict[str, Any]]:
+    """
+    Fetch the live records holding any of the given values
+    
+    One probe of idx_field_values_lookup per value; only the matching
+    records are read out of their chunks.
+    
+    Args:
+        db: Database session
+        values: Values normalized with normalize_lookup_value
+        limit: Maximum number of records returned
+        
+    Returns:
+        List of {'field', 'value', 'chunk_id', 'item_offset', 'source_file', 'item'}
+    """
+    if not values:
+        return []
+    item = case(
+        (ChunkFieldValue.item_offset.is_(None), JSONChunk.content),
+        else_=JSONChunk.content.op('->')(ChunkFieldValue.item_offset)
+    )
+    rows = db.query(
+        ChunkFieldValue.field, ChunkFieldValue.value, ChunkFieldValue.chunk_id,
+        ChunkFieldValue.item_offset, JSONChunk.source_file, item.label('item')
+    ).join(JSONChunk, JSONChunk.chunk_id == ChunkFieldValue.chunk_id).filter(
+        ChunkFieldValue.value.in_(values),
+        JSONChunk.deleted_at.is_(None)
+    ).limit(limit).all()
+    return [row._asdict() for row in rows]
+
+def bulk_insert_embeddings(db, chunk_ids: List[str], vectors) -> int:
+    """Insert the embeddings of a batch of chunks with a single multi-row INSERT"""
+    if not chunk_ids:
+        return 0
+    db.execute(insert(ChunkEmbedding), [
+        {'chunk_id': chunk_id, 'embedding': vector} for chunk_id, vector in zip(chunk_ids, vectors)
+    ])
+    return len(chunk_ids)
+
+def delete_chunk_embeddings(db, ids: List[int], batch_size: int = 1000) -> int:
+    """
+    Remove the embeddings of tombstoned chunks
+    
+    Keeps dead chunks from taking up the candidates of nearest-neighbour
+    searches.
+    
+    Args:
+        db: Database session
+        ids: JSONChunk ids whose embeddings are removed
+        batch_size: Number of ids per DELETE statement
+    """
+    deleted = 0
+    for i in range(0, len(ids), batch_size):
+        chunk_ids = select(JSONChunk.chunk_id).where(JSONChunk.id.in_(ids[i:i + batch_size]))
+        deleted += db.execute(delete(ChunkEmbedding).where(ChunkEmbedding.chunk_id.in_(chunk_ids))).rowcount
+    return deleted
+
+def nearest_chunk_ids(db, vector, limit: int = 20) -> List[int]:
+    """
+    Find the live chunks whose embeddings are closest to a vector
+    
+    Args:
+        db: Database session
+        vector: Query embedding
+        limit: Number of neighbours taken from the HNSW index
+        
+    Returns:
+        JSONChunk ids, nearest first
+    """
+    distance = ChunkEmbedding.embedding.op('<=>', return_type=Float)(cast(vector, Vector(EMBEDDING_DIM)))
+    nearest = db.query(ChunkEmbedding.chunk_id, distance.label('distance')) \
+        .order_by(distance).limit(limit).subquery()
+    rows = db.query(JSONChunk.id).join(nearest, nearest.c.chunk_id == JSONChunk.chunk_id).filter(
+        JSONChunk.deleted_at.is_(None)
+    ).order_by(nearest.c.distance)
+    return [row.id for row in rows]
+
+def refresh_search_terms(db, source_file: str) -> int:
+    """
+    Rebuild the vocabulary of a file from its live chunks
+    
+    Words are taken with the 'simple' configuration, so they are lowercased
+    but neither stemmed nor stop-listed, and counted with ts_stat; numbers
+    and words outside SEARCH_TERM_LENGTH are left out.
+    
+    Returns:
+        Number of words in the file's vocabulary
+    """
+    db.execute(delete(SearchTerm).where(SearchTerm.source_file == source_file))
+    result = db.execute(text("""
+        INSERT INTO search_terms (term, source_file, documents)
+        SELECT word, :source_file, ndoc
+        FROM ts_stat(format(
+            'SELECT jsonb_to_tsvector(''simple'', content, ''["string", "key"]'') FROM json_chunks '
+            'WHERE source_file = %L AND deleted_at IS NULL',
+            CAST(:source_file AS text)
+        ))
+        WHERE length(word) BETWEEN :min_length AND :max_length
+          AND word !~ '^[0-9.+-]+$'
+    """), {'source_file': source_file, 'min_length': SEARCH_TERM_LENGTH[0], 'max_length': SEARCH_TERM_LENGTH[1]})
+    return result.rowcount
+
+def similar_search_terms(db, words: List[str], threshold: float, per_word: int = 2) -> List[Tuple[str, str, float]]:
+    """
+    Find vocabulary words spelled like query words that are not in the vocabulary
+    
+    Candidates are found through the GIN trigram index with the % operator
+    and ranked by similarity, then by how many chunks hold them. Words that
+    are stop words of SEARCH_CONFIG are not corrected.
+    
+    Args:
+        db: Database session
+        words: Lowercased query words
+        threshold: Lowest trigram similarity of a match, 0 to 1
+        per_word: Most matches kept per query word
+    
+    Returns:
+        List of (query word, vocabulary word, similarity)
+    """
+    # Transaction-local threshold of the % operator
+    db.execute(text("SELECT set_config('pg_trgm.similarity_threshold', :threshold, true)"),
+               {'threshold': str(threshold)})
+    rows = db.execute(text("""
+        SELECT q.word, m.term, m.score
+        FROM unnest(CAST(:words AS text[])) AS q(word)
+        CROSS JOIN LATERAL (
+            SELECT t.term, similarity(t.term, q.word) AS score
+            FROM search_terms t
+            WHERE t.term % q.word
+            GROUP BY t.term
+            ORDER BY score DESC, sum(t.documents) DESC
+            LIMIT :per_word
+        ) AS m
+        WHERE numnode(plainto_tsquery(CAST(:config AS regconfig), q.word)) > 0
+          AND NOT EXISTS (SELECT 1 FROM search_terms s WHERE s.term = q.word)
+        ORDER BY m.score DESC
+    """), {'words': words, 'per_word': per_word, 'config': SEARCH_CONFIG})
+    return [(row.word, row.term, float(row.score)) for row in rows]
+
+def filter_by_field_range(query, field: str, low: Any = None, high: Any = None):
+    """
+    Restrict a JSONChunk query to chunks that may hold field values in [low, high]
+    
+    Chunks are skipped using their zone maps: a chunk is kept when the
+    field's [min, max] in that chunk overlaps the filter. Numeric bounds are
+    compared with numeric statistics and string bounds (e.g. ISO dates)
+    with string statistics. Chunks stored without statistics are kept.
+    
+    Args:
+        query: Query over JSONChunk
+        field: Dotted path of the field within a record
+        low: Inclusive lower bound, or None
+        high: Inclusive upper bound, or None
+        
+    Returns:
+        The filtered query
+    """
+    bound = low if low is not None else high
+    if isinstance(bound, (int, float)):
+        min_column, max_column = ChunkFieldStats.min_number, ChunkFieldStats.max_number
+    else:
+        min_column, max_column = ChunkFieldStats.min_text, ChunkFieldStats.max_text
+    
+    conditions = [ChunkFieldStats.chunk_id == JSONChunk.chunk_id, ChunkFieldStats.field == field]
+    if low is not None:
+        conditions.append(max_column >= low)
+    if high is not None:
+        conditions.append(min_column <= high)
+    return query.filter(or_(
+        exists().where(*conditions),
+        ~JSONChunk.metadata_.has_key('zone_map')
+    ))
+
+def get_stats_fields(db) -> List[str]:
+    """
+    List the distinct fields recorded in the zone maps
+    
+    Walks idx_field_stats_number one field at a time (a loose index scan),
+    so the cost follows the number of fields rather than of chunks.
+    """
+    rows = db.execute(text("""
+        WITH RECURSIVE fields AS (
+            SELECT min(field) AS field FROM chunk_field_stats
+            UNION ALL
+            SELECT (SELECT min(field) FROM chunk_field_stats WHERE field > fields.field)
+            FROM fields WHERE fields.field IS NOT NULL
+        )
+        SELECT field FROM fields WHERE field IS NOT NULL
+    """))
+    return [row.field for row in rows]
+
+def count_field_values(db, field: str) -> int:
+    """Count the non-null values of a field across live chunks, from the zone maps"""
+    return db.query(func.coalesce(func.sum(ChunkFieldStats.value_count), 0)).join(
+        JSONChunk, JSONChunk.chunk_id == ChunkFieldStats.chunk_id
+    ).filter(
+        ChunkFieldStats.field == field,
+        JSONChunk.deleted_at.is_(None)
+    ).scalar()
+
+def get_date_field(db) -> Optional[str]:
+    """Return the field dating the records of the most recently stored dated chunk"""
+    row = db.query(JSONChunk.metadata_['date_range']['field'].astext).filter(
+        JSONChunk.deleted_at.is_(None),
+        JSONChunk.metadata_.has_key('date_range')
+    ).order_by(JSONChunk.id.desc()).first()
+    return row[0] if row else None
+
+def get_live_chunk_hashes(db, source_file: str) -> Dict[Optional[str], List[Tuple[int, str, Optional[str]]]]:
+    """
+    Map content hashes of a file's live chunks to their rows
+    
+    Args:
+        db: Database session
+        source_file: Name of the uploaded file
+        
+    Returns:
+        Dictionary of content_hash -> list of (id, chunk_id, parent_id) rows
+        (a hash can occur more than once when a file repeats a chunk)
+    """
+    rows = db.query(JSONChunk.id, JSONChunk.chunk_id, JSONChunk.parent_id, JSONChunk.content_hash).filter(
+        JSONChunk.source_file == source_file,
+        JSONChunk.deleted_at.is_(None)
+    )
+    hashes: Dict[Optional[str], List[Tuple[int, str, Optional[str]]]] = {}
+    for row_id, chunk_id, parent_id, content_hash in rows:
+        hashes.setdefault(content_hash, []).append((row_id, chunk_id, parent_id))
+    return hashes
+
+def rename_parent_ids(db, source_file: str, renames: Dict[str, str]) -> int:
+    """
+    Point the children of one chunk id at another
+    
+    Args:
+        db: Database session
+        source_file: Name of the uploaded file
+        renames: Dictionary of old parent chunk_id -> new parent chunk_id
+        
+    Returns:
+        Number of parent ids renamed
+    """
+    for old_id, new_id in renames.items():
+        db.execute(
+            update(JSONChunk)
+            .where(JSONChunk.source_file == source_file, JSONChunk.parent_id == old_id)
+            .values(parent_id=new_id)
+        )
+    return len(renames)
+
+def set_parent_ids(db, parents: Dict[int, Optional[str]]) -> int:
+    """
+    Set the parent chunk of existing rows
+    
+    Args:
+        db: Database session
+        parents: Dictionary of JSONChunk id -> parent chunk_id
+        
+    Returns:
+        Number of rows updated
+    """
+    if parents:
+        db.execute(
+            update(JSONChunk),
+            [{'id': row_id, 'parent_id': parent_id} for row_id, parent_id in parents.items()]
+        )
+    return len(parents)
+
+def term_item_paths(terms: List[str]) -> List[str]:
+    """
+    Build one jsonpath per query term matching the items that hold it
+    
+    A term matches a string value holding it as a whole word, case
+    insensitively, and a digit term also matches an equal number. Terms are
+    expected to be word characters only, as produced by query_terms.
+    """
+    paths = []
+    for term in terms:
+        condition = f'@ like_regex "(^|[^[:alnum:]]){term}([^[:alnum:]]|$)" flag "i"'
+        if term.isdigit():
+            condition += f' || @ == {int(term)}'
+        paths.append(f'lax $.** ? ({condition})')
+    return paths
+
+def period_item_path(date_field: str) -> str:
+    """Build a jsonpath matching the items whose date_field lies in [$start, $end), compared as ISO text"""
+    key = ''.join('.' + json.dumps(part) for part in date_field.split('.'))
+    return f'lax $ ? (@{key} >= $start && @{key} < $end)'
+
+def project_items(db, ids: List[int], paths: List[str], variables: Optional[Dict[str, Any]] = None,
+                  sample: Optional[int] = 10) -> Dict[int, Dict[str, Any]]:
+    """
+    Fetch only the items of array chunks that match jsonpath filters
+    
+    The projection runs inside PostgreSQL, so unmatched items are neither
+    sent nor decoded. Each item is scored by how many of the paths match it
+    (jsonb_path_exists) and the items with the chunk's best non-zero score
+    are returned. When no item matches, the first sample items are returned
+    instead (jsonb_path_query_array), or all of them when sample is None.
+    Object and scalar chunks are returned whole.
+    
+    Args:
+        db: Database session
+        ids: JSONChunk ids
+        paths: jsonpath filters applied to each item, e.g. from term_item_paths
+        variables: Values of the $variables used by the paths
+        sample: Items returned from a chunk none of whose items match
+    
+    Returns:
+        Dictionary of JSONChunk id -> {'content', 'offsets' (item positions,
+        None when not projected), 'total' (items in the chunk, None when
+        it is not an array)}
+    """
+    rows = db.execute(text("""
+        SELECT c.id,
+               CASE WHEN jsonb_typeof(c.content) = 'array' THEN jsonb_array_length(c.content) END AS total,
+               m.offsets, m.items,
+               CASE WHEN jsonb_typeof(c.content) <> 'array' THEN c.content
+                    WHEN m.offsets IS NULL THEN jsonb_path_query_array(c.content, CAST(:sample_path AS jsonpath))
+               END AS fallback
+        FROM json_chunks c
+        LEFT JOIN LATERAL (
+            SELECT array_agg(s.ord - 1 ORDER BY s.ord) AS offsets, jsonb_agg(s.item ORDER BY s.ord) AS items
+            FROM (
+                SELECT i.item, i.ord, i.score, max(i.score) OVER () AS best
+                FROM (
+                    SELECT e.item, e.ord,
+                           (SELECT count(*) FROM unnest(CAST(:paths AS jsonpath[])) AS p(path)
+                            WHERE jsonb_path_exists(e.item, p.path, CAST(:variables AS jsonb))) AS score
+                    FROM jsonb_array_elements(
+                        CASE WHEN jsonb_typeof(c.content) = 'array' THEN c.content ELSE '[]'::jsonb END
+                    ) WITH ORDINALITY AS e(item, ord)
+                ) AS i
+            ) AS s
+            WHERE s.score > 0 AND s.score = s.best
+        ) AS m ON TRUE
+        WHERE c.id = ANY(:ids)
+    """), {
+        'ids': ids,
+        'paths': paths,
+        'variables': json.dumps(variables or {}, default=str),
+        'sample_path': f'lax $[0 to {sample - 1}]' if sample else 'lax $'
+    })
+    projected = {}
+    for row in rows:
+        if row.offsets is not None:
+            projected[row.id] = {'content': row.items, 'offsets': row.offsets, 'total': row.total}
+        else:
+            projected[row.id] = {'content': row.fallback, 'offsets': None, 'total': row.total}
+    return projected
+
+def get_chunk_ancestors(db, chunk_ids: List[str], depth: int = 1) -> List[JSONChunk]:
+    """
+    Fetch the live parent chunks of the given chunks
+    
+    Args:
+        db: Database session
+        chunk_ids: chunk_id of each starting chunk
+        depth: Number of levels to walk up the hierarchy
+        
+    Returns:
+        Ancestor chunks, nearest level first, without duplicates
+    """
+    ancestors = []
+    seen = set(chunk_ids)
+    parent_ids = [row.parent_id for row in db.query(JSONChunk.parent_id).filter(JSONChunk.chunk_id.in_(chunk_ids))]
+    for _ in range(depth):
+        parent_ids = [parent_id for parent_id in set(parent_ids) if parent_id and parent_id not in seen]
+        if not parent_ids:
+            break
+        parents = db.query(JSONChunk).filter(
+            JSONChunk.chunk_id.in_(parent_ids),
+            JSONChunk.deleted_at.is_(None)
+        ).all()
+        seen.update(parent_ids)
+        ancestors.extend(parents)
+        parent_ids = [parent.parent_id for parent in parents]
+    return ancestors
+
+def bump_data_generation(db) -> int:
+    """
+    Advance the data generation within the caller's transaction
+    
+    Readers see the new generation together with the data committed with
+    it, so results cached under an older generation are never reused.
+    
+    Returns:
+        The new generation
+    """
+    return db.execute(text("""
+        INSERT INTO data_generation (id, generation) VALUES (1, 1)
+        ON CONFLICT (id) DO UPDATE SET generation = data_generation.generation + 1
+        RETURNING generation
+    """)).scalar()
+
+def get_data_generation(db) -> int:
+    """Return the current data generation, 0 before the first upload"""
+    return db.execute(text("SELECT generation FROM data_generation WHERE id = 1")).scalar() or 0
+
+def tombstone_chunks(db, ids: List[int], batch_size: int = 1000) -> int:
+    """
+    Mark chunks as deleted without removing their rows
+    
+    Args:
+        db: Database session
+        ids: JSONChunk ids to tombstone
+        batch_size: Number of ids per UPDATE statement
+        
+    Returns:
+        Number of chunks tombstoned
+    """
+    now = datetime.utcnow()
+    for i in range(0, len(ids), batch_size):
+        db.execute(
+            update(JSONChunk)
+            .where(JSONChunk.id.in_(ids[i:i + batch_size]))
+            .values(deleted_at=now)
+        )
+    return len(ids)
+
+def get_rollup_days(db, ids: List[int], batch_size: int = 1000) -> Set[str]:
+    """
+    Collect the days covered by the rollups of the given chunks
+    
+    Args:
+        db: Database session
+        ids: JSONChunk ids
+        batch_size: Number of ids per SELECT statement
+        
+    Returns:
+        ISO days with per-day partial aggregates in those chunks
+    """
+    days = set()
+    for i in range(0, len(ids), batch_size):
+        rows = db.query(JSONChunk.rollups['days']).filter(
+            JSONChunk.id.in_(ids[i:i + batch_size]),
+            JSONChunk.rollups.isnot(None)
+        )
+        for (chunk_days,) in rows:
+            days.update(chunk_days or {})
+    return days
+
+def refresh_rollups(db, source_file: str, days: Set[str]) -> int:
+    """
+    Recompute the day, week and month rollups of a file touching the given days
+    
+    Day rollups are merged from the per-day partial aggregates that live
+    chunks carry in their rollups column; only chunks whose date_span
+    overlaps the days are read. Week and month rollups are then merged
+    from the day rollups, so deleted chunks drop out of min/max as well.
+    
+    Args:
+        db: Database session
+        source_file: Name of the uploaded file
+        days: ISO days whose records were inserted or tombstoned
+        
+    Returns:
+        Number of rollup rows written
+    """
+    if not days:
+        return 0
+    db.flush()
+    first, last = min(days), max(days)
+    
+    # Day rollups, from the partial aggregates of the chunks covering the days
+    totals: Dict[Tuple[str, str, str], List[float]] = {}
+    chunks = db.query(JSONChunk.rollups).filter(
+        JSONChunk.source_file == source_file,
+        JSONChunk.deleted_at.is_(None),
+        JSONChunk.rollups.isnot(None),
+        JSONChunk.date_span.overlaps(Range(
+            datetime.fromisoformat(first), datetime.fromisoformat(last) + timedelta(days=1), bounds='[)'
+        ))
+    )
+    for (rollup,) in chunks:
+        for day, fields in rollup['days'].items():
+            if day not in days:
+                continue
+            for field, stats in fields.items():
+                key = ('day', day, field)
+                totals[key] = merge_stats(totals.get(key), stats)
+    _replace_rollups(db, source_file, 'day', days, totals)
+    
+    # Week and month rollups, from the day rollups they contain
+    written = len(totals)
+    for period in PERIODS[1:]:
+        keys = {period_key(date.fromisoformat(day), period) for day in days}
+        start = min(period_bounds(key, period)[0] for key in keys)
+        end = max(period_bounds(key, period)[1] for key in keys)
+        totals = {}
+        rows = db.query(PrecomputedAggregate).filter(
+            PrecomputedAggregate.source_file == source_file,
+            PrecomputedAggregate.period == 'day',
+            PrecomputedAggregate.key.between(start.isoformat(), end.isoformat())
+        )
+        for row in rows:
+            key = (period, period_key(date.fromisoformat(row.key), period), row.name)
+            if key[1] in keys:
+                value = row.value
+                totals[key] = merge_stats(totals.get(key), [value['count'], value['sum'], value['min'], value['max']])
+        _replace_rollups(db, source_file, period, keys, totals)
+        written += len(totals)
+    return written
+
+def _replace_rollups(db, source_file: str, period: str, keys: Set[str],
+                     totals: Dict[Tuple[str, str, str], List[float]]):
+    """Swap the stored rollups of a file for the given period keys"""
+    db.query(PrecomputedAggregate).filter(
+        PrecomputedAggregate.source_file == source_file,
+        PrecomputedAggregate.period == period,
+        PrecomputedAggregate.key.in_(keys)
+    ).delete(synchronize_session=False)
+    rows = [
+        {
+            'name': field,
+            'key': key,
+            'period': period,
+            'source_file': source_file,
+            'value': summarize(stats),
+            'metadata_': {'period': period, 'field': field}
+        }
+        for (_, key, field), stats in totals.items()
+    ]
+    if rows:
+        db.execute(insert(PrecomputedAggregate), rows)
+    db.flush()
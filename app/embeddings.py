@@ -0,0 +1,96 @@
+import os
+import re
+import zlib
+from collections import Counter
+from functools import lru_cache
+from typing import Any, List
+
+import numpy as np
+
+# Dimensions of chunk and query embeddings
+EMBEDDING_DIM = int(os.getenv("EMBEDDING_DIM", "256"))
+# Characters of a chunk's text that are embedded
+EMBEDDING_TEXT_LIMIT = 20000
+
+_WORD_RE = re.compile(r'[^\W_]+')
+
+
+def chunk_text(value: Any) -> str:
+    """Join the object keys and string values of a chunk into one text"""
+    parts = []
+    stack = [value]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, dict):
+            parts.extend(str(key).replace('_', ' ') for key in value)
+            stack.extend(value.values())
+        elif isinstance(value, list):
+            stack.extend(value)
+        elif isinstance(value, str):
+            parts.append(value)
+    return ' '.join(reversed(parts))[:EMBEDDING_TEXT_LIMIT]
+
+
+@lru_cache(maxsize=200_000)
+def _hash_features(word: str, dim: int) -> np.ndarray:
+    """
+    Signed hash buckets of a word and of its character trigrams
+    
+    Trigrams of '<word>' let inflections and misspellings share most of
+    their features. Each feature is encoded as bucket + 1, negated for a
+    negative sign.
+    """
+    padded = f'<{word}>'
+    features = [word] + [padded[i:i + 3] for i in range(len(padded) - 2)]
+    hashes = np.array([zlib.crc32(feature.encode('utf-8')) for feature in features], dtype=np.int64)
+    buckets = hashes % dim + 1
+    return np.where(hashes & (1 << 31), -buckets, buckets)
+
+
+class HashingEmbedder:
+    """
+    Embeds texts locally with a signed hashing vectorizer
+    
+    No model and no network: words and their character trigrams are hashed
+    into a fixed number of dimensions, counts are log-scaled and vectors are
+    L2-normalized, so cosine distance reflects shared vocabulary.
+    """
+    
+    def __init__(self, dim: int = EMBEDDING_DIM):
+        self.dim = dim
+    
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """
+        Embed a batch of texts
+        
+        Returns:
+            Array of shape (len(texts), dim), one unit vector per text (zero
+            for texts without words)
+        """
+        rows, counts, features = [], [], []
+        for row, text in enumerate(texts):
+            for word, count in Counter(_WORD_RE.findall(text.lower())).items():
+                rows.append(row)
+                counts.append(count)
+                features.append(_hash_features(word, self.dim))
+        
+        size = len(texts) * self.dim
+        if features:
+            lengths = [len(encoded) for encoded in features]
+            encoded = np.concatenate(features)
+            # One flat index and signed weight per feature occurrence, summed with bincount
+            index = np.repeat(np.array(rows, dtype=np.int64) * self.dim, lengths) + np.abs(encoded) - 1
+            weights = np.repeat(np.array(counts, dtype=np.float32), lengths) * np.sign(encoded)
+            vectors = np.bincount(index, weights=weights, minlength=size)
+        else:
+            vectors = np.zeros(size)
+        vectors = vectors.reshape(len(texts), self.dim).astype(np.float32)
+        
+        # Sublinear term frequency, keeping the hashed sign
+        vectors = np.sign(vectors) * np.log1p(np.abs(vectors))
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+    
+    def embed_chunks(self, chunks: List[Any]) -> np.ndarray:
+        """Embed the text of a batch of chunks"""
+        return self.embed([chunk_text(chunk) for chunk in chunks])
@@ -0,0 +1,127 @@
+from datetime import datetime, timezone
+from typing import Dict, Any, List, Optional
+
+# Longest string kept as a min/max bound; longer values are cut to a prefix
+STATS_TEXT_LIMIT = 64
+# Sorts after every string sharing the prefix it is appended to
+_TEXT_MAX_SUFFIX = '\uffff'
+
+_JSON_TYPES = {
+    bool: 'boolean',
+    int: 'number',
+    float: 'number',
+    str: 'string',
+    dict: 'object',
+    list: 'array'
+}
+_NUMBER_TYPES = {int, float}
+_STRING_TYPES = {str}
+
+
+def _gather_columns(records: List[Dict[str, Any]], prefix: str, columns: Dict[str, List[Any]]):
+    """Split records into one list of values per field, descending into nested objects"""
+    keys: Dict[str, Any] = {}
+    for record in records:
+        keys.update(record)
+    for key in keys:
+        field = f'{prefix}{key}'
+        values = [record.get(key) for record in records]
+        nested = [value for value in values if type(value) is dict and value]
+        if nested:
+            _gather_columns(nested, field + '.', columns)
+            values = [value for value in values if type(value) is not dict or not value]
+        columns[field] = values
+
+
+def compute_field_stats(items: List[Any]) -> Dict[str, Dict[str, Any]]:
+    """
+    Compute a zone map for a chunk of records
+    
+    Values are gathered column by column, then each column is summarised
+    with the builtin min/max/set, so records are only walked in C loops.
+    Fields of nested objects are named by their dotted path.
+    
+    Args:
+        items: Records of the chunk; items that are not objects are ignored
+    
+    Returns:
+        Dictionary of field -> {'type', 'count', 'null_count', 'distinct',
+        and 'min'/'max' for numbers or, failing those, strings}. Strings of
+        a field that also holds numbers are bounded by 'text_min'/'text_max'.
+        null_count includes records that lack the field. 'type' is 'mixed'
+        when values of several JSON types occur.
+    """
+    records = [item for item in items if type(item) is dict]
+    columns: Dict[str, List[Any]] = {}
+    _gather_columns(records, '', columns)
+    
+    stats = {}
+    for field, values in columns.items():
+        value_types = set(map(type, values))
+        if type(None) in value_types:
+            value_types.discard(type(None))
+            values = [value for value in values if value is not None]
+        if not values:
+            stats[field] = {'type': 'null', 'count': 0, 'null_count': len(records)}
+            continue
+        types = {_JSON_TYPES.get(value_type, 'string') for value_type in value_types}
+        field_stats = {
+            'type': types.pop() if len(types) == 1 else 'mixed',
+            'count': len(values),
+            'null_count': len(records) - len(values)
+        }
+        
+        if value_types <= _NUMBER_TYPES:
+            numbers, strings = values, None
+        elif value_types == _STRING_TYPES:
+            numbers, strings = None, values
+        else:
+            numbers = [value for value in values if type(value) in _NUMBER_TYPES]
+            strings = [value for value in values if type(value) is str]
+        
+        scalars = values if dict not in value_types and list not in value_types else \
+            [value for value in values if type(value) not in (dict, list)]
+        if scalars:
+            field_stats['distinct'] = len(set(scalars))
+        if numbers:
+            field_stats['min'] = min(numbers)
+            field_stats['max'] = max(numbers)
+        if strings:
+            highest = max(strings)
+            if len(highest) > STATS_TEXT_LIMIT:
+                # A cut-off prefix would sort below the real maximum
+                highest = highest[:STATS_TEXT_LIMIT] + _TEXT_MAX_SUFFIX
+            # Fields mixing numbers and strings keep separate string bounds
+            prefix = 'text_' if numbers else ''
+            field_stats[prefix + 'min'] = min(strings)[:STATS_TEXT_LIMIT]
+            field_stats[prefix + 'max'] = highest
+        stats[field] = field_stats
+    return stats
+
+
+def parse_timestamp(value: Any) -> Optional[datetime]:
+    """
+    Interpret a JSON value as a point in time
+    
+    Accepts ISO 8601 strings (dates or date-times, with or without an offset)
+    and Unix epoch numbers in seconds or milliseconds. Aware values are
+    converted to naive UTC.
+    
+    Returns:
+        The timestamp, or None when the value is not recognised
+    """
+    if isinstance(value, bool):
+        return None
+    try:
+        if isinstance(value, (int, float)):
+            # Epochs past the year 5138 in seconds are taken as milliseconds
+            seconds = value / 1000 if abs(value) > 1e11 else value
+            return datetime.utcfromtimestamp(seconds)
+        if isinstance(value, str):
+            parsed = datetime.fromisoformat(value.strip())
+            if parsed.tzinfo is not None:
+                parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+            return parsed
+    except (ValueError, OverflowError, OSError):
+        pass
+    return None
@@ -0,0 +1,343 @@
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, Any, Optional, Tuple
+
+from .database import (
+    SessionLocal, bulk_insert_chunks, bulk_insert_embeddings, bulk_insert_field_stats, bulk_insert_field_values,
+    bump_data_generation, chunk_date_span, delete_chunk_embeddings, field_stats_rows, field_value_rows,
+    get_live_chunk_hashes, get_rollup_days, refresh_rollups, refresh_search_terms, rename_parent_ids, set_parent_ids,
+    tombstone_chunks, vector_search_available
+)
+from .bm25_index import BM25Index
+from .embeddings import HashingEmbedder
+from .json_processor import JSONProcessor
+
+logger = logging.getLogger(__name__)
+
+
+class IngestCancelled(Exception):
+    """Raised inside a worker when its job has been cancelled"""
+
+
+class IngestJob:
+    """Progress and outcome of a single background ingestion"""
+    
+    def __init__(self, file_path: str, filename: str):
+        """
+        Initialize the job
+        
+        Args:
+            file_path: Path to the spooled upload
+            filename: Original name of the uploaded file
+        """
+        self.job_id = uuid.uuid4().hex
+        self.file_path = file_path
+        self.filename = filename
+        self.status = 'queued'
+        self.bytes_total = os.path.getsize(file_path)
+        self.stats: Dict[str, Any] = {}
+        self.chunks_processed = 0
+        self.rows_inserted = 0
+        self.chunks_skipped = 0
+        self.chunks_deleted = 0
+        self.rollups_written = 0
+        self.search_terms = 0
+        self.error: Optional[str] = None
+        self.created_at = datetime.utcnow()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.cancel_event = threading.Event()
+        self.future = None
+    
+    @property
+    def is_finished(self) -> bool:
+        return self.status in ('completed', 'failed', 'cancelled')
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """Return a JSON-serialisable snapshot of the job"""
+        bytes_parsed = self.stats.get('bytes_read', 0)
+        if self.status == 'completed':
+            bytes_parsed = self.bytes_total
+        
+        elapsed = None
+        bytes_per_sec = None
+        eta_seconds = None
+        if self.started is not None:
+            elapsed = (self.finished or time.perf_counter()) - self.started
+            if elapsed > 0 and bytes_parsed:
+                bytes_per_sec = bytes_parsed / elapsed
+                if not self.is_finished:
+                    eta_seconds = max(self.bytes_total - bytes_parsed, 0) / bytes_per_sec
+        
+        return {
+            'job_id': self.job_id,
+            'filename': self.filename,
+            'status': self.status,
+            'created_at': self.created_at.isoformat(),
+            'progress': {
+                'bytes_total': self.bytes_total,
+                'bytes_parsed': bytes_parsed,
+                'percent': round(100.0 * bytes_parsed / self.bytes_total, 1) if self.bytes_total else 100.0,
+                'chunks_processed': self.chunks_processed,
+                'chunks_written': self.rows_inserted,
+                'chunks_skipped': self.chunks_skipped,
+                'chunks_deleted': self.chunks_deleted,
+                'elapsed_seconds': round(elapsed, 3) if elapsed is not None else None,
+                'bytes_per_sec': round(bytes_per_sec, 2) if bytes_per_sec else None,
+                'eta_seconds': round(eta_seconds, 1) if eta_seconds is not None else None
+            },
+            'ingest_stats': self.stats if self.is_finished else None,
+            'error': self.error
+        }
+
+
+class IngestionManager:
+    """Runs file ingestion on a worker pool and tracks job progress"""
+    
+    def __init__(self, processor: JSONProcessor, max_workers: int = 2,
+                 insert_batch_size: int = 500, max_finished_jobs: int = 1000,
+                 parse_workers: int = 1, embedder: Optional[HashingEmbedder] = None,
+                 search_index: Optional[BM25Index] = None):
+        """
+        Initialize the ingestion manager
+        
+        Args:
+            processor: JSON processor used to chunk uploaded files
+            max_workers: Number of files ingested concurrently
+            insert_batch_size: Number of chunk rows written per multi-row INSERT
+            max_finished_jobs: Finished jobs kept around for status queries
+            parse_workers: Worker processes used to decode each file; above
+                one, large root arrays are parsed in parallel
+            embedder: Embeds each batch of new chunks for vector search;
+                None to skip embeddings
+            search_index: In-process BM25 index refreshed with each
+                ingested file, or None
+        """
+        self.processor = processor
+        self.insert_batch_size = insert_batch_size
+        self.max_finished_jobs = max_finished_jobs
+        self.parse_workers = parse_workers
+        self.embedder = embedder
+        self.search_index = search_index
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='ingest')
+        self._jobs: 'OrderedDict[str, IngestJob]' = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def submit(self, file_path: str, filename: str) -> IngestJob:
+        """
+        Queue a spooled upload for ingestion
+        
+        The worker takes ownership of file_path and removes it when done.
+        """
+        job = IngestJob(file_path, filename)
+        with self._lock:
+            self._jobs[job.job_id] = job
+            self._evict_finished()
+        job.future = self._executor.submit(self._run, job)
+        return job
+    
+    def get(self, job_id: str) -> Optional[IngestJob]:
+        with self._lock:
+            return self._jobs.get(job_id)
+    
+    def cancel(self, job_id: str) -> Optional[IngestJob]:
+        """
+        Cancel a queued or running job
+        
+        A running job stops at the next chunk and rolls back its transaction.
+        """
+        job = self.get(job_id)
+        if job is None or job.is_finished:
+            return job
+        job.cancel_event.set()
+        if job.future is not None and job.future.cancel():
+            # Never started, so the worker will not clean up after it
+            job.status = 'cancelled'
+            self._remove_file(job)
+        return job
+    
+    def _evict_finished(self):
+        """Drop the oldest finished jobs beyond max_finished_jobs"""
+        finished = [job_id for job_id, job in self._jobs.items() if job.is_finished]
+        for job_id in finished[:max(len(finished) - self.max_finished_jobs, 0)]:
+            del self._jobs[job_id]
+    
+    def _run(self, job: IngestJob):
+        """Worker entry point: ingest one file inside a single transaction"""
+        job.status = 'running'
+        job.started = time.perf_counter()
+        db = SessionLocal()
+        try:
+            self._ingest(job, db)
+            job.status = 'completed'
+            logger.info(f"Successfully processed file {job.filename}: {job.stats}")
+            if self.search_index is not None:
+                self._refresh_search_index(job, db)
+        except IngestCancelled:
+            job.status = 'cancelled'
+            logger.info(f"Ingestion of {job.filename} cancelled")
+        except Exception as e:
+            job.status = 'failed'
+            job.error = f"Error processing file: {str(e)}"
+            logger.exception(f"An error occurred while ingesting {job.filename}")
+        finally:
+            job.finished = time.perf_counter()
+            db.close()
+            self._remove_file(job)
+    
+    def _ingest(self, job: IngestJob, db):
+        """
+        Stream chunks from the file and write them in batches
+        
+        Chunks whose content hash already exists for the same file are
+        skipped, and live chunks that are missing from the new upload are
+        tombstoned, so re-uploading a file only writes what changed.
+        
+        Nested chunks arrive before their parents, so whether a parent is
+        a new row or an existing one is only known afterwards; parent links
+        are fixed up once the whole file has been read.
+        """
+        batch = []
+        # Zone map rows of the chunks in batch
+        stats_batch = []
+        # Lookup index rows of the chunks in batch
+        values_batch = []
+        # chunk_id assigned by the processor -> chunk_id of the unchanged row kept instead
+        kept_ids: Dict[str, str] = {}
+        # Unchanged rows -> (their current parent, parent chunk_id from this upload)
+        kept_parents: Dict[int, Tuple[Optional[str], str]] = {}
+        # Parent chunk_ids referenced by inserted rows
+        new_parents = set()
+        # Days whose rollups change with this upload
+        rollup_days = set()
+        embed = self.embedder is not None and vector_search_available()
+        try:
+            existing = get_live_chunk_hashes(db, job.filename)
+            chunks = self.processor.iter_chunks(job.file_path, stats=job.stats, workers=self.parse_workers)
+            for chunk_type, chunk_data, metadata in chunks:
+                if job.cancel_event.is_set():
+                    raise IngestCancelled()
+                
+                job.chunks_processed += 1
+                chunk_id = metadata.pop('chunk_id', None) or str(uuid.uuid4())
+                parent_id = metadata.pop('parent_id', None)
+                content_hash = self.processor.hash_content(chunk_data, chunk_type)
+                unchanged = existing.get(content_hash)
+                if unchanged:
+                    # Same chunk is already stored; keep that row
+                    row_id, kept_id, kept_parent = unchanged.pop()
+                    kept_ids[chunk_id] = kept_id
+                    if parent_id or kept_parent:
+                        kept_parents[row_id] = (kept_parent, parent_id)
+                    job.chunks_skipped += 1
+                    continue
+                
+                if parent_id:
+                    new_parents.add(parent_id)
+                # The zone map is stored in chunk_field_stats, not in the GIN-indexed metadata
+                field_stats = metadata.pop('field_stats', None)
+                if field_stats is not None:
+                    metadata['zone_map'] = True
+                # Per-day partial aggregates are stored in a column of their own
+                rollups = metadata.pop('rollups', None)
+                if rollups is not None:
+                    metadata['rollups'] = True
+                batch.append({
+                    'chunk_id': chunk_id,
+                    'parent_id': parent_id,
+                    'source_file': job.filename,
+                    'chunk_type': chunk_type,
+                    'metadata_': metadata,
+                    'content': chunk_data,  # Store the actual patient data
+                    'content_hash': content_hash,
+                    'date_span': chunk_date_span(metadata),
+                    'rollups': rollups
+                })
+                stats_batch.extend(field_stats_rows(chunk_id, field_stats or {}))
+                values_batch.extend(field_value_rows(chunk_id, chunk_data, metadata.get('lookup_fields', [])))
+                if rollups is not None:
+                    rollup_days.update(rollups['days'])
+                if len(batch) >= self.insert_batch_size:
+                    self._write_batch(db, job, batch, stats_batch, values_batch, embed)
+                    batch = []
+                    stats_batch = []
+                    values_batch = []
+            
+            self._write_batch(db, job, batch, stats_batch, values_batch, embed)
+            # New children of unchanged parents point at the parent rows kept
+            rename_parent_ids(db, job.filename, {
+                chunk_id: kept_id for chunk_id, kept_id in kept_ids.items() if chunk_id in new_parents
+            })
+            set_parent_ids(db, {
+                row_id: kept_ids.get(parent_id, parent_id)
+                for row_id, (kept_parent, parent_id) in kept_parents.items()
+                if kept_ids.get(parent_id, parent_id) != kept_parent
+            })
+            stale = [row[0] for rows in existing.values() for row in rows]
+            rollup_days |= get_rollup_days(db, stale)
+            if embed:
+                delete_chunk_embeddings(db, stale)
+            job.chunks_deleted = tombstone_chunks(db, stale)
+            job.rollups_written = refresh_rollups(db, job.filename, rollup_days)
+            if job.rows_inserted or job.chunks_deleted:
+                # Vocabulary for typo-tolerant search; unchanged files keep theirs
+                job.search_terms = refresh_search_terms(db, job.filename)
+                # Invalidates cached query results once this transaction commits
+                bump_data_generation(db)
+            if job.cancel_event.is_set():
+                raise IngestCancelled()
+            # The whole file is committed as a single transaction
+            db.commit()
+        except BaseException:
+            db.rollback()
+            # Nothing from this job was kept
+            job.rows_inserted = 0
+            job.chunks_deleted = 0
+            job.rollups_written = 0
+            job.search_terms = 0
+            raise
+        
+        elapsed = time.perf_counter() - job.started
+        job.stats.update({
+            'rows_inserted': job.rows_inserted,
+            'chunks_inserted': job.rows_inserted,
+            'chunks_skipped': job.chunks_skipped,
+            'chunks_deleted': job.chunks_deleted,
+            'rollups_written': job.rollups_written,
+            'search_terms': job.search_terms,
+            'insert_batch_size': self.insert_batch_size,
+            'ingest_seconds': round(elapsed, 4),
+            'rows_per_sec': round(job.rows_inserted / elapsed, 2) if elapsed > 0 else None
+        })
+    
+    def _refresh_search_index(self, job: IngestJob, db):
+        """Index the file's new chunks and drop its tombstoned ones; the upload stands either way"""
+        try:
+            started = time.perf_counter()
+            changes = self.search_index.refresh(db, job.filename)
+            job.stats['search_index'] = {**changes, 'seconds': round(time.perf_counter() - started, 4)}
+        except Exception:
+            logger.exception(f"Failed to update the search index for {job.filename}")
+    
+    def _write_batch(self, db, job: IngestJob, batch, stats_batch, values_batch, embed: bool):
+        """Insert a batch of chunks with their zone map, lookup index and embedding rows"""
+        job.rows_inserted += bulk_insert_chunks(db, batch)
+        bulk_insert_field_stats(db, stats_batch)
+        bulk_insert_field_values(db, values_batch)
+        if embed and batch:
+            # One vectorized pass over the whole batch
+            vectors = self.embedder.embed_chunks([row['content'] for row in batch])
+            bulk_insert_embeddings(db, [row['chunk_id'] for row in batch], vectors)
+    
+    def _remove_file(self, job: IngestJob):
+        if os.path.exists(job.file_path):
+            try:
+                os.remove(job.file_path)
+            except OSError:
+                pass  # Ignore cleanup errors
@@ -1,203 +1,510 @@
+import codecs
+import hashlib
 import ijson
 import json
+import orjson
 import os
 import re
 from typing import Dict, List, Any, Optional, Generator, Tuple
 from datetime import datetime
+import time
 import uuid
 
+from .chunking import (
+    CHUNK_REF_KEY, ArrayChunker, ChunkAnchor, ChunkingPolicy, ChunkRecord, child_path, make_record,
+    serialized_size
+)
+from .field_stats import compute_field_stats
+from .rollups import daily_rollups, rollup_fields
+from .value_index import lookup_fields
+from .parallel_parser import ParallelChunkParser
+from .resource_usage import peak_rss_mb
+
+# Fields that identify an individual record, in order of preference
+ID_FIELDS = ('id', '_id', 'uuid', 'key')
+
+# Extensions of newline-delimited JSON files
+JSON_LINES_EXTENSIONS = ('.jsonl', '.ndjson')
+
+# How much of the file to inspect when looking for MongoDB shell syntax
+SNIFF_BYTES = 64 * 1024
+MONGODB_MARKER_RE = re.compile(rb'\b(?:ObjectId|ISODate|Date|NumberLong|NumberInt|NumberDecimal)\s*\(')
+
+
+class _CountingReader:
+    """File wrapper that counts the bytes handed to the parser"""
+    
+    def __init__(self, f):
+        self._f = f
+        self.bytes_read = 0
+    
+    def read(self, size: int = -1) -> bytes:
+        data = self._f.read(size)
+        self.bytes_read += len(data)
+        return data
+
+
+# Tokens of MongoDB shell / JavaScript object notation
+_WS_RE = re.compile(r'\s*')
+_TOKEN_RE = re.compile(r"""
+    (?P<ws>\s+)
+  | (?P<dstr>"(?:[^"\\]|\\.)*")
+  | (?P<sstr>'(?:[^'\\]|\\.)*')
+  | (?P<punct>[{}\[\],:])
+  | (?P<word>[A-Za-z0-9_$.+\-]+)
+""", re.VERBOSE | re.DOTALL)
+# Runs of tokens that are already valid JSON and can be copied verbatim.
+# Every token must be followed by another character so that a token cut off
+# at the end of the buffer is never copied.
+_PASSTHROUGH_RE = re.compile(r"""
+    (?:
+        (?: \s+
+          | "(?:[^"\\]|\\.)*"
+          | [{}\[\],:]
+          | -?(?:0|[1-9]\d*)(?:\.\d+)?(?:[eE][+-]?\d+)?(?![\w$.+\-])(?!\s*:)
+          | (?:true|false|null)(?![\w$.+\-])(?!\s*:)
+        )
+        (?=[\s\S])
+    )+
+""", re.VERBOSE)
+_CALL_RE = re.compile(r"""
+    (?:new\s+)?
+    (?P<name>ObjectId|ISODate|Date|NumberLong|NumberInt|NumberDecimal)
+    \s*\(\s*
+    (?P<arg>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*'|[^)\s]*)
+    \s*\)
+""", re.VERBOSE | re.DOTALL)
+# Start of a constructor call, with the constructor's name
+_CALL_HEAD_RE = re.compile(r'(?:new\s+)?(?P<name>[A-Za-z_$][\w$]*)\s*\(')
+_CONSTRUCTORS = frozenset({'ObjectId', 'ISODate', 'Date', 'NumberLong', 'NumberInt', 'NumberDecimal'})
+# Longest constructor call read ahead for; an unmatched call is an error past it,
+# so a malformed call does not pull the rest of the file into memory
+MAX_CALL_CHARS = 4096
+_NUMBER_RE = re.compile(r'-?(?:0|[1-9]\d*)(?:\.\d+)?(?:[eE][+-]?\d+)?')
+_SQUOTE_ESCAPE_RE = re.compile(r'\\.|"', re.DOTALL)
+_NUMERIC_CONSTRUCTORS = ('NumberLong', 'NumberInt', 'NumberDecimal')
+
+
+def _single_to_double_quoted(literal: str) -> str:
+    """Rewrite a single-quoted string literal as a JSON string"""
+    def replace(match):
+        text = match.group(0)
+        if text == '"':
+            return '\\"'
+        if text == "\\'":
+            return "'"
+        return text
+    return '"' + _SQUOTE_ESCAPE_RE.sub(replace, literal[1:-1]) + '"'
+
+
+class MongoJSONReader:
+    """
+    Binary file wrapper that converts MongoDB export format to valid JSON
+    in a single pass, so it can be fed straight into ijson.
+    
+    Handles ObjectId/ISODate/Date/NumberLong/NumberInt/NumberDecimal
+    constructors, unquoted keys, single-quoted strings, bare identifiers such
+    as UUIDs, and case-insensitive true/false/null. Double-quoted strings are
+    copied untouched, so quotes and keywords inside them are preserved.
+    """
+    
+    def __init__(self, f, block_size: int = 64 * 1024):
+        """
+        Args:
+            f: Binary file-like object holding the MongoDB export
+            block_size: Number of bytes to read from f at a time
+        """
+        self._f = f
+        self._block_size = block_size
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+        self._out = b''
+    
+    def read(self, size: int = -1) -> bytes:
+        while (size < 0 or len(self._out) < size) and not (self._eof and self._pos >= len(self._buf)):
+            self._out += self._convert().encode('utf-8')
+        if size < 0:
+            size = len(self._out)
+        data, self._out = self._out[:size], self._out[size:]
+        return data
+    
+    def _fill(self):
+        """Append the next block of input to the buffer"""
+        block = self._f.read(self._block_size)
+        if not block:
+            self._eof = True
+            self._buf = self._buf[self._pos:] + self._decoder.decode(b'', final=True)
+        else:
+            self._buf = self._buf[self._pos:] + self._decoder.decode(block)
+        self._pos = 0
+    
+    def _convert(self) -> str:
+        """Convert as many complete tokens as the buffer holds"""
+        buf, pos = self._buf, self._pos
+        end = len(buf)
+        pieces = []
+        while pos < end:
+            run = _PASSTHROUGH_RE.match(buf, pos)
+            if run:
+                pieces.append(buf[pos:run.end()])
+                pos = run.end()
+                continue
+            
+            match = _TOKEN_RE.match(buf, pos)
+            if not match:
+                if not self._eof:
+                    break
+                raise ValueError(f"Unexpected character {buf[pos]!r} in MongoDB export")
+            if match.end() == end and not self._eof:
+                break  # Token may continue in the next block
+            
+            kind = match.lastgroup
+            if kind == 'sstr':
+                pieces.append(_single_to_double_quoted(match.group()))
+                pos = match.end()
+            elif kind != 'word':
+                pieces.append(match.group())
+                pos = match.end()
+            else:
+                word = match.group()
+                after = _WS_RE.match(buf, match.end()).end()
+                if after == end and not self._eof:
+                    break  # Need the next character to classify the word
+                next_char = buf[after] if after < end else ''
+                if next_char == ':':
+                    # Unquoted key
+                    pieces.append(json.dumps(word))
+                    pos = match.end()
+                elif next_char == '(' or word == 'new':
+                    call = _CALL_RE.match(buf, pos)
+                    if not call:
+                        head = _CALL_HEAD_RE.match(buf, pos)
+                        if head and head.group('name') not in _CONSTRUCTORS:
+                            raise ValueError(f"Unsupported constructor {head.group('name')!r} in MongoDB export")
+                        if not self._eof and end - pos < MAX_CALL_CHARS:
+                            break
+                        raise ValueError(f"Malformed constructor call {buf[pos:pos + 40]!r} in MongoDB export")
+                    pieces.append(self._convert_call(call.group('name'), call.group('arg')))
+                    pos = call.end()
+                else:
+                    pieces.append(self._convert_bare_value(word))
+                    pos = match.end()
+        
+        self._pos = pos
+        if pos >= end or not pieces:
+            if self._eof and pos < end:
+                raise ValueError("Unexpected end of MongoDB export")
+            if not self._eof:
+                self._fill()
+        return ''.join(pieces)
+    
+    def _convert_call(self, name: str, arg: str) -> str:
+        """Convert a constructor call such as ObjectId("...") to a JSON value"""
+        if arg.startswith("'"):
+            arg = _single_to_double_quoted(arg)
+        if name in _NUMERIC_CONSTRUCTORS:
+            inner = json.loads(arg) if arg.startswith('"') else arg
+            return inner if _NUMBER_RE.fullmatch(inner) else json.dumps(inner)
+        if arg.startswith('"') or _NUMBER_RE.fullmatch(arg):
+            return arg
+        return json.dumps(arg)
+    
+    def _convert_bare_value(self, word: str) -> str:
+        """Convert an unquoted value to a JSON literal, number or string"""
+        lowered = word.lower()
+        if lowered in ('true', 'false', 'null'):
+            return lowered
+        if _NUMBER_RE.fullmatch(word):
+            return word
+        # Bare identifiers such as UUIDs or hex object ids
+        return json.dumps(word)
+
+
 class JSONProcessor:
     """Handles streaming and chunking of large JSON files"""
     
-    def __init__(self, chunk_size: int = 1000):
+    def __init__(self, chunk_size: int = 1000, policy: Optional[ChunkingPolicy] = None):
         """
         Initialize the JSON processor
         
         Args:
             chunk_size: Maximum number of items per chunk for arrays
+            policy: Chunking policy with byte/token budgets; when given, its
+                max_items takes the place of chunk_size
         """
-        self.chunk_size = chunk_size
+        self.policy = policy or ChunkingPolicy(max_items=chunk_size)
+        self.chunk_size = self.policy.max_items
     
-    def _preprocess_json_file(self, file_path: str) -> str:
+    def stream_json_file(self, file_path: str, stats: Optional[Dict[str, Any]] = None) -> Generator[Tuple[str, Any], None, None]:
         """
-        Preprocess JSON file to handle MongoDB export format
-        by converting it to valid JSON.
+        Stream a JSON file and yield chunks of data
         
-        Args:
-            file_path: Path to the original JSON file
-            
-        Returns:
-            Path to the preprocessed JSON file
-        """
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read().strip()
+        The file is parsed event by event with ijson, so only the chunk being
+        built is held in memory regardless of the size of the input. JSON Lines
+        files (.jsonl/.ndjson) are split on line boundaries instead.
         
-        # Try to parse as-is first
-        try:
-            json.loads(content)
-            return file_path  # Already valid JSON
-        except json.JSONDecodeError:
-            pass
+        Arrays are chunked at any depth: a nested array that does not fit in
+        one chunk is stored as chunks of its own and replaced in its parent
+        by a {'$ref': <path>} placeholder. Use iter_chunks to also get the
+        path and parent of each chunk.
         
-        # For MongoDB exports, try a more comprehensive approach
-        try:
-            # Handle MongoDB extended JSON format
-            processed_content = self._convert_mongodb_to_json(content)
-            
-            # Create a temporary file with corrected JSON
-            temp_file_path = file_path + '.temp'
-            with open(temp_file_path, 'w', encoding='utf-8') as f:
-                f.write(processed_content)
-            
-            # Verify the processed content is valid JSON
-            json.loads(processed_content)
-            return temp_file_path
+        Args:
+            file_path: Path to the JSON file
+            stats: Optional dictionary that is filled with throughput statistics
+                (bytes_read, elapsed_seconds, bytes_per_sec, peak_rss_mb).
+                bytes_read is kept current while chunks are being yielded.
             
-        except Exception as e:
-            # If all else fails, return original file and let the error bubble up
-            return file_path
-    
-    def _convert_mongodb_to_json(self, content: str) -> str:
+        Yields:
+            Tuple of (chunk_type, chunk_data) where chunk_type is a string
+            identifying the type of chunk (e.g., 'root_chunk', '<key>_chunk_N')
+            and chunk_data is the actual data
         """
-        Convert MongoDB export format to valid JSON
+        for chunk_type, chunk_data, _ in self.iter_chunks(file_path, stats):
+            yield chunk_type, chunk_data
+    
+    def iter_chunks(self, file_path: str, stats: Optional[Dict[str, Any]] = None,
+                    workers: int = 1) -> Generator[Tuple[str, Any, Dict[str, Any]], None, None]:
         """
-        # Step 1: Handle MongoDB functions
-        content = re.sub(r'ObjectId\(["\']([^"\')]+)["\']\)', r'"\1"', content)
-        content = re.sub(r'ISODate\(["\']([^"\')]+)["\']\)', r'"\1"', content)
-        content = re.sub(r'NumberLong\(([^)]+)\)', r'\1', content)
-        content = re.sub(r'NumberInt\(([^)]+)\)', r'\1', content)
-        content = re.sub(r'NumberDecimal\(["\']([^"\')]+)["\']\)', r'\1', content)
-        
-        # Step 2: Fix unquoted keys (more comprehensive)
-        content = re.sub(r'([{,]\s*)([a-zA-Z_][a-zA-Z0-9_]*)\s*:', r'\1"\2":', content)
+        Stream a JSON file and yield chunks together with their metadata
         
-        # Step 3: Fix unquoted string values that look like UUIDs or IDs
-        content = re.sub(r':\s*([a-fA-F0-9]{8}-[a-fA-F0-9]{4}-[a-fA-F0-9]{4}-[a-fA-F0-9]{4}-[a-fA-F0-9]{12})([,}])', r': "\1"\2', content)
-        content = re.sub(r':\s*([a-fA-F0-9]{24,})([,}])', r': "\1"\2', content)
-        
-        # Step 4: Convert single quotes to double quotes for string values
-        content = re.sub(r"'([^']*?)'", r'"\1"', content)
-        
-        # Step 5: Handle boolean and null values (case-insensitive)
-        content = re.sub(r'\btrue\b', 'true', content, flags=re.IGNORECASE)
-        content = re.sub(r'\bfalse\b', 'false', content, flags=re.IGNORECASE)
-        content = re.sub(r'\bnull\b', 'null', content, flags=re.IGNORECASE)
-        
-        return content
-
-    def stream_json_file(self, file_path: str) -> Generator[Tuple[str, Any], None, None]:
-        """
-        Stream a JSON file and yield chunks of data
+        Besides the extracted metadata, each chunk carries its JSON 'path'
+        and, as 'chunk_id' and 'parent_id', its own id and the id of the
+        chunk holding the value it was split out of. Nested chunks are
+        yielded before their parents.
         
         Args:
             file_path: Path to the JSON file
+            stats: Optional dictionary that is filled with throughput statistics
+            workers: Number of worker processes; with more than one, files
+                holding a plain root array and JSON Lines files are decoded
+                and their metadata extracted in parallel, chunk order is unchanged
             
         Yields:
-            Tuple of (chunk_type, chunk_data) where chunk_type is a string
-            identifying the type of chunk (e.g., 'day_wise', 'week_wise')
-            and chunk_data is the actual data
+            Tuple of (chunk_type, chunk_data, metadata)
         """
-        temp_file_path = None
+        json_lines = self.is_json_lines(file_path)
+        if json_lines or (workers > 1 and ParallelChunkParser.is_root_array(file_path)
+                          and not self._looks_like_mongodb_export(file_path)):
+            parser = ParallelChunkParser(workers=workers, json_lines=json_lines, policy=self.policy)
+            try:
+                yield from parser.stream_file(file_path, stats)
+            except Exception as e:
+                raise Exception(f"Error processing JSON file: {str(e)}")
+            return
+        
+        for chunk_type, chunk_data, info in self._stream_records(file_path, stats):
+            metadata = self.extract_metadata(chunk_data, chunk_type)
+            metadata.update(info)
+            yield chunk_type, chunk_data, metadata
+    
+    def _stream_records(self, file_path: str, stats: Optional[Dict[str, Any]] = None) -> Generator[ChunkRecord, None, None]:
+        """Stream the chunk records of a JSON document, see stream_json_file"""
+        if stats is None:
+            stats = {}
+        started = time.perf_counter()
+        readers = []
         try:
-            # Preprocess the file to handle MongoDB/JavaScript object notation
-            processed_file_path = self._preprocess_json_file(file_path)
-            temp_file_path = processed_file_path if processed_file_path != file_path else None
+            # MongoDB/JavaScript object notation is converted on the fly
+            mongodb = self._looks_like_mongodb_export(file_path)
+            yielded = False
+            retry = False
+            try:
+                for record in self._stream_path(file_path, readers, mongodb):
+                    yielded = True
+                    stats['bytes_read'] = readers[-1].bytes_read
+                    yield record
+            except ijson.JSONError:
+                # Nothing emitted yet, so the file may still be a MongoDB export
+                if yielded or mongodb:
+                    raise
+                retry = True
             
-            # Load the entire JSON file (since preprocessing already handled format issues)
-            with open(processed_file_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            
-            # Process the loaded data
-            if isinstance(data, dict):
-                # Handle object at root level
-                for chunk_type, chunk_data in self._process_dict_data(data):
-                    yield chunk_type, chunk_data
-            elif isinstance(data, list):
-                # Handle array at root level - chunk it
-                for i in range(0, len(data), self.chunk_size):
-                    chunk = data[i:i + self.chunk_size]
-                    yield 'root_chunk', chunk
-            else:
-                # Single value
-                yield 'single_value', data
+            if retry:
+                for record in self._stream_path(file_path, readers, mongodb=True):
+                    stats['bytes_read'] = readers[-1].bytes_read
+                    yield record
                 
         except Exception as e:
             raise Exception(f"Error processing JSON file: {str(e)}")
         finally:
-            # Clean up temporary file if created
-            if temp_file_path and os.path.exists(temp_file_path):
-                try:
-                    os.remove(temp_file_path)
-                except:
-                    pass  # Ignore cleanup errors
+            elapsed = time.perf_counter() - started
+            bytes_read = sum(reader.bytes_read for reader in readers)
+            stats.update({
+                'bytes_read': bytes_read,
+                'elapsed_seconds': round(elapsed, 4),
+                'bytes_per_sec': round(bytes_read / elapsed, 2) if elapsed > 0 else None,
+                'peak_rss_mb': peak_rss_mb(),
+                'parser_backend': getattr(ijson, 'backend', None)
+            })
+    
+    @staticmethod
+    def is_json_lines(file_path: str) -> bool:
+        """Check whether a file is newline-delimited JSON by its extension"""
+        return os.path.splitext(file_path)[1].lower() in JSON_LINES_EXTENSIONS
     
-    def _process_dict_data(self, data: dict) -> Generator[Tuple[str, Any], None, None]:
+    def _looks_like_mongodb_export(self, file_path: str) -> bool:
+        """Check the head of the file for MongoDB shell constructors"""
+        with open(file_path, 'rb') as f:
+            head = f.read(SNIFF_BYTES)
+        return MONGODB_MARKER_RE.search(head) is not None
+    
+    def _stream_path(self, file_path: str, readers: List[_CountingReader],
+                     mongodb: bool = False) -> Generator[ChunkRecord, None, None]:
+        """Open a file in binary mode and stream its chunk records"""
+        with open(file_path, 'rb') as f:
+            reader = _CountingReader(f)
+            readers.append(reader)
+            stream = MongoJSONReader(reader) if mongodb else reader
+            yield from self._stream_events(stream)
+    
+    def _stream_events(self, stream) -> Generator[ChunkRecord, None, None]:
         """
-        Process a dictionary and yield chunks based on content
+        Walk the ijson event stream of a binary file object and yield chunk records
         """
-        # Look for arrays that can be chunked
-        for key, value in data.items():
-            if isinstance(value, list) and len(value) > self.chunk_size:
-                # Chunk large arrays
-                for i in range(0, len(value), self.chunk_size):
-                    chunk = value[i:i + self.chunk_size]
-                    yield f'{key}_chunk_{i//self.chunk_size}', chunk
-            else:
-                # Yield smaller items as-is
-                yield key, value
+        events = ijson.basic_parse(stream, use_float=True)
+        event, value = next(events)
+        if event == 'start_map':
+            # Handle object at root level
+            yield from self._process_object(events)
+        elif event == 'start_array':
+            # Handle array at root level - chunk it
+            yield from self._walk_array(events, '', None, chunk_type='root_chunk')
+        else:
+            # Single value
+            yield make_record('single_value', value, '', None)
     
-    def _process_object_legacy(self, parser, prefix: str) -> Generator[Tuple[str, Dict], None, None]:
-        """Process a JSON object and yield chunks"""
-        current_key = None
-        chunk_buffer = []
+    def _process_object(self, events) -> Generator[ChunkRecord, None, None]:
+        """
+        Process the members of the root object and yield chunks
         
-        for prefix, event, value in parser:
-            if event == 'map_key':
-                current_key = value
-            elif event == 'start_array' and current_key:
-                # Process array values
-                array_prefix = f"{prefix}.{current_key}"
-                for chunk in self._process_array(parser, array_prefix, current_key):
-                    yield current_key, chunk
-            elif event == 'end_map' and prefix == '':
-                # End of root object
+        Every member is yielded under its key. A member array that does not
+        fit in one chunk is split into '<key>_chunk_N' chunks, whose parent
+        is the member's own chunk holding a reference to them.
+        """
+        for event, value in events:
+            if event == 'end_map':
                 break
+            key = value
+            event, value = next(events)
+            anchor = ChunkAnchor()
+            value = yield from self._walk(events, event, value, str(key), anchor)
+            yield make_record(str(key), value, str(key), None, chunk_id=anchor.chunk_id)
     
-    def _process_array(self, parser, prefix: str, array_name: str) -> Generator[List[Dict], None, None]:
-        """Process a JSON array and yield chunks of items"""
-        chunk = []
-        item_count = 0
+    def _walk(self, events, event: str, value: Any, path: str,
+              anchor: ChunkAnchor) -> Generator[ChunkRecord, None, Any]:
+        """
+        Build one complete JSON value starting at the given event
         
-        for event, value in ijson.parse(parser):
-            if event == 'start_map':
-                # Start of an object in the array
-                item = {}
-                current_key = None
-                
-                # Process object properties
-                for prop_event, prop_value in parser:
-                    if prop_event == 'map_key':
-                        current_key = prop_value
-                    elif prop_event in ('string', 'number', 'boolean', 'null'):
-                        if current_key:
-                            item[current_key] = prop_value
-                    elif prop_event == 'end_map':
-                        break
-                
-                # Add item to chunk
-                chunk.append(item)
-                item_count += 1
-                
-                # Yield chunk if size limit reached
-                if len(chunk) >= self.chunk_size:
-                    yield chunk
-                    chunk = []
-            
-            elif event == 'end_array' and value == prefix:
-                # End of the array
-                if chunk:  # Yield any remaining items
-                    yield chunk
+        Nested arrays that need more than one chunk are yielded as chunks
+        of their own with anchor as their parent.
+        
+        Returns:
+            The value, with references in place of the arrays split out
+        """
+        if event == 'start_array':
+            return (yield from self._walk_array(events, path, anchor))
+        if event != 'start_map':
+            return value
+        
+        result = {}
+        for event, value in events:
+            if event == 'end_map':
+                break
+            key = value
+            event, value = next(events)
+            if event == 'start_map' or event == 'start_array':
+                value = yield from self._walk(events, event, value, child_path(path, key), anchor)
+            result[key] = value
+        return result
+    
+    def _walk_array(self, events, path: str, anchor: Optional[ChunkAnchor],
+                    chunk_type: Optional[str] = None) -> Generator[ChunkRecord, None, Any]:
+        """Process the items of a JSON array, yielding the chunks it is split into"""
+        chunker = ArrayChunker(self.policy, path, anchor, chunk_type)
+        for event, value in events:
+            if event == 'end_array':
                 break
+            if event == 'start_map' or event == 'start_array':
+                item_path = f'{path}[{chunker.count}]'
+                item_anchor = ChunkAnchor()
+                value = yield from self._walk(events, event, value, item_path, item_anchor)
+                if item_anchor.used:
+                    value = yield from self._lift(value, item_path, item_anchor, anchor)
+            records = chunker.add(value)
+            if records:
+                yield from records
+        
+        records, value = chunker.finish()
+        yield from records
+        return value
+    
+    def _lift(self, item: Any, path: str, item_anchor: ChunkAnchor,
+              anchor: Optional[ChunkAnchor]) -> Generator[ChunkRecord, None, Dict[str, str]]:
+        """
+        Store an array item that holds references as a chunk of its own
+        
+        Keeps the references of its nested chunks pointing at a chunk whose
+        id is known up front, wherever the array containing it is cut.
+        
+        Returns:
+            The reference left in the array
+        """
+        yield make_record(path, item, path, anchor, chunk_id=item_anchor.chunk_id)
+        return {CHUNK_REF_KEY: path}
+    
+    def split_items(self, items: List[Any], offset: int = 0,
+                    chunk_type: str = 'root_chunk') -> Generator[ChunkRecord, None, None]:
+        """
+        Turn decoded root-level items into one chunk, splitting nested arrays
+        
+        Used for spans decoded in one piece, such as JSON Lines; yields the
+        same records the streaming parser yields for those items.
+        
+        Args:
+            items: Decoded items
+            offset: Index of the first item at the root
+            chunk_type: Chunk type of the resulting chunk
+        """
+        chunk = []
+        for index, item in enumerate(items, offset):
+            if isinstance(item, (dict, list)):
+                item_path = f'[{index}]'
+                item_anchor = ChunkAnchor()
+                item = yield from self._split(item, item_path, item_anchor)
+                if item_anchor.used:
+                    item = yield from self._lift(item, item_path, item_anchor, None)
+            chunk.append(item)
+        yield make_record(chunk_type, chunk, '', None, item_offset=offset)
+    
+    def _split(self, value: Any, path: str, anchor: ChunkAnchor) -> Generator[ChunkRecord, None, Any]:
+        """Decoded-value counterpart of _walk"""
+        if isinstance(value, dict):
+            result = {}
+            for key, member in value.items():
+                if isinstance(member, (dict, list)):
+                    member = yield from self._split(member, child_path(path, key), anchor)
+                result[key] = member
+            return result
+        if not isinstance(value, list):
+            return value
+        
+        chunker = ArrayChunker(self.policy, path, anchor)
+        for item in value:
+            if isinstance(item, (dict, list)):
+                item_path = f'{path}[{chunker.count}]'
+                item_anchor = ChunkAnchor()
+                item = yield from self._split(item, item_path, item_anchor)
+                if item_anchor.used:
+                    item = yield from self._lift(item, item_path, item_anchor, anchor)
+            records = chunker.add(item)
+            if records:
+                yield from records
+        
+        records, value = chunker.finish()
+        yield from records
+        return value
     
     def extract_metadata(self, chunk: Any, chunk_type: str) -> Dict[str, Any]:
         """
@@ -213,44 +520,88 @@ class JSONProcessor:
         if not chunk:
             return {}
         
+        chunk_bytes = serialized_size(chunk)
         metadata = {
             'chunk_type': chunk_type,
-            'timestamp': datetime.utcnow().isoformat()
+            'timestamp': datetime.utcnow().isoformat(),
+            'chunk_bytes': chunk_bytes,
+            'estimated_tokens': self.policy.estimate_tokens(chunk_bytes),
+            'chunking': self.policy.to_dict()
         }
         
         # Handle different chunk types
+        field_stats = None
         if isinstance(chunk, list):
             metadata['item_count'] = len(chunk)
             if chunk and isinstance(chunk[0], dict):
-                metadata['fields'] = list(chunk[0].keys())
+                field_stats = compute_field_stats(chunk)
+                fields = {}
+                for item in chunk:
+                    if isinstance(item, dict):
+                        fields.update(item)
+                metadata['fields'] = list(fields)
             else:
                 metadata['data_type'] = type(chunk[0]).__name__ if chunk else 'empty'
         elif isinstance(chunk, dict):
             metadata['item_count'] = 1
             metadata['fields'] = list(chunk.keys())
+            field_stats = compute_field_stats([chunk])
         else:
             metadata['item_count'] = 1
             metadata['data_type'] = type(chunk).__name__
         
-        # Extract date range if available (only for list of dicts)
-        if isinstance(chunk, list) and chunk and isinstance(chunk[0], dict):
+        if field_stats:
+            # Zone map: lets queries skip chunks whose ranges cannot match;
+            # moved to chunk_field_stats when the chunk is stored
+            metadata['field_stats'] = field_stats
+            # Fields whose values are entered in the lookup index at ingest
+            indexed = lookup_fields(field_stats, ID_FIELDS)
+            if indexed:
+                metadata['lookup_fields'] = indexed
+            
+            # Extract date range if available
             date_fields = ['date', 'timestamp', 'time', 'created_at', 'updated_at', 'start_date', 'end_date']
             for field in date_fields:
-                if field in chunk[0]:
-                    try:
-                        dates = [item[field] for item in chunk if isinstance(item, dict) and field in item]
-                        if dates:
-                            metadata['date_range'] = {
-                                'field': field,
-                                'min': min(dates),
-                                'max': max(dates)
-                            }
-                            break
-                    except (TypeError, ValueError):
-                        continue
+                if 'min' in field_stats.get(field, {}):
+                    metadata['date_range'] = {
+                        'field': field,
+                        'min': field_stats[field]['min'],
+                        'max': field_stats[field]['max']
+                    }
+                    
+                    # Per-day partial aggregates, merged into PrecomputedAggregate rollups;
+                    # moved to the chunk's rollups column when the chunk is stored
+                    numeric_fields = rollup_fields(field_stats, field, skip=ID_FIELDS)
+                    records = chunk if isinstance(chunk, list) else [chunk]
+                    days = daily_rollups(records, field, numeric_fields) if numeric_fields else None
+                    if days:
+                        metadata['rollups'] = {'date_field': field, 'days': days}
+                    break
         
         return metadata
 
+    def hash_content(self, chunk: Any, chunk_type: str = '') -> str:
+        """
+        Hash a chunk's type and content for change detection
+        
+        Keys are sorted first, so the hash does not depend on the key order
+        of the source file.
+        
+        Args:
+            chunk: Data chunk
+            chunk_type: Type of the chunk
+            
+        Returns:
+            Hex SHA-256 digest
+        """
+        digest = hashlib.sha256(chunk_type.encode('utf-8') + b'\0')
+        try:
+            digest.update(orjson.dumps(chunk, option=orjson.OPT_SORT_KEYS))
+        except TypeError:
+            # orjson rejects integers wider than 64 bits
+            digest.update(json.dumps(chunk, sort_keys=True, separators=(',', ':')).encode('utf-8'))
+        return digest.hexdigest()
+    
     def create_chunk_id(self, source_file: str, chunk_type: str, index: int) -> str:
         """
         Create a unique ID for a chunk
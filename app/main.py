@@ -14,12 +14,14 @@ from fastapi import FastAPI, APIRouter, UploadFile, File, HTTPException, Depends
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
+from starlette.concurrency import run_in_threadpool
 from typing import List, Dict, Any, Optional, Generator
 import uvicorn
 from pathlib import Path
 from datetime import datetime
 import json
 import tempfile
+import threading
 import logging
 
 # Configure logging
@@ -36,8 +38,13 @@ logger = logging.getLogger(__name__)
 
 # Import database and other components
 from .database import SessionLocal, engine, get_db, create_tables
-from .json_processor import JSONProcessor
-from .query_processor import QueryProcessor
+from .chunking import ChunkingPolicy
+from .bm25_index import get_bm25_index
+from .embeddings import HashingEmbedder
+from .json_processor import JSONProcessor, JSON_LINES_EXTENSIONS
+from .ingestion import IngestionManager
+from .query_processor import QueryProcessor, retrieval_cache
+from .response_cache import response_cache
 
 # Initialize FastAPI app
 app = FastAPI(
@@ -75,8 +82,90 @@ if not os.path.exists(UPLOAD_DIR):
     os.makedirs(UPLOAD_DIR, exist_ok=True)
 
 # Initialize JSON processor with smaller chunk size for serverless
-CHUNK_SIZE = 100  # Smaller chunks for serverless environments
-json_processor = JSONProcessor(chunk_size=CHUNK_SIZE)
+CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", "100"))  # Maximum items per chunk
+# Chunks are also closed before they exceed a token (and optional byte) budget,
+# so a chunk of large records still fits in the LLM context
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", "2000")) or None
+CHUNK_MAX_BYTES = int(os.getenv("CHUNK_MAX_BYTES", "0")) or None
+CHUNK_MIN_ITEMS = int(os.getenv("CHUNK_MIN_ITEMS", "1"))
+json_processor = JSONProcessor(policy=ChunkingPolicy(
+    max_items=CHUNK_SIZE,
+    min_items=CHUNK_MIN_ITEMS,
+    max_bytes=CHUNK_MAX_BYTES,
+    max_tokens=CHUNK_MAX_TOKENS
+))
+
+# Number of chunk rows written per multi-row INSERT
+INSERT_BATCH_SIZE = int(os.getenv("INSERT_BATCH_SIZE", "500"))
+
+# Uploads are ingested in the background by a small worker pool
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "2"))
+# Processes used to parse a single large root array (1 disables parallel parsing)
+INGEST_PARSE_WORKERS = int(os.getenv("INGEST_PARSE_WORKERS", "1"))
+ingestion_manager = IngestionManager(
+    json_processor,
+    max_workers=INGEST_WORKERS,
+    insert_batch_size=INSERT_BATCH_SIZE,
+    parse_workers=INGEST_PARSE_WORKERS,
+    embedder=HashingEmbedder(),
+    search_index=get_bm25_index()
+)
+
+
+def _build_search_index():
+    """Bring the BM25 index up to date with chunks stored while it was not running"""
+    db = SessionLocal()
+    try:
+        changes = ingestion_manager.search_index.refresh(db)
+        logger.info(f"BM25 index refreshed: {changes}")
+    except Exception:
+        logger.exception("Failed to build the BM25 index")
+    finally:
+        db.close()
+
+
+if ingestion_manager.search_index is not None and not os.getenv("VERCEL"):
+    threading.Thread(target=_build_search_index, name='bm25-build', daemon=True).start()
+
+# Uploads are copied to disk in blocks of this many bytes
+UPLOAD_BLOCK_SIZE = int(os.getenv("UPLOAD_BLOCK_SIZE", str(1024 * 1024)))
+# Largest accepted upload in bytes
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(2 * 1024 ** 3)))
+
+async def spool_upload(file: UploadFile) -> str:
+    """
+    Copy an upload into UPLOAD_DIR in fixed-size blocks
+    
+    Only one block is held in memory at a time, so concurrent large uploads
+    keep memory flat. Each upload gets its own file name, so two uploads of
+    the same file cannot overwrite each other.
+    
+    Args:
+        file: The uploaded file
+        
+    Returns:
+        Path to the spooled file
+    """
+    suffix = os.path.splitext(file.filename)[1]
+    fd, file_path = tempfile.mkstemp(dir=UPLOAD_DIR, suffix=suffix)
+    total = 0
+    try:
+        with os.fdopen(fd, "wb") as buffer:
+            while True:
+                block = await file.read(UPLOAD_BLOCK_SIZE)
+                if not block:
+                    break
+                total += len(block)
+                if total > MAX_UPLOAD_BYTES:
+                    raise HTTPException(
+                        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                        detail=f"File exceeds the maximum upload size of {MAX_UPLOAD_BYTES} bytes"
+                    )
+                buffer.write(block)
+    except Exception:
+        os.remove(file_path)
+        raise
+    return file_path
 
 @app.middleware("http")
 async def db_session_middleware(request: Request, call_next):
@@ -89,70 +178,42 @@ async def db_session_middleware(request: Request, call_next):
         request.state.db.close()
     return response
 
-@api_router.post("/upload/", response_model=Dict[str, Any])
+@api_router.post("/upload/", response_model=Dict[str, Any], status_code=status.HTTP_202_ACCEPTED)
 async def upload_file(
-    file: UploadFile = File(...),
-    db = Depends(get_db)
+    file: UploadFile = File(...)
 ):
     """
-    Upload and process a JSON file
+    Upload a JSON or JSON Lines file and queue it for ingestion
     
-    The file will be processed in a streaming fashion to handle large files efficiently.
+    The file is spooled to disk and handed to a background worker, and the
+    response carries a job id that can be polled at /api/jobs/{job_id}.
     """
+    file_path = None
     try:
         logger.info(f"Starting file upload processing for {file.filename}")
         # Validate file type
-        if not file.filename.lower().endswith('.json'):
+        if not file.filename.lower().endswith(('.json',) + JSON_LINES_EXTENSIONS):
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Only JSON files are supported"
+                detail="Only JSON and JSON Lines (.jsonl, .ndjson) files are supported"
             )
         
-        # Save the uploaded file
-        file_path = os.path.join(UPLOAD_DIR, file.filename)
-        with open(file_path, "wb") as buffer:
-            buffer.write(await file.read())
+        # Spool the uploaded file to disk block by block
+        file_path = await spool_upload(file)
         
-        # Process the JSON file and save chunks to database
-        from .database import JSONChunk
-        import uuid
+        # The worker owns the spooled file from here on
+        job = ingestion_manager.submit(file_path, file.filename)
+        file_path = None
         
-        chunks = []
-        for chunk_type, chunk_data in json_processor.stream_json_file(file_path):
-            # Generate unique chunk ID
-            chunk_id = str(uuid.uuid4())
-            
-            # Extract metadata
-            metadata = json_processor.extract_metadata(chunk_data, chunk_type)
-            
-            # Create database record
-            db_chunk = JSONChunk(
-                chunk_id=chunk_id,
-                source_file=file.filename,
-                chunk_type=chunk_type,
-                metadata_=metadata,
-                content=chunk_data  # Store the actual patient data
-            )
-            
-            # Save to database
-            db.add(db_chunk)
-            db.commit()
-            
-            chunks.append({
-                'chunk_id': chunk_id,
-                'chunk_type': chunk_type,
-                'item_count': len(chunk_data) if isinstance(chunk_data, list) else 1,
-                'metadata': metadata
-            })
-        
-        logger.info(f"Successfully processed file {file.filename}")
         return {
-            "status": "success",
+            "status": "accepted",
             "filename": file.filename,
-            "chunks_processed": len(chunks),
-            "chunks": chunks
+            "job_id": job.job_id,
+            "status_url": f"{api_router.prefix}/jobs/{job.job_id}"
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.exception("An error occurred during file upload")
         raise HTTPException(
@@ -160,10 +221,36 @@ async def upload_file(
             detail=f"Error processing file: {str(e)}"
         )
     finally:
-        # Clean up the uploaded file
-        if 'file_path' in locals() and os.path.exists(file_path):
+        # Clean up the uploaded file if it was never queued
+        if file_path and os.path.exists(file_path):
             os.remove(file_path)
 
+@api_router.get("/jobs/{job_id}", response_model=Dict[str, Any])
+async def get_job(job_id: str):
+    """Report status and progress of an ingestion job"""
+    job = ingestion_manager.get(job_id)
+    if job is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Job {job_id} not found"
+        )
+    return job.to_dict()
+
+@api_router.delete("/jobs/{job_id}", response_model=Dict[str, Any])
+async def cancel_job(job_id: str):
+    """
+    Cancel an ingestion job
+    
+    Nothing from a cancelled job is kept, since its transaction is rolled back.
+    """
+    job = ingestion_manager.cancel(job_id)
+    if job is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Job {job_id} not found"
+        )
+    return job.to_dict()
+
 @api_router.post("/query/", response_model=Dict[str, Any])
 async def process_query(
     query: Dict[str, str],
@@ -208,6 +295,11 @@ async def chat_endpoint(
 ):
     """
     Handle chat requests from the UI with streaming support
+    
+    The answer is sent as server-sent events: one {"content": ...} event
+    per piece of the answer as the language model generates it, then one
+    {"done": true, ...} event with the metadata and timings, then [DONE].
+    When the client disconnects the OpenAI request is cancelled.
     """
     try:
         data = await request.json()
@@ -230,15 +322,24 @@ async def chat_endpoint(
         # Initialize query processor
         processor = QueryProcessor(db)
         
-        # Process the query (use the last user message as the query)
-        result = processor.process_query(last_message['content'])
+        # Answer the last user message, streamed as OpenAI generates it
+        events = processor.stream_query(last_message['content'])
         
-        # For streaming response
         async def generate():
-            # In a real implementation, you would stream the response
-            # For simplicity, we'll just return the full response
-            yield f"data: {json.dumps({'content': result['response']})}\n\n"
-            yield "data: [DONE]\n\n"
+            # Each event is pulled in a worker thread, since the database and OpenAI clients block
+            try:
+                while True:
+                    if await request.is_disconnected():
+                        logger.info("Chat client disconnected, cancelling the answer")
+                        return
+                    event = await run_in_threadpool(next, events, None)
+                    if event is None:
+                        break
+                    yield f"data: {json.dumps(event, default=str)}\n\n"
+                yield "data: [DONE]\n\n"
+            finally:
+                # Closes the OpenAI response of an unfinished answer, cancelling it upstream
+                events.close()
         
         return StreamingResponse(
             generate(),
@@ -254,6 +355,11 @@ async def chat_endpoint(
             detail=f"Error processing chat request: {str(e)}"
         )
 
+@api_router.get("/cache/stats", response_model=Dict[str, Any])
+async def cache_stats():
+    """Report size, hits, misses, evictions and invalidations of this worker's caches"""
+    return {"retrieval": retrieval_cache.stats(), "responses": response_cache.stats()}
+
 @api_router.get("/health")
 async def health_check():
     """Health check endpoint"""
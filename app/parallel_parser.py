@@ -0,0 +1,385 @@
+import io
+import json
+import mmap
+import multiprocessing
+import os
+import re
+import time
+from collections import deque
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Any, Generator, List, Optional, Tuple
+
+import orjson
+
+from .chunking import ArrayChunker, ChunkingPolicy, ChunkRecord, ItemSignature, item_signature
+from .resource_usage import peak_rss_mb
+
+# Regular expressions used to find item boundaries in a root JSON array
+# without decoding it. Strings are skipped whole so brackets inside them
+# are ignored; containers are matched up to MAX_NESTING levels deep in a
+# single regex call, deeper items fall back to bracket counting.
+MAX_NESTING = 4
+_STRING = rb'"[^"\\]*(?:\\.[^"\\]*)*"'
+_PLAIN = rb'[^"{}\[\]]*'
+_SCALAR = rb'(?:' + _STRING + rb'|[^\s,\[\]{}"]+)'
+
+
+def _nest(special: bytes) -> bytes:
+    """Match a container whose members are plain text or `special` tokens"""
+    body = _PLAIN + rb'(?:(?:' + special + rb')' + _PLAIN + rb')*'
+    return rb'(?:\{' + body + rb'\}|\[' + body + rb'\])'
+
+
+_CONTAINER = _nest(_STRING)
+for _ in range(MAX_NESTING - 1):
+    _CONTAINER = _nest(_STRING + rb'|' + _CONTAINER)
+_ITEM = rb'(?:' + _CONTAINER + rb'|' + _SCALAR + rb')'
+_ITEM_RE = re.compile(rb'\s*,?\s*' + _ITEM)
+_BRACKET_RE = re.compile(_PLAIN + rb'(?:' + _STRING + _PLAIN + rb')*([{}\[\]])')
+_ARRAY_START_RE = re.compile(rb'\s*\[')
+_ARRAY_END_RE = re.compile(rb'\s*\]\s*$')
+
+# A non-blank line of a JSON Lines file, with any blank lines before it
+_LINE = rb'(?:[ \t\r\f\v]*\n)*[ \t\r\f\v]*\S[^\n]*(?:\n|\Z)'
+_LINE_RE = re.compile(_LINE)
+
+# Decoded span: its nested chunks and its root chunks with their metadata,
+# the items of its last, still open root chunk, and the signatures of all
+# of its root items
+SpanResult = Tuple[List[Tuple[str, Any, Dict[str, Any]]], List[Tuple[str, Any, Dict[str, Any]]],
+                   List[Any], List[ItemSignature]]
+
+# Spans hold this many times max_items items, so the root chunk merged
+# across each span edge is a small share of the work
+SPAN_CHUNKS = 8
+
+# Workers are spawned rather than forked since ingestion runs on threads
+_MP_CONTEXT = multiprocessing.get_context('spawn')
+
+# Per-process JSON processor used for metadata extraction
+_span_processor = None
+
+
+def _loads(data: bytes) -> Any:
+    try:
+        return orjson.loads(data)
+    except orjson.JSONDecodeError:
+        # orjson rejects integers wider than 64 bits, the json module does not
+        return json.loads(data)
+
+
+def decode_lines(data: bytes) -> List[Any]:
+    """
+    Decode the non-blank lines of a JSON Lines fragment
+    
+    Lines in MongoDB shell notation are converted before decoding.
+    """
+    items = []
+    for line in data.splitlines():
+        if not line.strip():
+            continue
+        try:
+            items.append(_loads(line))
+        except ValueError:
+            from .json_processor import MongoJSONReader
+            items.append(_loads(MongoJSONReader(io.BytesIO(line)).read()))
+    return items
+
+
+def iter_line_spans(buf, max_lines: int) -> Generator[Tuple[int, int, int], None, None]:
+    """
+    Yield (start, end, line_count) byte spans of up to max_lines consecutive non-blank lines
+    
+    Spans always end on a line boundary, so each one can be decoded on its own.
+    
+    Args:
+        buf: Bytes-like view of the whole file, normally an mmap
+        max_lines: Lines per span
+    """
+    pos = 0
+    run_re = _line_run_re(max_lines)
+    while True:
+        # One regex call finds the end of a full span of lines
+        run = run_re.match(buf, pos)
+        if not run:
+            break
+        yield pos, run.end(), max_lines
+        pos = run.end()
+    
+    count = sum(1 for _ in _LINE_RE.finditer(buf, pos))
+    if count:
+        yield pos, len(buf), count
+
+
+@lru_cache(maxsize=8)
+def _line_run_re(chunk_size: int):
+    return re.compile(rb'(?:' + _LINE + rb'){%d}' % chunk_size)
+
+
+def _decode_span(file_path: str, start: int, end: int, chunk_type: str, policy: Dict[str, Any],
+                 json_lines: bool = False, offset: int = 0) -> SpanResult:
+    """
+    Decode the items stored at [start, end) of a file into chunks with metadata
+    
+    Runs inside a pool worker; only offsets cross the process boundary on
+    the way in, and the decoded chunks with their metadata on the way out.
+    
+    The span's items are grouped into root chunks as if a chunk started
+    at the span; the caller re-groups the items up to the point where
+    that matches the chunks carried over from earlier spans. The items of
+    the last chunk are returned unclosed, and the signatures of all items
+    are returned for that merge.
+    """
+    global _span_processor
+    if _span_processor is None or _span_processor.policy.to_dict() != policy:
+        from .json_processor import JSONProcessor
+        _span_processor = JSONProcessor(policy=ChunkingPolicy.from_dict(policy))
+    
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    if json_lines:
+        items = decode_lines(data)
+    else:
+        items = _loads(b'[' + data + b']')
+    
+    *records, (_, items, _) = _span_processor.split_items(items, offset, chunk_type)
+    signatures = [item_signature(item) for item in items]
+    chunker = ArrayChunker(_span_processor.policy, '', None, chunk_type)
+    chunker.skip(offset)
+    root_records = []
+    for item, signature in zip(items, signatures):
+        root_records.extend(chunker.add(item, signature))
+    tail = items[len(items) - chunker.pending:]
+    return (_with_metadata(_span_processor, records), _with_metadata(_span_processor, root_records),
+            tail, signatures)
+
+
+def _with_metadata(processor, records: List[ChunkRecord]) -> List[Tuple[str, Any, Dict[str, Any]]]:
+    """Extract the metadata of chunk records"""
+    chunks = []
+    for record_type, chunk, info in records:
+        metadata = processor.extract_metadata(chunk, record_type)
+        metadata.update(info)
+        chunks.append((record_type, chunk, metadata))
+    return chunks
+
+
+class ParallelChunkParser:
+    """
+    Splits a root JSON array or a JSON Lines file into chunks decoded by a
+    process pool
+    """
+    
+    def __init__(self, chunk_size: int = 1000, workers: int = 0, max_pending: Optional[int] = None,
+                 json_lines: bool = False, policy: Optional[ChunkingPolicy] = None):
+        """
+        Initialize the parallel parser
+        
+        Args:
+            chunk_size: Maximum number of items per chunk
+            workers: Number of worker processes (defaults to the CPU count);
+                with one worker chunks are decoded in the calling process
+            max_pending: Maximum number of spans queued or held by workers
+                at once; bounds memory when the consumer is slower than the
+                workers (defaults to twice the worker count)
+            json_lines: Treat the file as newline-delimited JSON
+            policy: Chunking policy; overrides chunk_size when given. Limits
+                and content-defined boundaries apply to the serialized items
+                after nested arrays are split out, as in the sequential
+                parser, so the chunks do not depend on the number of workers
+                or on the file's whitespace
+        """
+        self.policy = policy or ChunkingPolicy(max_items=chunk_size)
+        self.chunk_size = self.policy.max_items
+        self.span_items = self.chunk_size * SPAN_CHUNKS
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending or 2 * self.workers
+        self.json_lines = json_lines
+        self._root_processor = None
+        self._run_re = re.compile(
+            rb'\s*,?\s*' + _ITEM + rb'(?:\s*,\s*' + _ITEM + rb'){%d}' % (self.span_items - 1)
+        )
+    
+    @staticmethod
+    def is_root_array(file_path: str) -> bool:
+        """Check whether a file holds a JSON array at its root"""
+        with open(file_path, 'rb') as f:
+            head = f.read(4096)
+        return _ARRAY_START_RE.match(head) is not None
+    
+    def iter_spans(self, buf) -> Generator[Tuple[int, int, int], None, None]:
+        """
+        Yield (start, end, item_count) byte spans of up to span_items consecutive items
+        
+        Args:
+            buf: Bytes-like view of the whole file, normally an mmap
+        """
+        match = _ARRAY_START_RE.match(buf)
+        if not match:
+            raise ValueError("File does not contain a JSON array at its root")
+        pos = match.end()
+        
+        while True:
+            start = None
+            count = 0
+            # Fast path: a full span of shallow items in one match
+            run = self._run_re.match(buf, pos)
+            if run:
+                start = self._skip_separator(buf, pos)
+                pos = run.end()
+                count = self.span_items
+            exhausted = False
+            while count < self.span_items:
+                item_end = self._match_item(buf, pos)
+                if item_end is None:
+                    exhausted = True
+                    break
+                if start is None:
+                    start = self._skip_separator(buf, pos)
+                pos = item_end
+                count += 1
+            if count:
+                yield start, pos, count
+            if exhausted:
+                break
+        
+        if not _ARRAY_END_RE.match(buf, pos):
+            raise ValueError(f"Malformed JSON array near byte {pos}")
+    
+    def _skip_separator(self, buf, pos: int) -> int:
+        """Return the offset of the first item byte after pos"""
+        while buf[pos:pos + 1] in (b' ', b'\t', b'\n', b'\r', b','):
+            pos += 1
+        return pos
+    
+    def _match_item(self, buf, pos: int) -> Optional[int]:
+        """Return the end offset of the item after pos, or None at the end of the array"""
+        match = _ITEM_RE.match(buf, pos)
+        if match:
+            return match.end()
+        
+        # Deeply nested item: count brackets until they balance
+        pos = self._skip_separator(buf, pos)
+        if buf[pos:pos + 1] not in (b'{', b'['):
+            return None
+        depth = 0
+        for bracket in _BRACKET_RE.finditer(buf, pos):
+            depth += 1 if bracket.group(1) in (b'{', b'[') else -1
+            if depth == 0:
+                return bracket.end()
+        raise ValueError(f"Unterminated JSON value starting at byte {pos}")
+    
+    def stream_file(self, file_path: str, stats: Optional[Dict[str, Any]] = None) -> Generator[Tuple[str, Any, Dict[str, Any]], None, None]:
+        """
+        Decode a file in parallel and yield chunks in file order
+        
+        Args:
+            file_path: Path to a JSON file whose root is an array, or to a
+                JSON Lines file
+            stats: Optional dictionary filled with throughput statistics
+        
+        Yields:
+            Tuple of (chunk_type, chunk_data, metadata)
+        """
+        if stats is None:
+            stats = {}
+        started = time.perf_counter()
+        bytes_read = 0
+        pending = deque()
+        executor = None
+        try:
+            if os.path.getsize(file_path) == 0:
+                if self.json_lines:
+                    return
+                raise ValueError("File is empty")
+            
+            with open(file_path, 'rb') as f, \
+                    mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                offset = 0
+                if self.json_lines:
+                    spans = iter_line_spans(buf, self.span_items)
+                else:
+                    spans = self.iter_spans(buf)
+                # Groups the items at span edges into root chunks
+                root = ArrayChunker(self.policy, '', None, 'root_chunk')
+                if self.workers > 1:
+                    executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=_MP_CONTEXT)
+                
+                for start, end, count in spans:
+                    args = (file_path, start, end, 'root_chunk', self.policy.to_dict(), self.json_lines, offset)
+                    offset += count
+                    if executor is None:
+                        span = _decode_span(*args)
+                        stats['bytes_read'] = bytes_read = end
+                        yield from self._emit_span(span, root)
+                        continue
+                    
+                    pending.append((end, executor.submit(_decode_span, *args)))
+                    # Backpressure: wait for the oldest chunk before queueing more
+                    while len(pending) >= self.max_pending:
+                        bytes_read = yield from self._emit(pending, stats, root)
+                while pending:
+                    bytes_read = yield from self._emit(pending, stats, root)
+                records, _ = root.finish()
+                yield from _with_metadata(self._processor, records)
+        finally:
+            for _, future in pending:
+                future.cancel()
+            if executor is not None:
+                executor.shutdown(wait=True)
+            elapsed = time.perf_counter() - started
+            stats.update({
+                'bytes_read': bytes_read,
+                'elapsed_seconds': round(elapsed, 4),
+                'bytes_per_sec': round(bytes_read / elapsed, 2) if elapsed > 0 else None,
+                'peak_rss_mb': peak_rss_mb(),
+                'parse_workers': self.workers
+            })
+    
+    def _emit(self, pending: deque, stats: Dict[str, Any],
+              root: ArrayChunker) -> Generator[Tuple[str, Any, Dict[str, Any]], None, int]:
+        end, future = pending.popleft()
+        span = future.result()
+        stats['bytes_read'] = end
+        yield from self._emit_span(span, root)
+        return end
+
+    def _emit_span(self, span: SpanResult, root: ArrayChunker) -> Generator[Tuple[str, Any, Dict[str, Any]], None, None]:
+        """
+        Yield the chunks of a decoded span
+        
+        The worker grouped the span's items as if a chunk started at the
+        span. Its root chunks are re-grouped here, together with the items
+        carried over from earlier spans, until the chunk open in root is
+        one the worker built too; from there on the worker's chunks stand.
+        """
+        nested, chunks, tail, signatures = span
+        yield from nested
+        index = 0
+        position = 0
+        while index < len(chunks) and root.pending:
+            chunk = chunks[index][1]
+            for item, signature in zip(chunk, signatures[position:]):
+                yield from _with_metadata(self._processor, root.add(item, signature))
+            position += len(chunk)
+            if root.pending == len(chunk):
+                # The open chunk holds the same items as the worker's chunk
+                break
+            index += 1
+        
+        adopted = chunks[index:]
+        if adopted:
+            root.skip(sum(len(chunk) for _, chunk, _ in adopted))
+            yield from adopted
+        for item, signature in zip(tail, signatures[len(signatures) - len(tail):]):
+            yield from _with_metadata(self._processor, root.add(item, signature))
+    
+    @property
+    def _processor(self):
+        """JSON processor extracting the metadata of root chunks in this process"""
+        if self._root_processor is None:
+            from .json_processor import JSONProcessor
+            self._root_processor = JSONProcessor(policy=self.policy)
+        return self._root_processor
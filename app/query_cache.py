@@ -0,0 +1,80 @@
+import re
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+_SPACE_RE = re.compile(r'\s+')
+
+
+def normalize_query(query: str) -> str:
+    """Lowercase a query and collapse its whitespace, so trivially different spellings share a cache entry"""
+    return _SPACE_RE.sub(' ', query).strip().lower()
+
+
+class QueryCache:
+    """
+    Bounded LRU cache of results computed against one data generation
+    
+    Every entry belongs to the generation it was computed against. The
+    first lookup with a different generation drops all entries, so results
+    never outlive the data they were computed from and no manual flush is
+    needed. Safe to share between threads.
+    """
+    
+    def __init__(self, max_entries: int):
+        """
+        Args:
+            max_entries: Most entries kept; the least recently used is
+                evicted beyond it, and 0 disables the cache
+        """
+        self.max_entries = max_entries
+        self._entries: 'OrderedDict[Hashable, Any]' = OrderedDict()
+        self._generation: Optional[Hashable] = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+    
+    def get(self, key: Hashable, generation: Hashable) -> Optional[Any]:
+        """Return the value cached for key under generation, or None"""
+        with self._lock:
+            if generation != self._generation:
+                if self._entries:
+                    self.invalidations += 1
+                    self._entries.clear()
+                self._generation = generation
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+    
+    def put(self, key: Hashable, generation: Hashable, value: Any):
+        """Cache a value computed against generation; values of an outdated generation are dropped"""
+        if self.max_entries <= 0 or value is None:
+            return
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+    
+    def stats(self) -> Dict[str, Any]:
+        """Return the size and hit, miss, eviction and invalidation counts of the cache"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations
+            }
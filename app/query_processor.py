@@ -1,18 +1,105 @@
-from typing import Dict, Any, List, Optional, Tuple
+from typing import Dict, Any, Iterator, List, Optional, Set, Tuple
 import re
+import time
 from datetime import datetime, timedelta
 from sqlalchemy.orm import Session
-from sqlalchemy import or_, String
+from sqlalchemy import func, or_
+from sqlalchemy.dialects.postgresql import Range
 import json
 from openai import OpenAI
 import os
 from dotenv import load_dotenv
 
+from .bm25_index import get_bm25_index
+from .embeddings import HashingEmbedder
+from .context_builder import build_context, count_tokens, query_terms
+from .query_cache import QueryCache, normalize_query
+from .reranker import reranker
+from .response_cache import context_hash, response_cache
+from .rollups import merge_stats, summarize
+
 # Load environment variables
 load_dotenv()
 
+# Words that mark an aggregate question, and the rollup statistic they ask for
+AGGREGATE_OPERATIONS = {
+    'average': 'mean',
+    'mean': 'mean',
+    'total': 'sum',
+    'sum': 'sum',
+    'count': 'count',
+    'how many': 'count',
+    'minimum': 'min',
+    'lowest': 'min',
+    'maximum': 'max',
+    'highest': 'max'
+}
+AGGREGATE_LABELS = {'mean': 'average', 'sum': 'total', 'min': 'minimum', 'max': 'maximum'}
+
+# Groups listed in the answer to a grouped aggregate; all are kept in metadata
+AGGREGATE_GROUPS_SHOWN = 20
+
+# Most records fetched by a simple lookup, and how many are shown in the answer
+LOOKUP_LIMIT = 20
+LOOKUP_RECORDS_SHOWN = 3
+# Words that label the value after them as an identifier, e.g. 'id 17'
+LOOKUP_KEYWORDS = frozenset({'id', 'uuid', 'key', 'code', 'ref', 'reference', 'sku'})
+# Tokens allowed between a label and its value, e.g. 'patient #12345', 'order number ABC'
+LOOKUP_CONNECTORS = frozenset({'#', ':', '=', 'no', 'number', 'is'})
+_QUOTED_RE = re.compile(r'"([^"]+)"|\'([^\']+)\'')
+_CODE_RE = re.compile(r'[a-z]')
+_DIGIT_RE = re.compile(r'\d')
+_ORDINAL_RE = re.compile(r'\d+(?:st|nd|rd|th)')
+
+# ts_rank_cd normalization: 1 divides the rank by 1 + log(document length),
+# so large chunks do not win just by holding more words
+SEARCH_RANK_NORMALIZATION = 1
+
+# Lowest trigram similarity of a vocabulary word taken as a spelling of a
+# query word; 0.25 still pairs swapped letters in short names ('jonh', 'john')
+FUZZY_SIMILARITY_THRESHOLD = float(os.getenv("FUZZY_SIMILARITY_THRESHOLD", "0.25"))
+# Vocabulary words tried per misspelled query word
+FUZZY_MATCHES_PER_WORD = 2
+
+# Candidates taken from each retriever and re-ranked, and the rank offset
+# of reciprocal rank fusion
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", "50"))
+RRF_K = 60
+# Latency budgets of the candidate and re-ranking stages of retrieval;
+# retrievers started after the first budget is spent are skipped
+CANDIDATE_BUDGET_MS = float(os.getenv("CANDIDATE_BUDGET_MS", "300"))
+RERANK_BUDGET_MS = float(os.getenv("RERANK_BUDGET_MS", "200"))
 
+# OpenAI model answering the questions that are not answered directly
+CHAT_MODEL = "gpt-3.5-turbo"
 
+# Records shown from each sampled chunk of a date query
+DATE_SAMPLE_ITEMS = 5
+
+# Items sent from a retrieved chunk none of whose items hold a query term
+ITEM_SAMPLE = int(os.getenv("ITEM_SAMPLE", "10"))
+
+# Levels of parent chunks added to the context of each retrieved chunk
+PARENT_CONTEXT_DEPTH = int(os.getenv("PARENT_CONTEXT_DEPTH", "1"))
+
+# Retrievals cached per process; 0 disables the cache
+RETRIEVAL_CACHE_SIZE = int(os.getenv("RETRIEVAL_CACHE_SIZE", "512"))
+retrieval_cache = QueryCache(RETRIEVAL_CACHE_SIZE)
+
+
+def reciprocal_rank_fusion(rankings: List[List[Any]], k: int = RRF_K) -> List[Any]:
+    """
+    Merge rankings by reciprocal rank fusion
+    
+    Each item scores the sum of 1 / (k + rank) over the rankings it appears
+    in, so items ranked well by several retrievers come first without
+    having to compare their raw scores.
+    """
+    scores: Dict[Any, float] = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, start=1):
+            scores[item] = scores.get(item, 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=scores.get, reverse=True)
 
 
 class QueryProcessor:
@@ -29,6 +116,9 @@ class QueryProcessor:
         self.client = OpenAI(
             api_key=os.getenv("OPENAI_API_KEY")
         )
+        self.embedder = HashingEmbedder()
+        # Stage counts and timings of the last retrieval
+        self.retrieval_stats: Dict[str, Any] = {}
         self.direct_query_handlers = {
             'date_query': self._handle_date_query,
             'aggregate_query': self._handle_aggregate_query,
@@ -69,14 +159,17 @@ class QueryProcessor:
         """
         # Try to extract date information
         date_match = self._extract_date_info(query)
+        
+        # Try to handle as an aggregate query, optionally over a period
+        if self._aggregate_operation(query.lower()):
+            result = self._handle_aggregate_query(query, date_match)
+            if result['is_direct']:
+                return result
+        
         if date_match:
             date_field, date_value = date_match
             return self._handle_date_query(query, date_field, date_value)
         
-        # Try to handle as an aggregate query
-        if any(word in query.lower() for word in ['average', 'total', 'sum', 'count', 'minimum', 'maximum']):
-            return self._handle_aggregate_query(query)
-        
         # Try simple lookup
         return self._handle_simple_lookup(query)
     
@@ -179,38 +272,51 @@ class QueryProcessor:
         }
     
     def _handle_date_query(self, query: str, date_field: str, date_value: any) -> Dict[str, Any]:
-        """Handle queries with date filters by querying the database."""
-        from .database import JSONChunk
+        """
+        Handle queries with date filters by querying the database.
+        
+        The requested day or period is matched against each chunk's indexed
+        date_span, so only chunks whose date range overlaps it are read.
+        """
+        from .database import JSONChunk, period_item_path, project_items
 
         results = []
-        try:
-            if date_field == 'date':
-                # Use the ->> operator to extract date fields as text for comparison
-                results = self.db.query(JSONChunk).filter(
-                    or_(
-                        JSONChunk.metadata_.op('->>')('created_at').like(f"{date_value}%"),
-                        JSONChunk.metadata_.op('->>')('date').like(f"{date_value}%")
-                    )
+        period = None
+        if date_field == 'date':
+            day = self._parse_query_date(date_value)
+            if day:
+                period = (day, day + timedelta(days=1))
+        elif date_field == 'date_range' and isinstance(date_value, dict):
+            start_date = self._parse_query_date(date_value.get('start'))
+            end_date = self._parse_query_date(date_value.get('end'))
+            if start_date and end_date:
+                period = (start_date, end_date + timedelta(days=1))
+
+        if period:
+            try:
+                # Index range scan on the GiST index over date_span; content is projected below
+                results = self.db.query(JSONChunk.id, JSONChunk.metadata_).filter(
+                    JSONChunk.deleted_at.is_(None),
+                    JSONChunk.date_span.overlaps(Range(*period, bounds='[)'))
                 ).limit(10).all()
-            elif date_field == 'date_range' and isinstance(date_value, dict):
-                start_date = date_value.get('start')
-                end_date = date_value.get('end')
-                if start_date and end_date:
-                    results = self.db.query(JSONChunk).filter(
-                        or_(
-                            JSONChunk.metadata_.op('->>')('created_at').between(start_date, end_date),
-                            JSONChunk.metadata_.op('->>')('date').between(start_date, end_date)
-                        )
-                    ).limit(10).all()
-        except Exception:
-            # If the query fails (e.g., key doesn't exist), fall back to complex query handler
-            pass
+            except Exception:
+                # If the query fails, fall back to complex query handler
+                self.db.rollback()
 
         if not results:
             return {'is_direct': False, 'response': None}
 
         response_text = f"Found {len(results)} records for the period {date_value}."
-        sample_content = [res.content for res in results[:2]]
+        # Only the records of the period are fetched from the sampled chunks
+        sample_content = []
+        variables = {'start': period[0].strftime('%Y-%m-%d'), 'end': period[1].strftime('%Y-%m-%d')}
+        for res in results[:2]:
+            record_date_field = ((res.metadata_ or {}).get('date_range') or {}).get('field')
+            paths = [period_item_path(record_date_field)] if record_date_field else []
+            projected = project_items(self.db, [res.id], paths, variables, sample=DATE_SAMPLE_ITEMS)
+            if res.id in projected:
+                content = projected[res.id]['content']
+                sample_content.append(content[:DATE_SAMPLE_ITEMS] if isinstance(content, list) else content)
 
         return {
             'is_direct': True,
@@ -224,26 +330,480 @@ class QueryProcessor:
             }
         }
     
-    def _handle_aggregate_query(self, query: str) -> Dict[str, Any]:
+    def _parse_query_date(self, value: Optional[str]) -> Optional[datetime]:
+        """Parse a date taken from a query, e.g. '2025-05-01' or 'may 1st, 2025'"""
+        if not value:
+            return None
+        value = re.sub(r'(\d)(?:st|nd|rd|th)\b', r'\1', value.strip())
+        value = re.sub(r'\s*,\s*', ' ', value)
+        for date_format in ('%Y-%m-%d', '%B %d %Y', '%b %d %Y'):
+            try:
+                return datetime.strptime(value, date_format)
+            except ValueError:
+                continue
+        for date_format in ('%B %d', '%b %d'):
+            try:
+                # No year given: assume the current one
+                return datetime.strptime(f"{value} {datetime.now().year}", f"{date_format} %Y")
+            except ValueError:
+                continue
+        return None
+    
+    def _handle_aggregate_query(self, query: str, date_info: Optional[Tuple[str, Any]] = None) -> Dict[str, Any]:
         """
         Handle aggregate queries (sum, average, count, etc.).
-        Currently, this falls back to the complex query handler.
+        
+        Ungrouped questions about a rolled-up field are answered from the
+        day/week/month rollups kept in PrecomputedAggregate at ingest. Other
+        questions, e.g. 'average glucose per patient_id last month', are
+        compiled into a single SQL aggregate over the records of every
+        matching chunk, so the answer is exact instead of being worked out by
+        the language model from a few retrieved chunks.
+        
+        Args:
+            query: User's natural language query
+            date_info: (date_field, date_value) extracted from the query, if any
+        """
+        started = time.perf_counter()
+        lowered = query.lower()
+        operation = self._aggregate_operation(lowered)
+        period = self._aggregate_period(date_info)
+        if not operation or period is False:
+            return {'is_direct': False, 'response': None}
+
+        metric_text, group_text = self._split_grouping(lowered)
+        result = None
+        if group_text is None:
+            result = self._rollup_aggregate(metric_text, operation, period)
+        if result is None:
+            result = self._sql_aggregate(metric_text, group_text, operation, period)
+        if result is None:
+            return {'is_direct': False, 'response': None}
+        
+        result['metadata']['elapsed_ms'] = round((time.perf_counter() - started) * 1000, 2)
+        return result
+    
+    def _aggregate_period(self, date_info: Optional[Tuple[str, Any]]):
+        """
+        Turn extracted date information into the inclusive (first, last) day
+        of an aggregate, None when the query names no period, or False when
+        the period cannot be parsed
         """
-        # For now, we let the language model handle all aggregations.
-        # A more advanced implementation could parse the query and build a SQL query.
+        if not date_info:
+            return None
+        date_field, date_value = date_info
+        if date_field == 'date':
+            start = end = self._parse_query_date(date_value)
+        elif date_field == 'date_range' and isinstance(date_value, dict):
+            start = self._parse_query_date(date_value.get('start'))
+            end = self._parse_query_date(date_value.get('end'))
+        else:
+            start = end = None
+        if not start or not end:
+            return False
+        return start, end
+    
+    def _split_grouping(self, lowered_query: str) -> Tuple[str, Optional[str]]:
+        """Split 'average glucose per patient' into the metric text and the grouping text"""
+        match = re.search(r'\s(?:grouped by|group by|broken down by|for each|by|per)\s+(.+)$', lowered_query)
+        if not match:
+            return lowered_query, None
+        return lowered_query[:match.start()], match.group(1)
+    
+    def _rollup_aggregate(self, lowered_query: str, operation: str, period) -> Optional[Dict[str, Any]]:
+        """
+        Answer an ungrouped aggregate from the rollups, or return None
+        
+        Rollups only cover records with a date, so a question about all
+        records is only answered from them when they hold every value of
+        the field.
+        """
+        from .database import PrecomputedAggregate, count_field_values
+        
+        names = [name for (name,) in self.db.query(PrecomputedAggregate.name).distinct()]
+        field = self._match_field(lowered_query, names)
+        if not field:
+            return None
+        
+        rows = self.db.query(PrecomputedAggregate).filter(PrecomputedAggregate.name == field)
+        if period:
+            start, end = period
+            rows = rows.filter(
+                PrecomputedAggregate.period == 'day',
+                PrecomputedAggregate.key.between(start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d'))
+            )
+        else:
+            # Month rollups are the fewest rows covering everything
+            rows = rows.filter(PrecomputedAggregate.period == 'month')
+
+        total = None
+        source_files = set()
+        for row in rows:
+            value = row.value
+            total = merge_stats(total, [value['count'], value['sum'], value['min'], value['max']])
+            source_files.add(row.source_file)
+        if not total or not total[0]:
+            return None
+        if not period and count_field_values(self.db, field) != total[0]:
+            # Some values belong to undated records, or are not numbers
+            return None
+
+        summary = summarize(total)
+        period_text = self._period_text(period)
         return {
-            'is_direct': False,
-            'response': None
+            'is_direct': True,
+            'response': self._describe_aggregate(operation, field, period_text, summary),
+            'metadata': {
+                'query_type': 'aggregate_query',
+                'source': 'rollups',
+                'field': field,
+                'operation': operation,
+                'period': period_text,
+                'result': summary[operation],
+                'aggregate': summary,
+                'source_files': sorted(source_files)
+            }
         }
     
+    def _sql_aggregate(self, lowered_query: str, group_text: Optional[str], operation: str,
+                       period) -> Optional[Dict[str, Any]]:
+        """Answer an aggregate with one SQL query over all matching records, or return None"""
+        from .aggregation import GROUP_PERIODS, MAX_GROUPS, run_aggregate
+        from .database import get_date_field, get_stats_fields
+        
+        fields = get_stats_fields(self.db)
+        field = self._match_field(lowered_query, fields)
+        if not field and operation != 'count':
+            return None
+        
+        group_field = group_period = None
+        if group_text:
+            period_match = re.match(r'(year|month|week|day)\b', group_text)
+            if period_match and period_match.group(1) in GROUP_PERIODS:
+                group_period = period_match.group(1)
+            else:
+                group_field = self._match_field(group_text, fields)
+                if not group_field:
+                    return None
+        
+        date_field = None
+        if period or group_period:
+            date_field = get_date_field(self.db)
+            if not date_field:
+                return None
+        start, end = period or (None, None)
+        
+        try:
+            aggregate = run_aggregate(
+                self.db, field,
+                date_field=date_field,
+                start=start,
+                end=end + timedelta(days=1) if end else None,
+                group_field=group_field,
+                group_period=group_period
+            )
+        except Exception:
+            self.db.rollback()
+            return None
+        
+        groups = [group for group in aggregate['groups'] if group['count']]
+        if not groups or (field and operation != 'count' and groups[0][operation] is None):
+            return None
+        
+        label = field or 'records'
+        period_text = self._period_text(period)
+        metadata = {
+            'query_type': 'aggregate_query',
+            'source': 'sql',
+            'field': field,
+            'operation': operation,
+            'period': period_text,
+            'date_field': date_field,
+            'sql_ms': aggregate['elapsed_ms']
+        }
+        if group_text is None:
+            summary = groups[0]
+            summary.pop('group')
+            response_text = self._describe_aggregate(operation, label, period_text, summary)
+            metadata.update({'result': summary[operation], 'aggregate': summary})
+        else:
+            grouping = group_field or group_period
+            lines = [f"The {AGGREGATE_LABELS.get(operation, 'number of')} {label} by {grouping} {period_text}:"]
+            for group in groups[:AGGREGATE_GROUPS_SHOWN]:
+                lines.append(f"- {group['group']}: {self._format_number(group[operation])} (from {group['count']} values)")
+            if len(groups) > AGGREGATE_GROUPS_SHOWN:
+                lines.append(f"... and {len(groups) - AGGREGATE_GROUPS_SHOWN} more groups")
+            if aggregate['truncated']:
+                lines.append(f"Only the first {MAX_GROUPS} groups by {grouping} were computed; the result is truncated.")
+            response_text = '\n'.join(lines)
+            metadata.update({'group_by': grouping, 'groups': groups, 'truncated': aggregate['truncated']})
+        
+        return {'is_direct': True, 'response': response_text, 'metadata': metadata}
+    
+    def _period_text(self, period) -> str:
+        """Describe the period of an aggregate"""
+        if not period:
+            return 'across all data'
+        start, end = period
+        return f"on {start:%Y-%m-%d}" if start == end else f"from {start:%Y-%m-%d} to {end:%Y-%m-%d}"
+    
+    def _describe_aggregate(self, operation: str, field: str, period_text: str, summary: Dict[str, Any]) -> str:
+        """Phrase an aggregate result as an answer"""
+        result = self._format_number(summary[operation])
+        if operation == 'count':
+            return f"There are {result} {field} {period_text}." if field == 'records' else \
+                f"There are {result} {field} values {period_text}."
+        label = AGGREGATE_LABELS[operation]
+        return f"The {label} {field} {period_text} is {result} (from {summary['count']} values)."
+    
+    def _format_number(self, value: Any) -> str:
+        """Format an aggregate with thousands separators and at most three decimals"""
+        return f"{value:,.3f}".rstrip('0').rstrip('.')
+    
+    def _aggregate_operation(self, lowered_query: str) -> Optional[str]:
+        """Return the rollup statistic asked for by an aggregate question"""
+        for word, operation in AGGREGATE_OPERATIONS.items():
+            if re.search(rf'\b{word}\b', lowered_query):
+                return operation
+        return None
+    
+    def _match_field(self, lowered_query: str, names: List[str]) -> Optional[str]:
+        """
+        Find the field named in the query, preferring the longest name
+
+        A dotted field also matches by its last segment, and a field ending
+        in '_id' without that suffix ('patient' for 'patient_id').
+        """
+        normalized = re.sub(r'[_.]', ' ', lowered_query)
+        best = None
+        for name in names:
+            last = name.rsplit('.', 1)[-1]
+            for phrase in {name, last, re.sub(r'_id$', '', last)}:
+                phrase = re.sub(r'[_.]', ' ', phrase.lower()).strip()
+                if phrase and re.search(rf'\b{re.escape(phrase)}\b', normalized) and (best is None or len(phrase) > best[0]):
+                    best = (len(phrase), name)
+        return best[1] if best else None
+    
     def _handle_simple_lookup(self, query: str) -> Dict[str, Any]:
-        """Handle simple lookup queries"""
-        # This is a simplified example - actual implementation would query the database
+        """
+        Handle simple lookups such as 'show patient 12345' or 'status of order ABC'
+        
+        Values named in the query are probed in the lookup index built at
+        ingest (id-like and categorical fields), and the matching records
+        are read straight out of their chunks. Matches on a field the query
+        mentions, e.g. 'patient' for patient_id, are preferred.
+        
+        A match is only answered directly when the query asks for it as a
+        lookup (see _is_named_lookup), so numbers such as the 10 of 'top 10
+        patients' are left to retrieval and the language model.
+        """
+        from .database import lookup_field_values
+        from .value_index import normalize_lookup_value
+
+        candidates = self._lookup_candidates(query)
+        if not candidates:
+            return {'is_direct': False, 'response': None}
+        try:
+            # One record over the limit tells whether the results were cut off
+            matches = lookup_field_values(self.db, candidates, limit=LOOKUP_LIMIT + 1)
+        except Exception:
+            self.db.rollback()
+            return {'is_direct': False, 'response': None}
+        truncated = len(matches) > LOOKUP_LIMIT
+        quoted = {normalize_lookup_value(a or b) for a, b in _QUOTED_RE.findall(query)}
+        labels = self._lookup_labels(query)
+        matches = [match for match in matches[:LOOKUP_LIMIT] if self._is_named_lookup(match, quoted, labels)]
+        if not matches:
+            return {'is_direct': False, 'response': None}
+
+        field = self._match_field(query.lower(), sorted({match['field'] for match in matches}))
+        if field:
+            matches = [match for match in matches if match['field'] == field]
+
+        first = matches[0]
+        if len(matches) == 1:
+            response_text = f"Found the record with {first['field']} = {first['value']}:"
+        else:
+            response_text = f"Found {len(matches)} records matching {', '.join(sorted({m['value'] for m in matches}))}:"
+        if truncated:
+            response_text = response_text[:-1] + f" (results were truncated at {LOOKUP_LIMIT} records; there may be more):"
+        shown = [json.dumps(match['item'], ensure_ascii=False, default=str) for match in matches[:LOOKUP_RECORDS_SHOWN]]
+        response_text += '\n' + '\n'.join(f"```json\n{record}\n```" for record in shown)
+        if len(matches) > LOOKUP_RECORDS_SHOWN:
+            response_text += f"\n... and {len(matches) - LOOKUP_RECORDS_SHOWN} more records"
+
         return {
-            'is_direct': False,
-            'response': None
+            'is_direct': True,
+            'response': response_text,
+            'metadata': {
+                'query_type': 'simple_lookup',
+                'field': field,
+                'values': candidates,
+                'results_count': len(matches),
+                'truncated': truncated,
+                'matches': [
+                    {key: match[key] for key in ('field', 'value', 'chunk_id', 'item_offset', 'source_file')}
+                    for match in matches
+                ]
+            }
         }
     
+    def _lookup_candidates(self, query: str) -> List[str]:
+        """
+        Extract the values a lookup query may be asking for
+        
+        Quoted strings, tokens containing a digit ('12345', 'ord-7') and
+        upper-case codes ('ABC') are taken, normalized like indexed values.
+        """
+        from .value_index import normalize_lookup_value
+
+        values = [a or b for a, b in _QUOTED_RE.findall(query)]
+        for token in re.findall(r'[A-Za-z0-9][\w\-]*', _QUOTED_RE.sub(' ', query)):
+            if any(char.isdigit() for char in token) or (len(token) > 1 and token.isupper()):
+                values.append(token)
+        candidates = []
+        for value in values:
+            value = normalize_lookup_value(value)
+            if value and value not in candidates:
+                candidates.append(value)
+        return candidates
+    
+    def _lookup_labels(self, query: str) -> Dict[str, Set[str]]:
+        """
+        Map each unquoted value of a query to the words right before it
+        
+        Connectors such as '#' or 'number' are skipped, so 'patient #12345'
+        and 'order number ABC' label their values 'patient' and 'order'.
+        """
+        from .value_index import normalize_lookup_value
+
+        tokens = re.findall(r'[\w\-]+|[#:=]', _QUOTED_RE.sub(' ', query).lower())
+        labels: Dict[str, Set[str]] = {}
+        for position, token in enumerate(tokens):
+            value = normalize_lookup_value(token)
+            before = position - 1
+            while before >= 0 and tokens[before] in LOOKUP_CONNECTORS:
+                before -= 1
+            if value and before >= 0:
+                labels.setdefault(value, set()).add(tokens[before])
+        return labels
+    
+    def _is_named_lookup(self, match: Dict[str, Any], quoted: Set[str], labels: Dict[str, Set[str]]) -> bool:
+        """
+        Check whether the query asks for a matched value as a lookup
+        
+        The value must be quoted, be a code mixing letters and digits
+        ('ord-7'), or be labelled by an identifier keyword ('id 17'), by the
+        matched field ('patient 12345' for patient_id) or by the kind of
+        record its file holds ('order ABC' in orders.json).
+        """
+        value = match['value']
+        if value in quoted or (_CODE_RE.search(value) and _DIGIT_RE.search(value) and not _ORDINAL_RE.fullmatch(value)):
+            return True
+        stem = os.path.splitext(os.path.basename(match['source_file'] or ''))[0].lower()
+        record_words = {word.rstrip('s') for word in re.findall(r'[a-z]+', stem)}
+        for label in labels.get(value, ()):
+            if label in LOOKUP_KEYWORDS or label.rstrip('s') in record_words \
+                    or self._match_field(label, [match['field']]):
+                return True
+        return False
+    
+    def stream_query(self, query: str) -> Iterator[Dict[str, Any]]:
+        """
+        Process a user query like process_query, yielding the answer as it is generated
+        
+        The language model is called with streaming, so each delta is yielded
+        as soon as OpenAI sends it. Closing the generator closes the OpenAI
+        response, which cancels the generation upstream; an answer that was
+        not finished is not cached.
+        
+        Args:
+            query: User's natural language query
+        
+        Yields:
+            {'content': text} events with the pieces of the answer, then one
+            final {'done': True, 'is_direct', 'metadata', 'timings'} event
+            with 'error' added when the query failed
+        """
+        started = time.perf_counter()
+        
+        def elapsed_ms() -> float:
+            return round((time.perf_counter() - started) * 1000, 2)
+        
+        direct_result = self._try_direct_query(query)
+        if direct_result['is_direct']:
+            yield {'content': direct_result['response']}
+            yield {
+                'done': True,
+                'is_direct': True,
+                'metadata': direct_result.get('metadata', {}),
+                'timings': {'first_token_ms': elapsed_ms(), 'total_ms': elapsed_ms()}
+            }
+            return
+        
+        timings: Dict[str, Any] = {}
+        metadata: Dict[str, Any] = {'model': CHAT_MODEL}
+        try:
+            messages, chunks_hash, metadata = self._complex_query_prompt(query)
+            timings['retrieval_ms'] = elapsed_ms()
+            
+            cached = response_cache.lookup(self.db, CHAT_MODEL, messages, chunks_hash, query)
+            if cached is not None:
+                answer, metadata['cache'] = cached
+                timings['first_token_ms'] = elapsed_ms()
+                yield {'content': answer}
+            else:
+                metadata['cache'] = 'miss'
+                stream = self.client.chat.completions.create(
+                    model=CHAT_MODEL,
+                    messages=messages,
+                    stream=True,
+                )
+                pieces = []
+                try:
+                    for event in stream:
+                        delta = event.choices[0].delta.content if event.choices else None
+                        if not delta:
+                            continue
+                        if not pieces:
+                            timings['first_token_ms'] = elapsed_ms()
+                        pieces.append(delta)
+                        yield {'content': delta}
+                finally:
+                    # Runs on GeneratorExit too: dropping the connection stops the generation
+                    stream.response.close()
+                response_cache.store(self.db, CHAT_MODEL, messages, chunks_hash, query, ''.join(pieces).strip())
+        except Exception as e:
+            timings['total_ms'] = elapsed_ms()
+            yield {'content': f"Error processing your query with OpenAI: {str(e)}"}
+            yield {'done': True, 'is_direct': False, 'metadata': metadata, 'timings': timings, 'error': str(e)}
+            return
+        
+        timings['total_ms'] = elapsed_ms()
+        yield {'done': True, 'is_direct': False, 'metadata': metadata, 'timings': timings}
+    
+    def _complex_query_prompt(self, query: str) -> Tuple[List[Dict[str, str]], str, Dict[str, Any]]:
+        """
+        Retrieve the chunks relevant to a query and build the prompt over them
+        
+        Returns:
+            Tuple of (chat messages, context_hash of the chunks, response
+            metadata with the model, context and retrieval stats)
+        """
+        relevant_chunks = self._retrieve_relevant_chunks(query)
+        system_prompt, user_prompt, context_stats = self._prepare_context_for_openai(relevant_chunks, query)
+        
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt},
+        ]
+        metadata = {
+            'model': CHAT_MODEL,
+            'context': context_stats,
+            'retrieval': self.retrieval_stats
+        }
+        return messages, context_hash(relevant_chunks), metadata
+    
     def _handle_complex_query(self, query: str) -> Dict[str, Any]:
         """
         Handle complex queries using the Perplexity API.
@@ -255,25 +815,30 @@ class QueryProcessor:
             Dictionary containing the response from the language model.
         """
         try:
-            relevant_chunks = self._retrieve_relevant_chunks(query)
-            system_prompt, user_prompt = self._prepare_context_for_openai(relevant_chunks, query)
-
-            messages = [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt},
-            ]
+            messages, chunks_hash, metadata = self._complex_query_prompt(query)
 
+            # Identical prompts, or similar questions over the same chunks, reuse a stored answer
+            cached = response_cache.lookup(self.db, CHAT_MODEL, messages, chunks_hash, query)
+            if cached is not None:
+                answer, metadata['cache'] = cached
+                return {
+                    'response': answer,
+                    'is_direct': False,
+                    'metadata': metadata
+                }
+            
             response = self.client.chat.completions.create(
-                model="gpt-3.5-turbo",
+                model=CHAT_MODEL,
                 messages=messages,
             )
+            answer = response.choices[0].message.content.strip()
+            response_cache.store(self.db, CHAT_MODEL, messages, chunks_hash, query, answer)
+            metadata['cache'] = 'miss'
 
             return {
-                'response': response.choices[0].message.content.strip(),
+                'response': answer,
                 'is_direct': False,
-                'metadata': {
-                    'model': 'gpt-3.5-turbo',
-                }
+                'metadata': metadata
             }
 
         except Exception as e:
@@ -283,66 +848,229 @@ class QueryProcessor:
                 'error': str(e)
             }
     
-    def _retrieve_relevant_chunks(self, query: str, limit: int = 5) -> List[Dict[str, Any]]:
+    def _retrieve_relevant_chunks(self, query: str, limit: int = 5,
+                                  parent_depth: int = PARENT_CONTEXT_DEPTH) -> List[Dict[str, Any]]:
         """
         Retrieve relevant chunks from the database based on the query.
-        This implementation performs a simple keyword search.
+        
+        Retrieval runs in two stages. The candidate stage fuses up to
+        RERANK_CANDIDATES chunks from each retriever with reciprocal rank
+        fusion: full-text search (see _keyword_search) and, when pgvector is
+        available, nearest neighbours of the query's embedding (see
+        _vector_search), which also finds chunks sharing only word stems or
+        fragments with the query. When BM25_INDEX_DIR is set, the in-process
+        BM25 index ranks chunks instead. Query words missing from the data
+        are also matched to similarly spelled words when pg_trgm is
+        available (see _fuzzy_search). The re-ranking stage scores the
+        candidates' content on the CPU (see Reranker) and keeps the best
+        limit. Each stage has a latency budget; counts and timings are left
+        in retrieval_stats.
+        
+        Of array chunks only the items holding the most query terms are
+        fetched, projected inside PostgreSQL (see project_items); their
+        positions are added to the metadata as item_offsets.
+        
+        Chunks split out of a larger value are followed by up to parent_depth
+        levels of their parent chunks, e.g. the patient record holding a
+        chunk of readings.
+        
+        Results are cached per normalized query in retrieval_cache until the
+        data generation changes, i.e. until an upload changes the chunks.
         """
-        from .database import JSONChunk  # Import here to avoid circular dependency issues
+        from .database import (  # Import here to avoid circular dependency issues
+            JSONChunk, get_chunk_ancestors, get_data_generation, project_items, term_item_paths
+        )
+        
+        search_index = get_bm25_index()
+        # The BM25 index catches up after the upload commits, so its version is part of the generation
+        generation = (get_data_generation(self.db), search_index.version() if search_index is not None else None)
+        cache_key = (normalize_query(query), limit, parent_depth)
+        cached = retrieval_cache.get(cache_key, generation)
+        if cached is not None:
+            self.retrieval_stats = {'cached': True}
+            return cached
 
-        keywords = [f"%{keyword.strip()}%" for keyword in query.lower().split() if len(keyword.strip()) > 2]
-        if not keywords:
+        # Candidate stage
+        started = time.perf_counter()
+        if search_index is not None:
+            # In-process BM25 instead of full-text and vector search in the database
+            retrievers = [('bm25', lambda: search_index.search(query, RERANK_CANDIDATES))]
+        else:
+            retrievers = [('keyword', lambda: self._keyword_search(query, RERANK_CANDIDATES)),
+                          ('vector', lambda: self._vector_search(query, RERANK_CANDIDATES))]
+        retrievers.append(('fuzzy', lambda: self._fuzzy_search(query, RERANK_CANDIDATES)))
+        rankings, retriever_ms = [], {}
+        for name, retrieve in retrievers:
+            if rankings and (time.perf_counter() - started) * 1000 > CANDIDATE_BUDGET_MS:
+                retriever_ms[name] = None  # Skipped
+                continue
+            retriever_started = time.perf_counter()
+            rankings.append(retrieve())
+            retriever_ms[name] = round((time.perf_counter() - retriever_started) * 1000, 2)
+        candidate_ids = reciprocal_rank_fusion(rankings)[:RERANK_CANDIDATES]
+        rows = {
+            row.id: row for row in self.db.query(
+                JSONChunk.id, JSONChunk.chunk_id, JSONChunk.parent_id, JSONChunk.metadata_
+            ).filter(JSONChunk.id.in_(candidate_ids))
+        }
+        # Only the items of each chunk holding the query's terms are fetched
+        items = project_items(self.db, list(rows), term_item_paths(sorted(query_terms(query))), sample=ITEM_SAMPLE)
+        self.retrieval_stats = {
+            'cached': False,
+            'candidates': {
+                'count': len(rows),
+                'retrievers_ms': retriever_ms,
+                'ms': round((time.perf_counter() - started) * 1000, 2),
+                'budget_ms': CANDIDATE_BUDGET_MS
+            }
+        }
+        if not rows:
             return []
-
-        # Build a query that searches for keywords in both metadata and content
-        # Note: This uses string casting for JSONB fields, which is not highly performant
-        # for large datasets. A full-text search index would be better.
-        # Use the ->> operator to extract JSON fields as text for searching
-        filters = [
-            or_(
-                JSONChunk.metadata_.op('->>')('search_text').ilike(kw),
-                JSONChunk.content.op('->>')('text').ilike(kw),
-                JSONChunk.content.cast(String).ilike(kw) # Fallback for unstructured content
-            )
-            for kw in keywords
-        ]
         
-        # Combine filters with OR logic
-        combined_filter = or_(*filters)
-
-        # Execute the query
-        results = self.db.query(JSONChunk).filter(combined_filter).limit(limit).all()
+        # Re-ranking stage
+        candidates = [(chunk_id, items[chunk_id]['content']) for chunk_id in candidate_ids if chunk_id in items]
+        ordered, self.retrieval_stats['rerank'] = reranker.rerank(query, candidates, RERANK_BUDGET_MS)
+        results = [rows[chunk_id] for chunk_id in ordered[:limit]]
 
         # Format results
-        return [
-            {
+        retrieved = []
+        for chunk in results:
+            projected = items[chunk.id]
+            metadata = chunk.metadata_
+            if projected['total'] is not None:
+                metadata = {**(metadata or {}), 'items_total': projected['total'], 'item_offsets': projected['offsets']}
+            retrieved.append({
                 'id': chunk.chunk_id,
-                'content': chunk.content,
-                'metadata': chunk.metadata_
-            }
-            for chunk in results
-        ]
+                'parent_id': chunk.parent_id,
+                'content': projected['content'],
+                'metadata': metadata
+            })
+        self.retrieval_stats['items'] = {
+            'returned': sum(len(chunk['content']) for chunk in retrieved if isinstance(chunk['content'], list)),
+            'total': sum(items[chunk.id]['total'] or 1 for chunk in results)
+        }
+        
+        if results and parent_depth > 0:
+            retrieved += [
+                {
+                    'id': chunk.chunk_id,
+                    'parent_id': chunk.parent_id,
+                    'content': chunk.content,
+                    'metadata': chunk.metadata_
+                }
+                for chunk in get_chunk_ancestors(self.db, [chunk.chunk_id for chunk in results], parent_depth)
+            ]
+        retrieval_cache.put(cache_key, generation, retrieved)
+        return retrieved
+    
+    def _keyword_search(self, query: str, limit: int) -> List[int]:
+        """
+        Rank chunks by full-text search
+        
+        The query is parsed with websearch_to_tsquery, so quoted phrases and
+        -exclusions work, matched against the GIN-indexed search_vector
+        (string values and keys of the content) and ranked with ts_rank_cd.
+        When fewer than limit chunks contain every term, chunks containing
+        any of them follow.
+        
+        Returns:
+            JSONChunk ids, best first
+        """
+        from .database import JSONChunk, SEARCH_CONFIG
+
+        words = re.findall(r'\w+', query)
+        if not words:
+            return []
+
+        ids = []
+        # All terms first, which the GIN index narrows down most; then any term
+        for text_query in (query, ' or '.join(words)):
+            ts_query = func.websearch_to_tsquery(SEARCH_CONFIG, text_query)
+            rank = func.ts_rank_cd(JSONChunk.search_vector, ts_query, SEARCH_RANK_NORMALIZATION)
+            rows = self.db.query(JSONChunk.id).filter(
+                JSONChunk.deleted_at.is_(None),
+                JSONChunk.search_vector.op('@@')(ts_query),
+                JSONChunk.id.notin_(ids)
+            ).order_by(rank.desc()).limit(limit - len(ids))
+            ids += [row.id for row in rows]
+            if len(ids) >= limit or len(words) == 1:
+                break
+        return ids
+    
+    def _fuzzy_search(self, query: str, limit: int) -> List[int]:
+        """
+        Rank chunks by full-text search for corrected spellings of the query
+        
+        Query words that no chunk holds, e.g. 'glucos' or 'jonh', are matched
+        to vocabulary words by trigram similarity (see similar_search_terms).
+        Chunks holding any match are ranked by ts_rank_cd weighted by the
+        match's similarity. Empty without pg_trgm or when every word is known.
+        
+        Returns:
+            JSONChunk ids, best first
+        """
+        from .database import JSONChunk, SEARCH_CONFIG, fuzzy_search_available, similar_search_terms
+
+        words = list(dict.fromkeys(re.findall(r'[^\W\d_]{3,}', query.lower())))
+        if not words or not fuzzy_search_available():
+            return []
+        try:
+            matches = similar_search_terms(self.db, words, FUZZY_SIMILARITY_THRESHOLD, FUZZY_MATCHES_PER_WORD)
+            if not matches:
+                return []
+            ts_queries = [(func.plainto_tsquery(SEARCH_CONFIG, term), score) for _, term, score in matches]
+            rank = sum(
+                score * func.ts_rank_cd(JSONChunk.search_vector, ts_query, SEARCH_RANK_NORMALIZATION)
+                for ts_query, score in ts_queries
+            )
+            rows = self.db.query(JSONChunk.id).filter(
+                JSONChunk.deleted_at.is_(None),
+                or_(*(JSONChunk.search_vector.op('@@')(ts_query) for ts_query, _ in ts_queries))
+            ).order_by(rank.desc()).limit(limit)
+            return [row.id for row in rows]
+        except Exception:
+            self.db.rollback()
+            return []
     
-    def _prepare_context_for_openai(self, chunks: List[Dict[str, Any]], query: str) -> Tuple[str, str]:
+    def _vector_search(self, query: str, limit: int) -> List[int]:
+        """Rank chunks by cosine distance of their embeddings to the query's; empty without pgvector"""
+        from .database import nearest_chunk_ids, vector_search_available
+
+        if not vector_search_available():
+            return []
+        vector = self.embedder.embed([query])[0]
+        if not vector.any():
+            return []
+        try:
+            return nearest_chunk_ids(self.db, vector.tolist(), limit)
+        except Exception:
+            self.db.rollback()
+            return []
+    
+    def _prepare_context_for_openai(self, chunks: List[Dict[str, Any]], query: str) -> Tuple[str, str, Dict[str, Any]]:
         """
         Prepare system and user prompts for the OpenAI API.
 
+        The chunks are fitted to CONTEXT_TOKEN_BUDGET by build_context, which
+        keeps the records and fields matching the query and serializes them
+        compactly.
+
         Args:
             chunks: List of relevant chunks.
             query: User's query.
 
         Returns:
-            A tuple containing the system prompt and the user prompt.
+            A tuple containing the system prompt, the user prompt and the
+            context stats (tokens used, records shown).
         """
         system_prompt = """You are a helpful assistant that answers questions based on the provided data.
         Use the following pieces of context to answer the user's question.
+        Records of a chunk are given as a table of columns and rows, projected to the fields relevant to the question.
         If you don't know the answer, just say that you don't know, don't try to make up an answer."""
 
-        user_prompt_context = "Context:\n"
-        for i, chunk in enumerate(chunks, 1):
-            chunk_str = json.dumps(chunk['content'], indent=2) if isinstance(chunk['content'], (dict, list)) else str(chunk['content'])
-            user_prompt_context += f"--- Chunk {i} (Source: {chunk['metadata'].get('source', 'unknown')}, Type: {chunk['metadata'].get('type', 'unknown')}) ---\n{chunk_str}\n"
+        user_prompt_context, context_stats = build_context(chunks, query)
 
         user_prompt = f"{user_prompt_context}\nQuestion: {query}"
+        context_stats['prompt_tokens'] = count_tokens(system_prompt) + count_tokens(user_prompt)
 
-        return system_prompt, user_prompt
+        return system_prompt, user_prompt, context_stats
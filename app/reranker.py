@@ -0,0 +1,218 @@
+import logging
+import math
+import os
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from .bm25_index import tokenize
+from .context_builder import ID_FIELDS, query_terms
+from .embeddings import chunk_text
+from .value_index import is_id_field
+
+logger = logging.getLogger(__name__)
+
+# BM25F streams of a chunk: values of identifier fields, field names and
+# other values, with their weights and length normalization
+FIELD_WEIGHTS = {'id': 3.0, 'key': 1.5, 'text': 1.0}
+FIELD_B = {'id': 0.5, 'key': 0.75, 'text': 0.75}
+BM25F_K1 = 1.2
+# Bonus of a chunk holding all its matched query terms next to each other
+PROXIMITY_WEIGHT = float(os.getenv("RERANK_PROXIMITY_WEIGHT", "1.0"))
+# sentence-transformers cross-encoder scoring the query and a chunk's text
+# together, e.g. 'cross-encoder/ms-marco-MiniLM-L-6-v2'; unset disables it
+RERANK_CROSS_ENCODER = os.getenv("RERANK_CROSS_ENCODER")
+# Characters of a chunk's text given to the cross-encoder
+CROSS_ENCODER_TEXT_LIMIT = 2000
+
+
+class _Analyzed:
+    """Query term counts and lengths per BM25F stream, and query term positions, of a chunk"""
+    
+    def __init__(self, content: Any, terms: Set[str]):
+        # Text of each stream and of the whole chunk in document order, tokenized once each
+        pieces: Dict[str, List[str]] = {name: [] for name in FIELD_WEIGHTS}
+        sequence: List[str] = []
+        stack: List[Tuple[str, Any]] = [('', content)]
+        while stack:
+            key, value = stack.pop()
+            if isinstance(value, dict):
+                for child_key, child in reversed(list(value.items())):
+                    stack.append((str(child_key), child))
+                    stack.append(('', _FieldName(child_key)))
+            elif isinstance(value, list):
+                stack.extend((key, item) for item in reversed(value))
+            elif isinstance(value, _FieldName):
+                pieces['key'].append(value.name)
+                sequence.append(value.name)
+            elif isinstance(value, (str, int, float)) and not isinstance(value, bool):
+                text = str(value)
+                pieces['id' if key and is_id_field(key, ID_FIELDS) else 'text'].append(text)
+                sequence.append(text)
+        
+        self.streams: Dict[str, Counter] = {}
+        self.lengths: Dict[str, int] = {}
+        for name, texts in pieces.items():
+            tokens = tokenize(' '.join(texts))
+            self.streams[name] = Counter(token for token in tokens if token in terms)
+            self.lengths[name] = len(tokens)
+        self.positions = [
+            (i, token) for i, token in enumerate(tokenize(' '.join(sequence))) if token in terms
+        ]
+
+
+class _FieldName:
+    """Marks a field name on the traversal stack of _Analyzed"""
+    __slots__ = ('name',)
+    
+    def __init__(self, name: Any):
+        self.name = str(name)
+
+
+def _min_window(positions: List[Tuple[int, str]]) -> Tuple[int, int]:
+    """
+    Find the shortest run of a chunk's tokens holding every query term it holds
+    
+    Args:
+        positions: (token position, query term) pairs in position order
+    
+    Returns:
+        Tuple of (distinct terms held, window length); (0, 0) when none are held
+    """
+    need = len({token for _, token in positions})
+    if not need:
+        return 0, 0
+    counts: Counter = Counter()
+    have = 0
+    best = positions[-1][0] - positions[0][0] + 1
+    start = 0
+    for position, token in positions:
+        counts[token] += 1
+        if counts[token] == 1:
+            have += 1
+        while have == need:
+            best = min(best, position - positions[start][0] + 1)
+            first = positions[start][1]
+            counts[first] -= 1
+            if not counts[first]:
+                have -= 1
+            start += 1
+    return need, best
+
+
+class Reranker:
+    """
+    CPU re-ranking of retrieval candidates against the query
+    
+    Candidates are scored with BM25F over three streams of each chunk
+    (identifier values, field names, other values), with document
+    frequencies taken over the candidates, plus a bonus for chunks holding
+    the query terms close together. When RERANK_CROSS_ENCODER names a model
+    and sentence-transformers is installed, its scores are fused with the
+    lexical ranking by reciprocal rank fusion.
+    """
+    
+    def __init__(self, cross_encoder: Optional[str] = RERANK_CROSS_ENCODER):
+        self.cross_encoder_name = cross_encoder
+        self._cross_encoder = None
+    
+    def rerank(self, query: str, candidates: List[Tuple[int, Any]],
+               budget_ms: float) -> Tuple[List[int], Dict[str, Any]]:
+        """
+        Order candidates by relevance to the query
+        
+        Scoring stops when budget_ms is spent; candidates not scored by then
+        follow the scored ones in their original order.
+        
+        Args:
+            query: User's query
+            candidates: (chunk id, content) pairs in candidate order
+            budget_ms: Milliseconds the stage may take
+        
+        Returns:
+            Tuple of (chunk ids, best first; timing stats)
+        """
+        from .query_processor import reciprocal_rank_fusion
+        
+        started = time.perf_counter()
+        deadline = started + budget_ms / 1000
+        terms = query_terms(query)
+        
+        analyzed = []
+        for chunk_id, content in candidates:
+            if time.perf_counter() > deadline:
+                break
+            analyzed.append((chunk_id, _Analyzed(content, terms)))
+        
+        ordered = [chunk_id for chunk_id, _ in analyzed]
+        if terms and analyzed:
+            scores = self._lexical_scores(analyzed, terms)
+            # sorted is stable, so ties keep the candidate order
+            ordered = [chunk_id for chunk_id, _ in sorted(zip(ordered, scores), key=lambda pair: -pair[1])]
+        
+        cross_encoded = False
+        if self.cross_encoder_name and ordered and time.perf_counter() < deadline:
+            contents = dict(candidates)
+            cross_scores = self._cross_scores(query, [contents[chunk_id] for chunk_id in ordered])
+            if cross_scores is not None:
+                by_cross = [chunk_id for chunk_id, _ in sorted(zip(ordered, cross_scores), key=lambda pair: -pair[1])]
+                ordered = reciprocal_rank_fusion([ordered, by_cross])
+                cross_encoded = True
+        
+        scored = set(ordered)
+        ordered += [chunk_id for chunk_id, _ in candidates if chunk_id not in scored]
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        return ordered, {
+            'candidates': len(candidates),
+            'scored': len(analyzed),
+            'cross_encoder': cross_encoded,
+            'ms': round(elapsed_ms, 2),
+            'budget_ms': budget_ms,
+            'budget_exceeded': len(analyzed) < len(candidates)
+        }
+    
+    def _lexical_scores(self, analyzed: List[Tuple[int, _Analyzed]], terms: Set[str]) -> List[float]:
+        """BM25F plus proximity score of each analyzed chunk"""
+        documents = [chunk for _, chunk in analyzed]
+        total = len(documents)
+        average = {
+            name: (sum(chunk.lengths[name] for chunk in documents) / total) or 1.0 for name in FIELD_WEIGHTS
+        }
+        df = Counter(term for chunk in documents for term in terms
+                     if any(chunk.streams[name][term] for name in FIELD_WEIGHTS))
+        
+        scores = []
+        for chunk in documents:
+            score = 0.0
+            for term in terms:
+                if not df[term]:
+                    continue
+                # Field-weighted, length-normalized frequency, saturated once
+                weighted = sum(
+                    FIELD_WEIGHTS[name] * chunk.streams[name][term]
+                    / (1 - FIELD_B[name] + FIELD_B[name] * chunk.lengths[name] / average[name])
+                    for name in FIELD_WEIGHTS
+                )
+                idf = math.log(1 + (total - df[term] + 0.5) / (df[term] + 0.5))
+                score += idf * weighted / (BM25F_K1 + weighted)
+            held, window = _min_window(chunk.positions)
+            if held > 1:
+                score += PROXIMITY_WEIGHT * held / window
+            scores.append(score)
+        return scores
+    
+    def _cross_scores(self, query: str, contents: List[Any]) -> Optional[List[float]]:
+        """Score query and chunk text pairs with the cross-encoder, or None when it cannot be loaded"""
+        if self._cross_encoder is None:
+            try:
+                from sentence_transformers import CrossEncoder
+                self._cross_encoder = CrossEncoder(self.cross_encoder_name, device='cpu')
+            except Exception as e:
+                logger.warning(f"Cross-encoder {self.cross_encoder_name} is not available, re-ranking without it: {e}")
+                self.cross_encoder_name = None
+                return None
+        pairs = [(query, chunk_text(content)[:CROSS_ENCODER_TEXT_LIMIT]) for content in contents]
+        return [float(score) for score in self._cross_encoder.predict(pairs)]
+
+
+reranker = Reranker()
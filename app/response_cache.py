@@ -0,0 +1,169 @@
+import hashlib
+import logging
+import os
+import threading
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import orjson
+from sqlalchemy import delete, select
+
+from .embeddings import HashingEmbedder
+from .query_cache import normalize_query
+
+logger = logging.getLogger(__name__)
+
+# Seconds a cached answer is served for
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", str(24 * 3600)))
+# Most cached answers kept; the least recently used are evicted beyond it, 0 disables the cache
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "10000"))
+# Lowest cosine similarity of a differently worded question whose answer is
+# reused over the same chunks; unset disables the semantic tier
+RESPONSE_CACHE_SIMILARITY = os.getenv("RESPONSE_CACHE_SIMILARITY")
+# Cached questions over the same chunks compared per semantic lookup
+SEMANTIC_CANDIDATES = 200
+
+
+def context_hash(chunks: List[Dict[str, Any]]) -> str:
+    """Fingerprint the retrieved chunks by their ids and content"""
+    payload = orjson.dumps([[chunk['id'], chunk['content']] for chunk in chunks], option=orjson.OPT_SORT_KEYS)
+    return hashlib.sha256(payload).hexdigest()
+
+
+def prompt_key(model: str, messages: List[Dict[str, str]]) -> str:
+    """Hash the model and the prompt messages into the exact cache key"""
+    return hashlib.sha256(orjson.dumps([model, messages])).hexdigest()
+
+
+class ResponseCache:
+    """
+    Language model answers stored in PostgreSQL, shared by all workers
+    
+    Exact tier: answers are keyed on a hash of the model and the full
+    prompt, which embeds the retrieved chunks, so new or changed chunks
+    miss. Semantic tier (when a similarity threshold is set): a question
+    worded differently reuses the answer of a cached question over the same
+    chunks, i.e. with the same context_hash, when the cosine similarity of
+    their HashingEmbedder vectors reaches the threshold.
+    
+    Answers expire after ttl seconds; beyond max_entries the least recently
+    used are evicted whenever an answer is stored.
+    """
+    
+    def __init__(self, ttl: int = RESPONSE_CACHE_TTL, max_entries: int = RESPONSE_CACHE_SIZE,
+                 similarity: Optional[float] = None, embedder: Optional[HashingEmbedder] = None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.similarity = similarity
+        self.embedder = embedder or HashingEmbedder()
+        self._lock = threading.Lock()
+        self._counts = {'exact_hits': 0, 'semantic_hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+    
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0 and self.ttl > 0
+    
+    def lookup(self, db, model: str, messages: List[Dict[str, str]], chunks_hash: str,
+               query: str) -> Optional[Tuple[str, str]]:
+        """
+        Find a cached answer to a prompt
+        
+        Returns:
+            Tuple of (answer, 'exact' or 'semantic'), or None on a miss
+        """
+        from .database import ResponseCacheEntry
+        
+        if not self.enabled:
+            return None
+        fresh = datetime.utcnow() - timedelta(seconds=self.ttl)
+        try:
+            entry = db.get(ResponseCacheEntry, prompt_key(model, messages))
+            tier = 'exact'
+            if (entry is None or entry.created_at < fresh) and self.similarity is not None:
+                entry = self._nearest_question(db, model, chunks_hash, query, fresh)
+                tier = 'semantic'
+            if entry is None or entry.created_at < fresh:
+                self._count('misses')
+                return None
+            
+            entry.hits += 1
+            entry.last_used_at = datetime.utcnow()
+            db.commit()
+        except Exception:
+            # The answer is asked for again instead
+            logger.exception("Response cache lookup failed")
+            db.rollback()
+            self._count('misses')
+            return None
+        self._count(f'{tier}_hits')
+        return entry.response, tier
+    
+    def store(self, db, model: str, messages: List[Dict[str, str]], chunks_hash: str, query: str, response: str):
+        """Cache an answer and evict expired and least recently used answers"""
+        from .database import ResponseCacheEntry
+        
+        if not self.enabled:
+            return
+        now = datetime.utcnow()
+        embedding = self.embedder.embed([normalize_query(query)])[0].astype(np.float32)
+        try:
+            db.merge(ResponseCacheEntry(
+                key=prompt_key(model, messages), model=model, context_hash=chunks_hash, query=query,
+                query_embedding=embedding.tobytes(), response=response, created_at=now, last_used_at=now, hits=0
+            ))
+            
+            keep = select(ResponseCacheEntry.key).order_by(ResponseCacheEntry.last_used_at.desc()).limit(self.max_entries)
+            evicted = db.execute(delete(ResponseCacheEntry).where(
+                (ResponseCacheEntry.created_at < now - timedelta(seconds=self.ttl)) | ResponseCacheEntry.key.notin_(keep)
+            )).rowcount
+            db.commit()
+        except Exception:
+            logger.exception("Storing a response in the cache failed")
+            db.rollback()
+            return
+        self._count('stores')
+        self._count('evictions', evicted)
+    
+    def stats(self) -> Dict[str, Any]:
+        """Return this worker's hit, miss, store and eviction counts"""
+        with self._lock:
+            counts = dict(self._counts)
+        lookups = counts['exact_hits'] + counts['semantic_hits'] + counts['misses']
+        counts['hit_rate'] = round((lookups - counts['misses']) / lookups, 4) if lookups else None
+        counts.update({'ttl_seconds': self.ttl, 'max_entries': self.max_entries, 'similarity': self.similarity})
+        return counts
+    
+    def _nearest_question(self, db, model: str, chunks_hash: str, query: str, fresh: datetime):
+        """Return the fresh entry over the same chunks whose question is most similar, if similar enough"""
+        from .database import ResponseCacheEntry
+        
+        candidates = db.query(ResponseCacheEntry).filter(
+            ResponseCacheEntry.model == model,
+            ResponseCacheEntry.context_hash == chunks_hash,
+            ResponseCacheEntry.created_at >= fresh,
+            ResponseCacheEntry.query_embedding.isnot(None)
+        ).order_by(ResponseCacheEntry.last_used_at.desc()).limit(SEMANTIC_CANDIDATES).all()
+        if not candidates:
+            return None
+        vector = self.embedder.embed([normalize_query(query)])[0]
+        if not vector.any():
+            return None
+        # Entries embedded with another EMBEDDING_DIM are not comparable
+        candidates = [entry for entry in candidates if len(entry.query_embedding) == vector.size * 4]
+        if not candidates:
+            return None
+        matrix = np.stack([np.frombuffer(entry.query_embedding, dtype=np.float32) for entry in candidates])
+        # Vectors are unit length, so the dot product is the cosine similarity
+        scores = matrix @ vector
+        best = int(np.argmax(scores))
+        return candidates[best] if scores[best] >= self.similarity else None
+    
+    def _count(self, name: str, amount: int = 1):
+        with self._lock:
+            self._counts[name] += amount
+
+
+response_cache = ResponseCache(
+    similarity=float(RESPONSE_CACHE_SIMILARITY) if RESPONSE_CACHE_SIMILARITY else None
+)
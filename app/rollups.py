@@ -0,0 +1,111 @@
+from datetime import date, timedelta
+from typing import Dict, Any, Iterable, List, Optional, Tuple
+
+from .field_stats import parse_timestamp
+
+# Periods rolled up at ingest, finest first
+PERIODS = ('day', 'week', 'month')
+
+# Partial aggregate of one field: [count, sum, min, max]
+Stats = List[float]
+
+
+def period_key(day: date, period: str) -> str:
+    """Return the key of the day, ISO week ('2025-W18') or month ('2025-05') holding day"""
+    if period == 'day':
+        return day.isoformat()
+    if period == 'week':
+        year, week, _ = day.isocalendar()
+        return f'{year}-W{week:02d}'
+    return f'{day.year}-{day.month:02d}'
+
+
+def period_bounds(key: str, period: str) -> Tuple[date, date]:
+    """Return the first and last day of a period key"""
+    if period == 'day':
+        day = date.fromisoformat(key)
+        return day, day
+    if period == 'week':
+        year, week = key.split('-W')
+        first = date.fromisocalendar(int(year), int(week), 1)
+        return first, first + timedelta(days=6)
+    year, month = (int(part) for part in key.split('-'))
+    first = date(year, month, 1)
+    following = date(year + month // 12, month % 12 + 1, 1)
+    return first, following - timedelta(days=1)
+
+
+def merge_stats(total: Optional[Stats], stats: Stats) -> Stats:
+    """Combine two partial aggregates"""
+    if total is None:
+        return list(stats)
+    return [
+        total[0] + stats[0],
+        total[1] + stats[1],
+        min(total[2], stats[2]),
+        max(total[3], stats[3])
+    ]
+
+
+def summarize(stats: Stats) -> Dict[str, Any]:
+    """Turn a partial aggregate into the stored count/sum/min/max/mean"""
+    count, total, low, high = stats
+    return {
+        'count': count,
+        'sum': total,
+        'min': low,
+        'max': high,
+        'mean': total / count if count else None
+    }
+
+
+def rollup_fields(field_stats: Dict[str, Dict[str, Any]], date_field: str,
+                  skip: Iterable[str] = ()) -> List[str]:
+    """Pick the numeric fields of a chunk worth rolling up"""
+    skip = set(skip)
+    return [
+        field for field, stats in field_stats.items()
+        if stats['type'] == 'number' and field != date_field and field not in skip
+        and not field.endswith('_id')
+    ]
+
+
+def daily_rollups(items: List[Any], date_field: str, fields: List[str]) -> Dict[str, Dict[str, Stats]]:
+    """
+    Aggregate numeric fields of a chunk's records per day
+    
+    Args:
+        items: Records of the chunk
+        date_field: Field dating each record
+        fields: Dotted paths of the numeric fields to aggregate
+    
+    Returns:
+        Dictionary of ISO day -> field -> [count, sum, min, max]
+    """
+    paths = [(field, field.split('.')) for field in fields]
+    days: Dict[str, Dict[str, Stats]] = {}
+    for item in items:
+        if type(item) is not dict:
+            continue
+        timestamp = parse_timestamp(item.get(date_field))
+        if timestamp is None:
+            continue
+        day = days.setdefault(timestamp.date().isoformat(), {})
+        for field, path in paths:
+            value = item
+            for key in path:
+                value = value.get(key) if type(value) is dict else None
+            if type(value) not in (int, float):
+                continue
+            stats = day.get(field)
+            if stats is None:
+                day[field] = [1, value, value, value]
+            else:
+                stats[0] += 1
+                stats[1] += value
+                if value < stats[2]:
+                    stats[2] = value
+                if value > stats[3]:
+                    stats[3] = value
+    return {day: fields for day, fields in days.items() if fields}
+
@@ -0,0 +1,80 @@
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from .chunking import CHUNK_REF_KEY
+
+# Longest string value entered in the lookup index
+LOOKUP_VALUE_LIMIT = 128
+# A string field is categorical in a chunk when it has at most this many
+# distinct values, and at most one per two records
+CATEGORICAL_MAX_DISTINCT = 32
+
+# (field, normalized value, offset of the record within its chunk)
+Posting = Tuple[str, str, Optional[int]]
+
+
+def is_id_field(field: str, id_fields: Iterable[str]) -> bool:
+    """Check whether a dotted field names an identifier, e.g. 'id', 'patient_id' or 'orderId'"""
+    name = field.rsplit('.', 1)[-1]
+    return name in id_fields or name.lower().endswith('_id') or (name.endswith('Id') and len(name) > 2)
+
+
+def lookup_fields(field_stats: Dict[str, Dict[str, Any]], id_fields: Iterable[str]) -> List[str]:
+    """
+    Pick the fields of a chunk whose values go into the lookup index
+    
+    Args:
+        field_stats: Zone map of the chunk from compute_field_stats
+        id_fields: Field names that identify a record
+    
+    Returns:
+        Identifier fields holding strings or numbers, and categorical
+        string fields (few distinct values, e.g. 'status')
+    """
+    fields = []
+    for field, stats in field_stats.items():
+        if stats['type'] not in ('string', 'number', 'mixed') or CHUNK_REF_KEY in field.split('.'):
+            continue
+        if is_id_field(field, id_fields):
+            fields.append(field)
+        elif stats['type'] == 'string' and \
+                stats.get('distinct', 0) <= min(CATEGORICAL_MAX_DISTINCT, stats['count'] // 2):
+            fields.append(field)
+    return fields
+
+
+def normalize_lookup_value(value: Any) -> Optional[str]:
+    """Return the index key of a value, or None for values that are not looked up"""
+    if type(value) is str:
+        value = value.strip().lower()
+        return value if 0 < len(value) <= LOOKUP_VALUE_LIMIT else None
+    if type(value) is int:
+        return str(value)
+    return None
+
+
+def value_postings(chunk: Any, fields: List[str]) -> List[Posting]:
+    """
+    List the lookup index entries of a chunk
+    
+    Args:
+        chunk: A list of records, or a single record
+        fields: Dotted paths of the fields to index
+    
+    Returns:
+        One posting per indexed field value; the offset is the record's
+        position in a list chunk and None for a single-record chunk
+    """
+    records = enumerate(chunk) if isinstance(chunk, list) else [(None, chunk)]
+    paths = [(field, field.split('.')) for field in fields]
+    postings = []
+    for offset, record in records:
+        if type(record) is not dict:
+            continue
+        for field, path in paths:
+            value = record
+            for key in path:
+                value = value.get(key) if type(value) is dict else None
+            key = normalize_lookup_value(value)
+            if key is not None:
+                postings.append((field, key, offset))
+    return postings
@@ -0,0 +1,118 @@
+"""
+Benchmark date-range pruning of chunks
+
+Fills a scratch copy of json_chunks with synthetic chunks, each covering a
+few days, and compares the latency of date questions answered by
+
+  * text comparisons on metadata_->'date_range' (sequential scan), and
+  * an overlap (&&) check on the GiST-indexed date_span column.
+
+    python -m benchmarks.date_pruning --rows 10000000
+
+Uses DATABASE_URL like the application. The scratch table is dropped
+afterwards unless --keep is given.
+"""
+import argparse
+import random
+import statistics
+import time
+from datetime import date, timedelta
+
+from sqlalchemy import text
+
+from app.database import engine
+
+TABLE = 'bench_date_chunks'
+FIRST_DAY = date(2015, 1, 1)
+DAYS = 3650
+
+TEXT_QUERY = f"""
+    SELECT id FROM {TABLE}
+    WHERE deleted_at IS NULL
+      AND metadata_->'date_range'->>'min' <= :end_text
+      AND metadata_->'date_range'->>'max' >= :start_text
+    LIMIT :limit
+"""
+RANGE_QUERY = f"""
+    SELECT id FROM {TABLE}
+    WHERE deleted_at IS NULL
+      AND date_span && tsrange(:start, :end, '[)')
+    LIMIT :limit
+"""
+
+
+def create_table(conn, rows: int):
+    """Create and fill the scratch table server-side with generate_series"""
+    conn.execute(text(f"DROP TABLE IF EXISTS {TABLE}"))
+    conn.execute(text(f"""
+        CREATE TABLE {TABLE} AS
+        SELECT g AS id,
+               jsonb_build_object(
+                   'chunk_type', 'root_chunk',
+                   'item_count', 100,
+                   'date_range', jsonb_build_object(
+                       'field', 'date',
+                       'min', to_char(d, 'YYYY-MM-DD'),
+                       'max', to_char(d + span, 'YYYY-MM-DD'))) AS metadata_,
+               tsrange(d, d + span, '[]') AS date_span,
+               NULL::timestamp AS deleted_at
+        FROM (
+            SELECT g,
+                   DATE '{FIRST_DAY.isoformat()}' + (random() * {DAYS})::int AS d,
+                   (random() * 6)::int AS span
+            FROM generate_series(1, :rows) AS g
+        ) AS s
+    """), {'rows': rows})
+    conn.execute(text(f"CREATE INDEX ON {TABLE} USING gist (date_span)"))
+    conn.execute(text(f"ANALYZE {TABLE}"))
+
+
+def time_queries(conn, sql: str, periods, limit: int):
+    latencies = []
+    for start, end in periods:
+        started = time.perf_counter()
+        conn.execute(text(sql), {
+            'start': start, 'end': end,
+            'start_text': start.isoformat(), 'end_text': (end - timedelta(days=1)).isoformat(),
+            'limit': limit
+        }).fetchall()
+        latencies.append((time.perf_counter() - started) * 1000)
+    latencies.sort()
+    return statistics.median(latencies), latencies[int(len(latencies) * 0.95) - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=10_000_000)
+    parser.add_argument('--queries', type=int, default=20)
+    parser.add_argument('--limit', type=int, default=10, help='Rows fetched per query, as in _handle_date_query')
+    parser.add_argument('--keep', action='store_true', help='Keep the scratch table for further runs')
+    args = parser.parse_args()
+
+    random.seed(42)
+    with engine.connect() as conn:
+        started = time.perf_counter()
+        create_table(conn, args.rows)
+        conn.commit()
+        print(f"Loaded {args.rows:,} chunks in {time.perf_counter() - started:.1f}s")
+
+        try:
+            print(f"{'question':>10} {'predicate':>16} {'median ms':>10} {'p95 ms':>10}")
+            for label, days in (('day', 1), ('week', 7), ('month', 30)):
+                periods = []
+                for _ in range(args.queries):
+                    start = FIRST_DAY + timedelta(days=random.randrange(DAYS - days))
+                    periods.append((start, start + timedelta(days=days)))
+                # Far-future periods match nothing, the worst case for a scan
+                periods += [(date(2100, 1, 1), date(2100, 1, 1) + timedelta(days=days))] * 3
+                for name, sql in (('text metadata', TEXT_QUERY), ('date_span GiST', RANGE_QUERY)):
+                    median, p95 = time_queries(conn, sql, periods, args.limit)
+                    print(f"{label:>10} {name:>16} {median:>10.2f} {p95:>10.2f}")
+        finally:
+            if not args.keep:
+                conn.execute(text(f"DROP TABLE IF EXISTS {TABLE}"))
+                conn.commit()
+
+
+if __name__ == '__main__':
+    main()
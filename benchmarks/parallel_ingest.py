@@ -0,0 +1,100 @@
+"""
+Benchmark parallel chunk parsing and metadata extraction
+
+Generates a synthetic root-array JSON file and measures how ingestion
+throughput scales with the number of parse workers, both under the
+production size policy (chunks closed at a token budget, as in app.main)
+and under a plain item-count policy.
+
+    python -m benchmarks.parallel_ingest --records 1000000 --workers 1 2 4 8 16
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+
+from app.chunking import ChunkingPolicy
+from app.json_processor import JSONProcessor
+
+
+def write_sample_file(path: str, records: int):
+    """Write a root array of patient readings"""
+    random.seed(42)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('[')
+        for i in range(records):
+            if i:
+                f.write(',\n')
+            json.dump({
+                'patient_id': f'P{i % 5000:05d}',
+                'date': f'2025-{random.randint(1, 12):02d}-{random.randint(1, 28):02d}',
+                'glucose': random.randint(60, 320),
+                'notes': 'routine check, fasting' if i % 3 else 'post-meal [flagged]',
+                'vitals': {'hr': random.randint(50, 120), 'bp': [random.randint(90, 140), random.randint(60, 90)]}
+            }, f)
+        f.write(']')
+
+
+def make_policies(chunk_size: int, max_tokens: int) -> dict:
+    """Return the chunking policies to benchmark, keyed by name"""
+    return {
+        'size': ChunkingPolicy(max_items=chunk_size, max_tokens=max_tokens),
+        'items': ChunkingPolicy(max_items=chunk_size)
+    }
+
+
+def run(path: str, workers: int, policy: ChunkingPolicy) -> dict:
+    processor = JSONProcessor(policy=policy)
+    stats = {}
+    started = time.perf_counter()
+    chunks = sum(1 for _ in processor.iter_chunks(path, stats=stats, workers=workers))
+    elapsed = time.perf_counter() - started
+    return {
+        'workers': workers,
+        'chunks': chunks,
+        'seconds': elapsed,
+        'mb_per_sec': os.path.getsize(path) / elapsed / (1024 * 1024),
+        'peak_rss_mb': stats.get('peak_rss_mb')
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=500000)
+    parser.add_argument('--chunk-size', type=int, default=100)
+    parser.add_argument('--max-tokens', type=int, default=2000,
+                        help='Token budget of the size policy (CHUNK_MAX_TOKENS in production)')
+    parser.add_argument('--policy', choices=['size', 'items', 'both'], default='both')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--file', help='Use an existing root-array JSON file instead of generating one')
+    args = parser.parse_args()
+
+    path = args.file
+    if path is None:
+        fd, path = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        write_sample_file(path, args.records)
+    print(f"File: {path} ({os.path.getsize(path) / (1024 * 1024):.1f} MB)")
+
+    policies = make_policies(args.chunk_size, args.max_tokens)
+    if args.policy != 'both':
+        policies = {args.policy: policies[args.policy]}
+
+    try:
+        print(f"{'policy':>6} {'workers':>8} {'chunks':>8} {'seconds':>9} {'MB/s':>8} {'speedup':>8} {'peak RSS MB':>12}")
+        for name, policy in policies.items():
+            baseline = None
+            for workers in args.workers:
+                result = run(path, workers, policy)
+                baseline = baseline or result['seconds']
+                print(f"{name:>6} {result['workers']:>8} {result['chunks']:>8} {result['seconds']:>9.2f} "
+                      f"{result['mb_per_sec']:>8.1f} {baseline / result['seconds']:>8.2f}x {result['peak_rss_mb']!s:>12}")
+    finally:
+        if args.file is None:
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,9 @@
 import streamlit as st
 import requests
+import codecs
 import os
 import json
+import time
 
 st.set_page_config(page_title="RAG Chatbot", page_icon="🤖", layout="wide")
 
@@ -11,6 +13,40 @@ st.caption("A Streamlit chat UI for your FastAPI RAG backend")
 # Define backend endpoints
 CHAT_URL = "http://127.0.0.1:8000/api/chat/"
 UPLOAD_URL = "http://127.0.0.1:8000/api/upload/"
+JOBS_URL = "http://127.0.0.1:8000/api/jobs/"
+JOB_POLL_INTERVAL = 1.0  # Seconds between ingestion status checks
+
+def wait_for_ingestion(job_id: str, filename: str) -> dict:
+    """Poll an ingestion job, showing its progress, until it finishes."""
+    progress_bar = st.progress(0.0, text=f"Queued {filename}...")
+    while True:
+        response = requests.get(f"{JOBS_URL}{job_id}")
+        response.raise_for_status()
+        job = response.json()
+        progress = job['progress']
+        if job['status'] not in ('queued', 'running'):
+            progress_bar.empty()
+            return job
+        
+        text = f"Processing {filename}: {progress['chunks_processed']} chunks"
+        if progress.get('eta_seconds') is not None:
+            text += f", about {progress['eta_seconds']:.0f}s left"
+        progress_bar.progress(min(progress['percent'] / 100.0, 1.0), text=text)
+        time.sleep(JOB_POLL_INTERVAL)
+
+def iter_sse_events(response):
+    """Yield the data of each server-sent event of a streamed response, however the network splits it."""
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer = ""
+    for chunk in response.iter_content(chunk_size=None):
+        # A multi-byte character may be split across network chunks too
+        buffer += decoder.decode(chunk).replace('\r\n', '\n')
+        # Events end with a blank line; anything after the last one is kept for the next chunk
+        *events, buffer = buffer.split('\n\n')
+        for event in events:
+            data = [line[5:].lstrip(' ') for line in event.split('\n') if line.startswith('data:')]
+            if data:
+                yield '\n'.join(data)
 
 def send_chat_message(prompt: str):
     """Helper function to send a message to the chat backend and display the response."""
@@ -24,21 +60,16 @@ def send_chat_message(prompt: str):
             
             with requests.post(CHAT_URL, json=payload, stream=True) as r:
                 r.raise_for_status()
-                for chunk in r.iter_content(chunk_size=None):
-                    if chunk:
-                        decoded_chunk = chunk.decode('utf-8')
-                        if decoded_chunk.startswith('data: '):
-                            try:
-                                data_str = decoded_chunk[6:].strip()
-                                if data_str == '[DONE]':
-                                    break
-                                if data_str:
-                                    data = json.loads(data_str)
-                                    if data.get('content'):
-                                        full_response += data['content']
-                                        message_placeholder.markdown(full_response + "▌")
-                            except json.JSONDecodeError:
-                                pass # Ignore non-json data chunks
+                for data_str in iter_sse_events(r):
+                    if data_str == '[DONE]':
+                        break
+                    try:
+                        data = json.loads(data_str)
+                    except json.JSONDecodeError:
+                        continue # Ignore non-json events
+                    if data.get('content'):
+                        full_response += data['content']
+                        message_placeholder.markdown(full_response + "▌")
             message_placeholder.markdown(full_response)
         except requests.exceptions.RequestException as e:
             full_response = f"Error connecting to the backend: {e}"
@@ -63,8 +94,8 @@ for message in st.session_state.messages:
 with st.sidebar:
     st.header("Upload Documents")
     uploaded_files = st.file_uploader(
-        "Upload one or more JSON files", 
-        type=['json'], 
+        "Upload one or more JSON or JSON Lines files", 
+        type=['json', 'jsonl', 'ndjson'], 
         accept_multiple_files=True,
         key="file_uploader"
     )
@@ -76,17 +107,21 @@ with st.sidebar:
         new_files_to_process = [f for f in uploaded_files if f.file_id not in st.session_state.processed_files]
 
         for uploaded_file in new_files_to_process:
-            with st.spinner(f'Uploading and processing {uploaded_file.name}...'):
-                try:
+            try:
+                with st.spinner(f'Uploading {uploaded_file.name}...'):
                     files = {'file': (uploaded_file.name, uploaded_file.getvalue(), uploaded_file.type)}
                     response = requests.post(UPLOAD_URL, files=files)
                     response.raise_for_status()
+                job = wait_for_ingestion(response.json()['job_id'], uploaded_file.name)
+                if job['status'] == 'completed':
                     st.success(f"Successfully processed `{uploaded_file.name}`.")
                     # Add a message to the chat history and mark as processed
                     st.session_state.messages.append({"role": "assistant", "content": f"I have successfully processed `{uploaded_file.name}`. You can now ask questions about it."})
-                    st.session_state.processed_files.append(uploaded_file.file_id)
-                except requests.exceptions.RequestException as e:
-                    st.error(f"Error uploading {uploaded_file.name}: {e}")
+                else:
+                    st.error(f"Processing {uploaded_file.name} {job['status']}: {job.get('error') or ''}")
+                st.session_state.processed_files.append(uploaded_file.file_id)
+            except requests.exceptions.RequestException as e:
+                st.error(f"Error uploading {uploaded_file.name}: {e}")
         
         # Rerun to display the new messages in the chat
         if new_files_to_process:
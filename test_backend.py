@@ -1,6 +1,7 @@
 import requests
 import json
 import sys
+import time
 
 # Base URL for the API
 BASE_URL = "http://localhost:8000/api"
@@ -78,7 +79,18 @@ def test_file_upload():
         
         print(f"Status Code: {response.status_code}")
         print("Response:", json.dumps(response.json(), indent=2))
-        return response.status_code == 200
+        if response.status_code != 202:
+            return False
+        
+        # Poll the ingestion job until it finishes
+        job_id = response.json()["job_id"]
+        for _ in range(60):
+            job = requests.get(f"{BASE_URL}/jobs/{job_id}").json()
+            if job["status"] not in ("queued", "running"):
+                break
+            time.sleep(0.5)
+        print("Job:", json.dumps(job, indent=2))
+        return job["status"] == "completed"
     except Exception as e:
         print(f"Error: {e}")
         return False